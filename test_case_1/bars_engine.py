@@ -0,0 +1,163 @@
+import numpy as np
+import pandas as pd
+
+from price_index import PriceIndex
+
+class BarsEngine:
+    '''In-memory columnar copy of bars_1 that answers Task11 questions.
+
+    bars_1 is loaded once into flat NumPy arrays sorted by (symbol, date, id),
+    so every symbol occupies a contiguous slice. Lagged values, positive volume
+    and daily changes are computed with shifted arrays, and per-symbol
+    aggregates with np.bincount, no python loop runs over rows.
+
+    Window functions of Task11 SQL queries use lag() OVER (ORDER BY id),
+    so at the border of two symbols the lag reads the previous symbol.
+    by_id=True reproduces this exactly and is used to cross-check results
+    with SQL, by_id=False lags inside each symbol in date order.
+
+    Attributes:
+
+        symbols:np.ndarray
+            sorted unique symbols, symbol code is a position in this array
+
+        codes:np.ndarray
+            symbol code of every bar
+
+        days:np.ndarray
+            candle dates as days since epoch
+
+        ids, close, adj_close, volume:np.ndarray
+            columns of bars_1 in the same order as days
+
+        offsets:np.ndarray
+            bars of symbol code c are offsets[c]:offsets[c + 1]
+
+        id_order:np.ndarray
+            positions of bars in id order, used by by_id kernels
+
+    Methods:
+
+        from_df(df:pd.DataFrame)
+            builds engine from a dataframe with bars_1 columns
+
+        load(db_connector:PostgresConnector, table_name:str, chunk_size:int)
+            reads table with a server-side cursor and builds engine
+
+        date_mask(start, end)
+            returns a boolean mask of bars with start <= candle_date < end
+
+        lag(values:np.ndarray, lag:int, mask:np.ndarray, by_id:bool)
+            returns positions, values and lagged values of bars selected by mask,
+            raises ValueError if lag is smaller than 1
+
+        question_1(start, end, lag:int, by_id:bool)
+            symbols with adj_close bigger than adj_close lag bars ago, and their share of all symbols
+
+        question_2(start, end)
+            average dollar volume, adj_close * volume
+
+        question_3(start, end, by_id:bool)
+            positive volume of every symbol in ascending order
+
+        question_4(by_id:bool)
+            average absolute daily change of close of every symbol in ascending order
+    '''
+    COLUMNS = ['id', 'symbol', 'candle_date', 'close', 'adj_close', 'volume']
+
+    def __init__(self, ids, symbols, dates, closes, adj_closes, volumes):
+        ids = np.asarray(ids, dtype=np.int64)
+        days = PriceIndex.to_days(dates) if len(ids) else np.array([], dtype=np.int64)
+        self.symbols, codes = np.unique(np.asarray(symbols, dtype=str), return_inverse=True)
+        order = np.lexsort((ids, days, codes))
+        self.codes = codes[order].astype(np.int64)
+        self.days = days[order]
+        self.ids = ids[order]
+        self.close = np.asarray(closes, dtype=np.float64)[order]
+        self.adj_close = np.asarray(adj_closes, dtype=np.float64)[order]
+        self.volume = np.asarray(volumes, dtype=np.float64)[order]
+        self.offsets = np.searchsorted(self.codes, np.arange(len(self.symbols) + 1))
+        self.id_order = np.argsort(self.ids, kind='stable')
+
+    @classmethod
+    def from_df(cls, df:pd.DataFrame):
+        return cls(df['id'].values, df['symbol'].values, df['candle_date'].values,
+                   df['close'].values, df['adj_close'].values, df['volume'].values)
+
+    @classmethod
+    def load(cls, db_connector, table_name:str='bars_1', chunk_size:int=100000):
+        command = 'SELECT {} FROM {}'.format(', '.join(cls.COLUMNS), table_name)
+        chunks = list(db_connector.execute_stream_chunks(command, chunk_size=chunk_size, output='numpy'))
+        if not chunks:
+            return cls([], [], [], [], [], [])
+        columns = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in cls.COLUMNS}
+        return cls(columns['id'], columns['symbol'], columns['candle_date'],
+                   columns['close'], columns['adj_close'], columns['volume'])
+
+    def date_mask(self, start=None, end=None) -> np.ndarray:
+        mask = np.ones(len(self.days), dtype=bool)
+        if start is not None:
+            mask &= self.days >= PriceIndex.to_days([start])[0]
+        if end is not None:
+            mask &= self.days < PriceIndex.to_days([end])[0]
+        return mask
+
+    def lag(self, values:np.ndarray, lag:int=1, mask:np.ndarray=None, by_id:bool=False):
+        '''mask is applied before lag, like WHERE before a window function,
+        lagged value is nan if there is no bar lag rows back '''
+        if lag < 1:
+            raise ValueError('lag must be 1 or bigger, got {}'.format(lag))
+        if mask is None:
+            mask = np.ones(len(values), dtype=bool)
+        if by_id:
+            positions = self.id_order[mask[self.id_order]]
+        else:
+            positions = np.flatnonzero(mask)
+        current = values[positions]
+        lagged = np.full(len(positions), np.nan)
+        if lag < len(positions):
+            lagged[lag:] = current[:-lag]
+            if not by_id:
+                codes = self.codes[positions]
+                lagged[lag:][codes[lag:] != codes[:-lag]] = np.nan
+        return positions, current, lagged
+
+    def question_1(self, start='2019-01-01', end='2020-01-01', lag:int=40, by_id:bool=False):
+        positions, current, lagged = self.lag(self.adj_close, lag, self.date_mask(start, end), by_id)
+        with np.errstate(invalid='ignore'):
+            hit = current > lagged
+        symbols = self.symbols[np.unique(self.codes[positions[hit]])].tolist()
+        ratio = len(symbols) / len(self.symbols) if len(self.symbols) else None
+        return symbols, ratio
+
+    def question_2(self, start='2019-02-01', end='2019-03-01'):
+        mask = self.date_mask(start, end)
+        if not mask.any():
+            return None
+        return float(np.mean(self.adj_close[mask] * self.volume[mask]))
+
+    def question_3(self, start='2015-01-01', end='2016-01-01', by_id:bool=False) -> list:
+        '''only symbols with at least one positive day, like in SQL '''
+        positions, current, lagged = self.lag(self.adj_close, 1, self.date_mask(start, end), by_id)
+        with np.errstate(invalid='ignore'):
+            hit = positions[current > lagged]
+        n_symbols = len(self.symbols)
+        sums = np.bincount(self.codes[hit], weights=self.volume[hit], minlength=n_symbols)
+        present = np.flatnonzero(np.bincount(self.codes[hit], minlength=n_symbols))
+        present = present[np.argsort(sums[present], kind='stable')]
+        return list(zip(self.symbols[present].tolist(), sums[present].tolist()))
+
+    def question_4(self, by_id:bool=False) -> list:
+        '''symbols without any daily change get None and go last, like NULL in SQL '''
+        positions, current, lagged = self.lag(self.close, 1, None, by_id)
+        change = np.abs(current - lagged)
+        valid = ~np.isnan(change)
+        codes = self.codes[positions[valid]]
+        n_symbols = len(self.symbols)
+        counts = np.bincount(codes, minlength=n_symbols)
+        sums = np.bincount(codes, weights=change[valid], minlength=n_symbols)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / counts
+        order = np.argsort(means, kind='stable')
+        return [(symbol, None if counts[code] == 0 else float(means[code]))
+                for symbol, code in zip(self.symbols[order].tolist(), order)]
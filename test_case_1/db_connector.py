@@ -1,8 +1,19 @@
+import re
 import csv
 import time
+import datetime
+import uuid
+import weakref
+import threading
+import numpy as np
 import pandas as pd
 
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
 import psycopg2
+import psycopg2.extensions
 from configparser import ConfigParser
 from icecream import ic
 
@@ -27,6 +38,479 @@ class DBConnector:
         '''executes a database query '''
         pass
 
+class PoolTimeout(Exception):
+    '''raised when no connection becomes available within pool timeout '''
+    pass
+
+class ConnectionPool:
+    '''Bounded thread-safe pool of psycopg2 connections.
+
+    Connections are created lazily up to maxconn and reused between queries,
+    so a batch of queries pays the TCP+auth handshake only once per connection.
+    Safe to share between threads of a ThreadPoolExecutor.
+
+    Attributes:
+
+        connection_parameters:dict
+            postgres database connection parameters
+
+        minconn:int
+            number of idle connections that are never evicted
+
+        maxconn:int
+            maximum number of live connections (idle + checked out)
+
+        max_idle:float
+            idle connections older than max_idle seconds are closed
+
+        health_check_interval:float
+            connections idle longer than this are checked with SELECT 1 before reuse
+
+        timeout:float
+            how long getconn() waits for a free connection before PoolTimeout
+
+    Methods:
+
+        getconn()
+            checks out a healthy connection, waits if pool is exhausted
+
+        putconn(conn, discard:bool)
+            returns connection to the pool, broken connections are discarded
+
+        connection()
+            context manager around getconn()/putconn()
+
+        cursor(conn)
+            returns a cursor bound to conn, reused between checkouts
+
+        evict_idle()
+            closes connections idle longer than max_idle
+
+        stats()
+            returns pool statistics: checkouts, wait time, live connections
+
+        closeall()
+            closes all idle connections, pool can not be used after that
+    '''
+    def __init__(self, connection_parameters:dict, minconn:int=0, maxconn:int=10,
+                 max_idle:float=300, health_check_interval:float=30, timeout:float=30):
+        self.connection_parameters = connection_parameters
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+
+        '''idle connections as (conn, last_used), most recently used on the right '''
+        self.idle = deque()
+        self.cursors = {}
+        self.live = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.created = 0
+        self.evicted = 0
+        self.health_check_failures = 0
+
+    def connect(self):
+        conn = psycopg2.connect(**self.connection_parameters)
+        with self.condition:
+            self.created += 1
+        return conn
+
+    def close_connection(self, conn):
+        cur = self.cursors.pop(id(conn), None)
+        try:
+            if cur is not None:
+                cur.close()
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def evict_idle(self):
+        '''must be called with condition lock held '''
+        now = time.monotonic()
+        while len(self.idle) > self.minconn and now - self.idle[0][1] > self.max_idle:
+            conn, last_used = self.idle.popleft()
+            self.live -= 1
+            self.evicted += 1
+            self.close_connection(conn)
+
+    def check_health(self, conn, last_used:float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            cur = self.cursor(conn)
+            cur.execute('SELECT 1')
+            cur.fetchall()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        start_time = time.monotonic()
+        deadline = start_time + self.timeout
+        while True:
+            conn = None
+            last_used = None
+            with self.condition:
+                while True:
+                    if self.closed:
+                        raise PoolTimeout('Connection pool is closed')
+                    self.evict_idle()
+                    if self.idle:
+                        conn, last_used = self.idle.pop()
+                        break
+                    if self.live < self.maxconn:
+                        self.live += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout('No connection available in {} seconds'.format(self.timeout))
+                    self.condition.wait(remaining)
+
+            if conn is None:
+                try:
+                    conn = self.connect()
+                except Exception:
+                    with self.condition:
+                        self.live -= 1
+                        self.condition.notify()
+                    raise
+            elif not self.check_health(conn, last_used):
+                self.close_connection(conn)
+                with self.condition:
+                    self.live -= 1
+                    self.health_check_failures += 1
+                    self.condition.notify()
+                continue
+
+            with self.condition:
+                self.checkouts += 1
+                self.wait_time += time.monotonic() - start_time
+            return conn
+
+    def putconn(self, conn, discard:bool=False):
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        with self.condition:
+            if discard or conn.closed or self.closed:
+                self.live -= 1
+                self.close_connection(conn)
+            else:
+                self.idle.append((conn, time.monotonic()))
+            self.condition.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        except psycopg2.OperationalError:
+            self.putconn(conn, discard=True)
+            raise
+        except Exception:
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    def cursor(self, conn):
+        '''cursors are reused between checkouts of the same connection '''
+        cur = self.cursors.get(id(conn))
+        if cur is None or cur.closed:
+            cur = conn.cursor()
+            self.cursors[id(conn)] = cur
+        return cur
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                'checkouts': self.checkouts,
+                'wait_time': self.wait_time,
+                'avg_wait_time': self.wait_time / self.checkouts if self.checkouts else 0.0,
+                'live': self.live,
+                'idle': len(self.idle),
+                'in_use': self.live - len(self.idle),
+                'created': self.created,
+                'evicted': self.evicted,
+                'health_check_failures': self.health_check_failures,
+            }
+
+    def closeall(self):
+        with self.condition:
+            self.closed = True
+            while self.idle:
+                conn, last_used = self.idle.popleft()
+                self.live -= 1
+                self.close_connection(conn)
+            self.condition.notify_all()
+
+class QueryCache:
+    '''Size-bounded LRU cache of read query results.
+
+    Entries are keyed by normalized SQL text and query parameters.
+    Every table has a generation counter, an entry stores generations
+    of the tables its query reads and is stale once any of them is bumped,
+    so a write to bars_1 invalidates only queries that read bars_1.
+    Stale entries are dropped lazily when they are looked up or evicted.
+
+    Generations are bumped by writes made through the same connector only,
+    writes of other processes are not seen, so the cache should be enabled
+    for read-mostly sessions like Task11.
+
+    Attributes:
+
+        max_entries:int
+            maximum number of cached results
+
+        max_rows:int
+            maximum number of rows of all cached results,
+            a result bigger than max_rows is not cached
+
+        entries:OrderedDict
+            key -> (result, generations), least recently used first
+
+        generations:dict
+            table name -> generation counter
+
+    Methods:
+
+        normalize(command:str)
+            collapses whitespace of a query
+
+        make_key(command:str, data)
+            returns a hashable key of a query and its parameters
+
+        tables(command:str)
+            returns names of tables a query reads (FROM and JOIN clauses)
+
+        snapshot(tables:tuple)
+            returns current generations of tables, taken before a query is executed
+
+        get(key)
+            returns (True, result) of a fresh entry or (False, None)
+
+        put(key, result, tables:tuple, generations:tuple)
+            stores a result and evicts least recently used entries
+
+        invalidate(tables)
+            bumps generations of tables, None invalidates everything
+
+        stats()
+            returns hits, misses, stale lookups, evictions and size of cache
+    '''
+    TABLE_PATTERN = re.compile(r'\b(?:from|join)\s+([a-z_][a-z0-9_]*(?:\.[a-z_][a-z0-9_]*)?)', re.IGNORECASE)
+
+    def __init__(self, max_entries:int=256, max_rows:int=1000000):
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.entries = OrderedDict()
+        self.generations = {}
+        '''bumped by invalidate(None), makes every entry stale '''
+        self.epoch = 0
+        self.rows = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def normalize(command:str) -> str:
+        return ' '.join(command.split())
+
+    def make_key(self, command:str, data=None):
+        if isinstance(data, dict):
+            data = tuple(sorted(data.items()))
+        elif isinstance(data, list):
+            data = tuple(data)
+        return self.normalize(command), data
+
+    def tables(self, command:str) -> tuple:
+        '''CTE names are read as tables too, they are never bumped, so they do not matter '''
+        names = set(name.lower().split('.')[-1] for name in self.TABLE_PATTERN.findall(command))
+        return tuple(sorted(names))
+
+    def snapshot(self, tables:tuple) -> tuple:
+        with self.lock:
+            return (self.epoch,) + tuple(self.generations.get(table, 0) for table in tables)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            result, tables, generations = entry
+            if generations != (self.epoch,) + tuple(self.generations.get(table, 0) for table in tables):
+                self.drop(key)
+                self.stale += 1
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, result
+
+    def drop(self, key):
+        '''must be called with lock held '''
+        result, tables, generations = self.entries.pop(key)
+        self.rows -= len(result)
+
+    def put(self, key, result:list, tables:tuple, generations:tuple):
+        '''generations are taken before the query, so a result read while
+        a table was written is stored already stale '''
+        if len(result) > self.max_rows or self.max_entries <= 0:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.drop(key)
+            self.entries[key] = (result, tables, generations)
+            self.rows += len(result)
+            while len(self.entries) > self.max_entries or self.rows > self.max_rows:
+                self.drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, tables=None):
+        with self.lock:
+            self.invalidations += 1
+            if tables is None:
+                self.epoch += 1
+                return
+            if isinstance(tables, str):
+                tables = (tables,)
+            for table in tables:
+                table = table.lower()
+                self.generations[table] = self.generations.get(table, 0) + 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'stale': self.stale,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self.entries),
+                'rows': self.rows,
+            }
+
+class StatementRegistry:
+    '''Named parameterized statements prepared once per connection.
+
+    A statement is defined with psycopg2 %s placeholders. On the first
+    execution with a connection it is sent as PREPARE name AS ... with $n
+    placeholders, later executions send only EXECUTE name (params), so
+    Postgres parses and plans it once per connection instead of once per call.
+    Prepared statements outlive transactions and rollbacks and are dropped
+    with their connection, connections are tracked with weak references.
+    Table names can not be parameters, a statement is defined per table.
+
+    Without a long-lived connection (prepare=False) the statement text is
+    executed with bound parameters, one round trip like a plain query.
+
+    Attributes:
+
+        statements:dict
+            name -> (sql, prepare command, number of parameters)
+
+        prepared:WeakKeyDictionary
+            connection -> names of statements prepared on it
+
+        counts, times, max_times, prepares, errors:dict
+            name -> execution statistics
+
+    Methods:
+
+        define(name:str, sql:str)
+            registers a statement once and returns its name
+
+        execute(cur, name:str, data, fetch:bool, prepare:bool)
+            prepares statement on connection of cur if needed and executes it
+
+        stats()
+            returns executions, prepares, errors and latencies of every statement
+    '''
+    def __init__(self):
+        self.statements = {}
+        self.prepared = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+        self.counts = {}
+        self.times = {}
+        self.max_times = {}
+        self.prepares = {}
+        self.errors = {}
+
+    def define(self, name:str, sql:str) -> str:
+        if name in self.statements:
+            return name
+        parts = sql.split('%s')
+        body = parts[0] + ''.join('${}{}'.format(i + 1, part) for i, part in enumerate(parts[1:]))
+        with self.lock:
+            self.statements.setdefault(name, (sql, 'PREPARE {} AS {}'.format(name, body), len(parts) - 1))
+        return name
+
+    def execute(self, cur, name:str, data=(), fetch:bool=False, prepare:bool=True):
+        sql, prepare_command, n_params = self.statements[name]
+        start_time = time.perf_counter()
+        failed = False
+        try:
+            if not prepare:
+                cur.execute(sql, data)
+            else:
+                with self.lock:
+                    names = self.prepared.setdefault(cur.connection, set())
+                if name not in names:
+                    cur.execute(prepare_command)
+                    names.add(name)
+                    with self.lock:
+                        self.prepares[name] = self.prepares.get(name, 0) + 1
+                if n_params:
+                    cur.execute('EXECUTE {} ({})'.format(name, ', '.join(['%s'] * n_params)), data)
+                else:
+                    cur.execute('EXECUTE {}'.format(name))
+            return cur.fetchall() if fetch else None
+        except Exception:
+            failed = True
+            raise
+        finally:
+            time_spent = time.perf_counter() - start_time
+            with self.lock:
+                self.counts[name] = self.counts.get(name, 0) + 1
+                self.times[name] = self.times.get(name, 0.0) + time_spent
+                self.max_times[name] = max(self.max_times.get(name, 0.0), time_spent)
+                if failed:
+                    self.errors[name] = self.errors.get(name, 0) + 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                name: {
+                    'executions': count,
+                    'prepares': self.prepares.get(name, 0),
+                    'errors': self.errors.get(name, 0),
+                    'total_time': self.times[name],
+                    'avg_time': self.times[name] / count,
+                    'max_time': self.max_times[name],
+                }
+                for name, count in self.counts.items()
+            }
+
 class PostgresConnector(DBConnector):
     '''PostgreSQL database connector
 
@@ -41,6 +525,16 @@ class PostgresConnector(DBConnector):
         connection_parameters:dict
             postgres database connection parameters
 
+        pool:ConnectionPool
+            connection pool owned by connector, None if pooled is False
+
+        cache:QueryCache
+            result cache of execute_cached(), None if cache_size is 0
+
+        statements:StatementRegistry
+            parameterized statements of execute_prepared(),
+            prepared once per pooled connection
+
     Methods:
 
         config()
@@ -60,12 +554,64 @@ class PostgresConnector(DBConnector):
             read data from file, changes columns order and filters null values
             returns a list of preprocessed bars
 
-        execute(command:str, data=None, fetch=bool, executemany=bool)
+        execute(command:str, data=None, fetch=bool, executemany=bool, cur=None)
             Executes a query command.
-            Data contains some data like data to be inserted to database.
+            Data contains some data like data to be inserted to database
+            or query parameters.
             If fetch is True, method returns result of a query with cur.fetchall().
             If executemany is True, trades/errors are inserted into the database
             with a single query for better execution speed.
+            In pooled mode connection and cursor are taken from the pool
+            and returned after the query instead of being closed.
+            If cur is given, query is executed with it as a part of transaction().
+            Writes made with execute() do not invalidate the query cache,
+            call invalidate() with written tables after them.
+
+        execute_prepared(name:str, data, fetch:bool, cur=None)
+            executes a statement defined in statements with bound parameters,
+            in pooled mode it is prepared once per connection.
+            Errors are handled like in execute()
+
+        statement_stats()
+            returns execution counts and latencies of every statement
+
+        execute_cached(command:str, data=None, cur=None, statement:str=None)
+            same as execute(fetch=True), the result is served from cache
+            until a table read by the query is written through this connector.
+            If statement is given, command is its sql and it is run with execute_prepared()
+
+        invalidate(tables, cur)
+            bumps cache generations of written tables, None invalidates all entries.
+            Writes made with a transaction() cursor invalidate when the transaction ends.
+            Write methods of connector call it, raw execute() writes must call it themselves
+
+        cache_stats()
+            returns cache statistics, empty dict if cache is disabled
+
+        transaction()
+            context manager that yields a cursor, all queries executed with it
+            are committed or rolled back together
+
+        execute_stream(command:str, data=None, itersize:int)
+            executes a query with a named (server-side) cursor
+            and lazily yields rows, itersize rows are fetched per round trip
+
+        execute_stream_chunks(command:str, data=None, chunk_size:int, output:str)
+            same as execute_stream, yields chunks of chunk_size rows,
+            output is 'rows' (list of tuples), 'numpy' (dict of column arrays)
+            or 'pandas' (pd.DataFrame)
+
+        iter_data_limit(table_name:str, limit:int, chunk_size:int, output:str)
+            streaming version of read_data_limit
+
+        iter_data_by_symbol(table_name:str, symbol:str, chunk_size:int, output:str)
+            streaming version of read_data_by_symbol
+
+        pool_stats()
+            returns connection pool statistics, empty dict if pooled is False
+
+        close()
+            closes all pooled connections
 
         insert_data_executemany(data:list, table_name:str, fetch:bool)
             bulk insert trades to database
@@ -79,28 +625,68 @@ class PostgresConnector(DBConnector):
         read_symbols_distinct(table_name:str)
             creates a list of all symbols present in table
 
+        read_symbols_since(table_name:str, last_id:int)
+            returns (symbol, max id) for symbols of rows with id bigger than last_id
+
+        read_symbols_present(symbols:list, table_name:str, cur)
+            returns rows of symbols of the list that are present in table
+
         insert_error_data_list(data:list, table_name:str)
             bulk insert errors to database
 
         delete_data(table_name:str, limit:int)
             deletes n rows from table
 
+        claim_data(table_name:str, limit:int, cur)
+            deletes and returns n oldest rows not locked by other workers
+            (FOR UPDATE SKIP LOCKED)
+
         find_minimum_price(symbol:str, start_date:str, candle_date:str)
             returns all data for a specific symbol
             with timestamps between start_date and candle_date
 
+        find_minimum_prices(probes:list, table_name:str, cur)
+            takes (symbol, candle_date, n_days) probes and returns minimum close
+            of every probe window candle_date - n_days <= date <= candle_date,
+            None if window has no bars. All probes are sent in one query
+
         delete_tables()
             deletes all tables from database
 
-        create_tables()
-            creates tables bars_1, bars_2 and error_log
+        create_tables(indexed:bool, partition_by_year:bool, years)
+            creates tables bars_1, bars_2 and error_log.
+            If indexed is True, adds (symbol, candle_date) indexes and BRIN on candle_date.
+            If partition_by_year is True, bars_1 is range partitioned by candle_date,
+            one partition per year plus a default partition
+
+        create_indexes()
+            creates indexes of create_tables(indexed=True) if they do not exist
+
+        partition_bars_1(years)
+            moves existing bars_1 data into a table partitioned by year
+
+        migrate_schema(partition_by_year:bool)
+            upgrades an existing database to the indexed (and partitioned) schema
     '''
-    def __init__(self, config_filename:str, config_section:str):
+    def __init__(self, config_filename:str, config_section:str, pooled:bool=False,
+                 pool_size:int=10, max_idle:float=300, cache_size:int=0, cache_rows:int=1000000):
         self.config_filename = config_filename
         self.config_section = config_section
 
         self.connection_parameters = self.config()
 
+        self.pool = None
+        if pooled:
+            self.pool = ConnectionPool(self.connection_parameters, maxconn=pool_size, max_idle=max_idle)
+
+        self.cache = None
+        if cache_size:
+            self.cache = QueryCache(max_entries=cache_size, max_rows=cache_rows)
+        '''id(cur) -> tables written in a transaction, invalidated when it ends '''
+        self.pending_invalidations = {}
+
+        self.statements = StatementRegistry()
+
     def config(self) -> dict:
         parser = ConfigParser()
         parser.read(self.config_filename)
@@ -141,76 +727,328 @@ class PostgresConnector(DBConnector):
         ic("data preprocessed in %s seconds" % (time_spent))
         return result
 
-    def execute(self, command:str, data=None, fetch=False, executemany=False):
+    def execute(self, command:str, data=None, fetch=False, executemany=False, cur=None):
         '''executes a database query '''
+        if cur is not None:
+            '''query is a part of transaction(), errors are raised to roll it back '''
+            if fetch:
+                cur.execute(command, data)
+                return cur.fetchall()
+            if executemany:
+                cur.executemany(command, data)
+            else:
+                cur.execute(command, data)
+            return None
+
         start_time = time.time()
         conn = None
+        broken = False
         result = None
         try:
-            conn = psycopg2.connect(**self.connection_parameters)
-            cur = conn.cursor()
+            if self.pool is not None:
+                conn = self.pool.getconn()
+                cur = self.pool.cursor(conn)
+            else:
+                conn = psycopg2.connect(**self.connection_parameters)
+                cur = conn.cursor()
             if fetch:
-                cur.execute(command)
+                cur.execute(command, data)
                 result = cur.fetchall()
             else:
                 if executemany:
                     cur.executemany(command, data)
                 else:
                     cur.execute(command, data)
-            cur.close()
+            if self.pool is None:
+                cur.close()
             conn.commit()
         except (Exception, psycopg2.DatabaseError) as error:
+            broken = isinstance(error, psycopg2.OperationalError)
             print(error)
         finally:
             time_spent = time.time() - start_time
             ic("executed in %s seconds" % (time_spent))
             if conn is not None:
-                conn.close()
+                if self.pool is not None:
+                    self.pool.putconn(conn, discard=broken)
+                else:
+                    conn.close()
             return result
 
-    def insert_data_executemany(self, data:list, table_name:str, fetch=False):
+    def execute_prepared(self, name:str, data=(), fetch=False, cur=None):
+        '''only pooled connections live long enough for PREPARE to pay off '''
+        prepare = self.pool is not None
+        if cur is not None:
+            return self.statements.execute(cur, name, data, fetch=fetch, prepare=prepare)
+
+        conn = None
+        broken = False
+        result = None
+        try:
+            if self.pool is not None:
+                conn = self.pool.getconn()
+                cur = self.pool.cursor(conn)
+            else:
+                conn = psycopg2.connect(**self.connection_parameters)
+                cur = conn.cursor()
+            result = self.statements.execute(cur, name, data, fetch=fetch, prepare=prepare)
+            if self.pool is None:
+                cur.close()
+            conn.commit()
+        except (Exception, psycopg2.DatabaseError) as error:
+            broken = isinstance(error, psycopg2.OperationalError)
+            print(error)
+        finally:
+            if conn is not None:
+                if self.pool is not None:
+                    self.pool.putconn(conn, discard=broken)
+                else:
+                    conn.close()
+        return result
+
+    def statement_stats(self) -> dict:
+        return self.statements.stats()
+
+    def execute_cached(self, command:str, data=None, cur=None, statement:str=None):
+        '''queries of a transaction may see its uncommitted writes, so they are not cached '''
+        def fetch(cur=None):
+            if statement is not None:
+                return self.execute_prepared(statement, data, fetch=True, cur=cur)
+            return self.execute(command, data, fetch=True, executemany=False, cur=cur)
+
+        if self.cache is None or cur is not None:
+            return fetch(cur)
+        key = self.cache.make_key(command, data)
+        found, result = self.cache.get(key)
+        if found:
+            return list(result)
+        tables = self.cache.tables(command)
+        generations = self.cache.snapshot(tables)
+        result = fetch()
+        if result is not None:
+            self.cache.put(key, result, tables, generations)
+            result = list(result)
+        return result
+
+    def invalidate(self, tables=None, cur=None):
+        if self.cache is None:
+            return
+        if cur is not None and id(cur) in self.pending_invalidations:
+            self.pending_invalidations[id(cur)].append(tables)
+            return
+        self.cache.invalidate(tables)
+
+    def cache_stats(self) -> dict:
+        if self.cache is None:
+            return {}
+        return self.cache.stats()
+
+    @contextmanager
+    def transaction(self):
+        '''yields a cursor, queries executed with it are committed together
+        when the block exits, or rolled back if it raises '''
+        if self.pool is not None:
+            conn = self.pool.getconn()
+        else:
+            conn = psycopg2.connect(**self.connection_parameters)
+        cur = conn.cursor()
+        if self.cache is not None:
+            self.pending_invalidations[id(cur)] = []
+        try:
+            yield cur
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            '''generations are bumped after commit, a result read before it is stored stale '''
+            for tables in self.pending_invalidations.pop(id(cur), ()):
+                self.cache.invalidate(tables)
+            cur.close()
+            if self.pool is not None:
+                self.pool.putconn(conn)
+            else:
+                conn.close()
+
+    @contextmanager
+    def named_cursor(self, itersize:int=10000):
+        '''named cursors keep result set on the server, rows are fetched on demand '''
+        if self.pool is not None:
+            conn = self.pool.getconn()
+        else:
+            conn = psycopg2.connect(**self.connection_parameters)
+        cur = conn.cursor(name='stream_{}'.format(uuid.uuid4().hex))
+        cur.itersize = itersize
+        try:
+            yield cur
+        finally:
+            try:
+                cur.close()
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+            if self.pool is not None:
+                self.pool.putconn(conn)
+            else:
+                conn.close()
+
+    def execute_stream(self, command:str, data=None, itersize:int=10000):
+        with self.named_cursor(itersize=itersize) as cur:
+            cur.execute(command, data)
+            for row in cur:
+                yield row
+
+    def to_columns(self, rows:list, columns:list, output:str='rows'):
+        if output == 'numpy':
+            if not rows:
+                return {column: np.array([]) for column in columns}
+            return {column: np.array(values) for column, values in zip(columns, zip(*rows))}
+        if output == 'pandas':
+            return pd.DataFrame(rows, columns=columns)
+        return rows
+
+    def execute_stream_chunks(self, command:str, data=None, chunk_size:int=10000, output:str='rows'):
+        with self.named_cursor(itersize=chunk_size) as cur:
+            cur.execute(command, data)
+            columns = None
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                if columns is None:
+                    columns = [column.name for column in cur.description]
+                yield self.to_columns(rows, columns, output)
+
+    def pool_stats(self) -> dict:
+        if self.pool is None:
+            return {}
+        return self.pool.stats()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.closeall()
+
+    def insert_data_executemany(self, data:list, table_name:str, fetch=False, cur=None):
         q = "INSERT INTO {} (candle_date, symbol, open, high, low, close, adj_close, volume) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)".format(table_name)
-        self.execute(q, data, fetch=False, executemany=True)
+        self.execute(q, data, fetch=False, executemany=True, cur=cur)
+        self.invalidate(table_name, cur=cur)
 
     def read_data_limit(self, table_name:str='bars_1', limit:int=0):
-        q = "select * from {} limit {}".format(table_name, limit)
-        data = self.execute(q, data=None, fetch=True, executemany=False)
+        name = self.statements.define('read_data_limit_{}'.format(table_name),
+                                      "select * from {} limit %s".format(table_name))
+        data = self.execute_prepared(name, data=(limit,), fetch=True)
         return data
 
     def read_data_by_symbol(self, table_name:str='bars_1', symbol:str='ABC'):
-        q = "select * from {} where symbol = '{}'".format(table_name, symbol)
-        data = self.execute(q, data=None, fetch=True, executemany=False)
+        name = self.statements.define('read_data_by_symbol_{}'.format(table_name),
+                                      "select * from {} where symbol = %s".format(table_name))
+        data = self.execute_prepared(name, data=(symbol,), fetch=True)
         return data
 
+    def iter_data_limit(self, table_name:str='bars_1', limit:int=None, chunk_size:int=10000, output:str='rows'):
+        '''limit None streams the whole table '''
+        q = "select * from {}".format(table_name)
+        if limit is not None:
+            q += " limit {}".format(int(limit))
+        return self.execute_stream_chunks(q, data=None, chunk_size=chunk_size, output=output)
+
+    def iter_data_by_symbol(self, table_name:str='bars_1', symbol:str='ABC', chunk_size:int=10000, output:str='rows'):
+        q = "select * from {} where symbol = %s order by candle_date".format(table_name)
+        return self.execute_stream_chunks(q, data=(symbol,), chunk_size=chunk_size, output=output)
+
     def read_symbols_distinct(self, table_name:str='bars_1') -> list:
         '''returns a list of symbols present in table '''
 
         q = "select distinct symbol from {}".format(table_name)
+        data = self.execute_cached(q, data=None)
+        return data
+
+    def read_symbols_since(self, table_name:str='bars_1', last_id:int=0) -> list:
+        '''used to refresh a list of symbols without reading the whole table '''
+        q = "select symbol, max(id) from {} where id > {} group by symbol".format(table_name, int(last_id))
         data = self.execute(q, data=None, fetch=True, executemany=False)
         return data
 
-    def insert_error_data_list(self, data:list, table_name:str='error_log'):
+    def read_symbols_present(self, symbols:list, table_name:str='bars_1', cur=None) -> list:
+        '''one index lookup per symbol, rows are (symbol,) like in read_symbols_distinct '''
+        q = """select s.symbol from unnest(%s::text[]) as s(symbol)
+            where exists (select 1 from {} t where t.symbol = s.symbol)""".format(table_name)
+        data = self.execute(q, data=(list(symbols),), fetch=True, executemany=False, cur=cur)
+        return data
+
+    def insert_error_data_list(self, data:list, table_name:str='error_log', cur=None):
         q = "INSERT INTO {} (launch_timestamp, date, symbol, message) VALUES (%s, %s, %s, %s)".format(table_name)
-        self.execute(q, data, fetch=False, executemany=True)
+        self.execute(q, data, fetch=False, executemany=True, cur=cur)
+        self.invalidate(table_name, cur=cur)
+
+    def claim_data(self, table_name:str='bars_2', limit:int=20000, cur=None) -> list:
+        '''deletes up to limit oldest rows and returns them.
+        Rows locked by other workers are skipped, so concurrent workers
+        never claim the same row. Use inside transaction() to make
+        the claim permanent only together with processing results. '''
+        q = """DELETE FROM {} WHERE id IN (
+                SELECT id FROM {} ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, candle_date, symbol, open, high, low, close, adj_close, volume
+            """.format(table_name, table_name)
+        data = self.execute(q, data=(limit,), fetch=True, executemany=False, cur=cur)
+        self.invalidate(table_name, cur=cur)
+        if data:
+            data.sort(key=lambda row: row[0])
+        return data
 
     def delete_data(self, table_name:str, limit:int):
-        q = """DELETE from {} WHERE id IN (SELECT id FROM {} LIMIT {})
-            """.format(table_name, table_name, limit)
-        self.execute(q, data=None, fetch=False, executemany=False)
+        name = self.statements.define('delete_data_{}'.format(table_name),
+                                      "DELETE from {} WHERE id IN (SELECT id FROM {} LIMIT %s)".format(table_name, table_name))
+        self.execute_prepared(name, data=(limit,), fetch=False)
+        self.invalidate(table_name)
 
     def find_minimum_price(self, symbol:str, start_date:str, candle_date:str):
-        q = """SELECT * from bars_1 WHERE symbol = '{}' AND candle_date >= '{}' AND candle_date <= '{}'
-            """.format(symbol, start_date, candle_date)
-        data = self.execute(q, data=None, fetch=True, executemany=False)
+        q = "SELECT * from bars_1 WHERE symbol = %s AND candle_date >= %s AND candle_date <= %s"
+        name = self.statements.define('find_minimum_price', q)
+        data = self.execute_cached(q, data=(symbol, start_date, candle_date), statement=name)
         return data
 
+    def find_minimum_prices(self, probes:list, table_name:str='bars_1', cur=None) -> list:
+        '''probes are sent as arrays and joined with bars_1 with LATERAL min(close),
+        equal probes are sent once. Every probe is an index range scan of
+        (symbol, candle_date), without create_indexes() every probe scans the table '''
+        unique = list(dict.fromkeys((symbol, candle_date, int(n_days)) for symbol, candle_date, n_days in probes))
+        if not unique:
+            return []
+        q = """
+        SELECT m.min_close
+        FROM unnest(%s::text[], %s::text[]::date[], %s::int[]) WITH ORDINALITY AS p(symbol, candle_date, n_days, n)
+        LEFT JOIN LATERAL (
+            SELECT min(b.close) AS min_close
+            FROM {} b
+            WHERE b.symbol = p.symbol
+            AND b.candle_date >= p.candle_date - p.n_days
+            AND b.candle_date <= p.candle_date
+        ) m ON true
+        ORDER BY p.n
+        """.format(table_name)
+        name = self.statements.define('find_minimum_prices_{}'.format(table_name), q)
+        symbols, candle_dates, n_days = (list(column) for column in zip(*unique))
+        '''dates and date strings are sent as text, a date array parameter does not accept text '''
+        candle_dates = [str(candle_date) for candle_date in candle_dates]
+        data = self.execute_prepared(name, data=(symbols, candle_dates, n_days), fetch=True, cur=cur)
+        if data is None:
+            return None
+        minimums = dict(zip(unique, (row[0] for row in data)))
+        return [minimums[(symbol, candle_date, int(n_days))] for symbol, candle_date, n_days in probes]
+
     def delete_tables(self):
         q = """ DROP SCHEMA public CASCADE; CREATE SCHEMA public; """
         self.execute(q, data=None, fetch=False, executemany=False)
+        self.invalidate()
 
-    def create_tables(self):
-        q = """
-        CREATE TABLE bars_1 (
+    def bars_table_sql(self, table_name:str, partition_by_year:bool=False, years=()) -> str:
+        '''partition key must be a part of primary key of a partitioned table '''
+        if not partition_by_year:
+            return """
+        CREATE TABLE {} (
             id BIGSERIAL PRIMARY KEY,
             candle_date DATE NOT NULL,
             symbol TEXT NOT NULL,
@@ -221,8 +1059,11 @@ class PostgresConnector(DBConnector):
             adj_close FLOAT NOT NULL,
             volume FLOAT NOT NULL
         );
-        CREATE TABLE bars_2 (
-            id BIGSERIAL PRIMARY KEY,
+        """.format(table_name)
+
+        q = """
+        CREATE TABLE {} (
+            id BIGSERIAL,
             candle_date DATE NOT NULL,
             symbol TEXT NOT NULL,
             open FLOAT NOT NULL,
@@ -230,17 +1071,89 @@ class PostgresConnector(DBConnector):
             low FLOAT NOT NULL,
             close FLOAT NOT NULL,
             adj_close FLOAT NOT NULL,
-            volume FLOAT NOT NULL
-        );
+            volume FLOAT NOT NULL,
+            PRIMARY KEY (id, candle_date)
+        ) PARTITION BY RANGE (candle_date);
+        """.format(table_name)
+        for year in years:
+            q += """
+        CREATE TABLE {0}_{1} PARTITION OF {0} FOR VALUES FROM ('{1}-01-01') TO ('{2}-01-01');
+        """.format(table_name, int(year), int(year) + 1)
+        q += """
+        CREATE TABLE {0}_default PARTITION OF {0} DEFAULT;
+        """.format(table_name)
+        return q
+
+    def indexes_sql(self) -> str:
+        '''indexes created on a partitioned table are created on every partition '''
+        q = """
+        CREATE INDEX IF NOT EXISTS bars_1_symbol_candle_date_idx ON bars_1 (symbol, candle_date);
+        CREATE INDEX IF NOT EXISTS bars_1_candle_date_brin ON bars_1 USING BRIN (candle_date);
+        CREATE INDEX IF NOT EXISTS bars_2_symbol_candle_date_idx ON bars_2 (symbol, candle_date);
+        CREATE INDEX IF NOT EXISTS error_log_symbol_date_idx ON error_log (symbol, date);
+        """
+        return q
+
+    def create_tables(self, indexed:bool=False, partition_by_year:bool=False, years=range(2000, 2031)):
+        q = self.bars_table_sql('bars_1', partition_by_year=partition_by_year, years=years)
+        q += self.bars_table_sql('bars_2')
+        q += """
         CREATE TABLE error_log (
             id BIGSERIAL PRIMARY KEY,
             launch_timestamp FLOAT(4),
             date DATE NOT NULL,
             symbol TEXT NOT NULL,
             message TEXT NOT NULL
-        )
+        );
         """
+        if indexed:
+            q += self.indexes_sql()
         self.execute(q, data=None, fetch=False, executemany=False)
+        self.invalidate()
+
+    def create_indexes(self):
+        q = self.indexes_sql() + """
+        ANALYZE bars_1;
+        ANALYZE bars_2;
+        ANALYZE error_log;
+        """
+        self.execute(q, data=None, fetch=False, executemany=False)
+
+    def partition_bars_1(self, years=None):
+        '''runs in one transaction: old table is renamed, data is copied with the same ids,
+        id sequence continues from the last id and old table is dropped.
+        If years is None, partitions cover all years present in bars_1 '''
+        if years is None:
+            data = self.execute("select extract(year from min(candle_date)), extract(year from max(candle_date)) from bars_1",
+                                data=None, fetch=True, executemany=False)
+            if not data or data[0][0] is None:
+                years = range(2000, 2031)
+            else:
+                years = range(int(data[0][0]), int(data[0][1]) + 1)
+        q = """
+        ALTER TABLE bars_1 RENAME TO bars_1_unpartitioned;
+        ALTER SEQUENCE bars_1_id_seq RENAME TO bars_1_unpartitioned_id_seq;
+        ALTER INDEX bars_1_pkey RENAME TO bars_1_unpartitioned_pkey;
+        """
+        q += self.bars_table_sql('bars_1', partition_by_year=True, years=years)
+        q += """
+        INSERT INTO bars_1 (id, candle_date, symbol, open, high, low, close, adj_close, volume)
+        SELECT id, candle_date, symbol, open, high, low, close, adj_close, volume FROM bars_1_unpartitioned;
+        SELECT setval('bars_1_id_seq', COALESCE((SELECT max(id) FROM bars_1), 0) + 1, false);
+        DROP TABLE bars_1_unpartitioned;
+        """
+        self.execute(q, data=None, fetch=False, executemany=False)
+        self.invalidate('bars_1')
+
+    def migrate_schema(self, partition_by_year:bool=False):
+        '''safe to run more than once: indexes use IF NOT EXISTS,
+        bars_1 is partitioned only if it is not partitioned yet '''
+        if partition_by_year:
+            data = self.execute("select relkind from pg_class where relname = 'bars_1'",
+                                data=None, fetch=True, executemany=False)
+            if data and data[0][0] != 'p':
+                self.partition_bars_1()
+        self.create_indexes()
 
 '''a class for manual testing PostgreSQL database connector '''
 class TestPostgressConnector:
@@ -266,6 +1179,16 @@ class TestPostgressConnector:
         data = self.db_connector.preprocess_data(source_filename)
         self.db_connector.insert_data_executemany(data, table_name)
 
+    def test_iter_data_limit(self, table_name='bars_1', chunk_size=10000, output='pandas'):
+        start_time = time.time()
+        n_rows = 0
+        for chunk in self.db_connector.iter_data_limit(table_name, chunk_size=chunk_size, output=output):
+            n_rows += len(chunk) if output != 'numpy' else len(chunk['id'])
+        ic('streamed %s rows in %s seconds' % (n_rows, time.time() - start_time))
+
+    def test_migrate_schema(self, partition_by_year=False):
+        self.db_connector.migrate_schema(partition_by_year=partition_by_year)
+
     def test_read_symbols_distinct(self, table_name):
         data = self.db_connector.read_symbols_distinct(table_name)
         ic(len(data))
@@ -291,6 +1214,82 @@ class TestPostgressConnector:
             ic('last element:', data[-1])
             ic(type(data[-1][1]))
 
+    def test_pooled_execute(self, n_queries=100, n_threads=8):
+        connector = PostgresConnector(self.db_connector.config_filename, self.db_connector.config_section,
+                                      pooled=True, pool_size=n_threads)
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(lambda i: connector.read_data_limit('bars_1', 1), range(n_queries)))
+        ic('pooled queries executed in %s seconds' % (time.time() - start_time))
+        ic(connector.pool_stats())
+        connector.close()
+
+    def test_query_cache(self, symbol='MMM', start_date='2010-02-01', candle_date='2019-11-11') -> bool:
+        '''repeated reads are cache hits, a write to bars_1 makes them stale,
+        a write to another table does not '''
+        connector = PostgresConnector(self.db_connector.config_filename, self.db_connector.config_section, cache_size=16)
+        expected = connector.find_minimum_price(symbol, start_date, candle_date)
+        symbols = connector.read_symbols_distinct('bars_1')
+        start_time = time.time()
+        for i in range(100):
+            connector.find_minimum_price(symbol, start_date, candle_date)
+        ic('100 cached reads in %s seconds' % (time.time() - start_time))
+        hits = connector.cache_stats()['hits'] == 100
+
+        connector.invalidate('error_log')
+        still_cached = connector.read_symbols_distinct('bars_1') == symbols
+        hits = hits and connector.cache_stats()['hits'] == 101
+
+        with connector.transaction() as cur:
+            connector.insert_data_executemany([['2100-01-01', symbol, 1, 1, 1, 1, 1, 1]], 'bars_1', cur=cur)
+            cur.execute("DELETE FROM bars_1 WHERE candle_date = '2100-01-01'")
+        stats = connector.cache_stats()
+        data = connector.find_minimum_price(symbol, start_date, candle_date)
+        stale = connector.cache_stats()['stale'] == stats['stale'] + 1 and data == expected
+        ic(connector.cache_stats())
+        return hits and still_cached and stale
+
+    def test_prepared_statements(self, symbol='MMM', n_queries=1000) -> bool:
+        '''a pooled connection prepares statement once, compares latency with
+        a query that is parsed and planned on every call '''
+        connector = PostgresConnector(self.db_connector.config_filename, self.db_connector.config_section,
+                                      pooled=True, pool_size=1)
+        expected = connector.read_data_by_symbol('bars_1', symbol)
+        start_time = time.time()
+        same = all(connector.read_data_by_symbol('bars_1', symbol) == expected for i in range(n_queries))
+        ic('%s prepared queries in %s seconds' % (n_queries, time.time() - start_time))
+
+        q = "select * from bars_1 where symbol = '{}'".format(symbol)
+        start_time = time.time()
+        for i in range(n_queries):
+            connector.execute(q, data=None, fetch=True, executemany=False)
+        ic('%s plain queries in %s seconds' % (n_queries, time.time() - start_time))
+
+        stats = connector.statement_stats()['read_data_by_symbol_bars_1']
+        ic(stats)
+        connector.close()
+        return same and stats['prepares'] == 1 and stats['executions'] == n_queries + 1
+
+    def test_find_minimum_prices(self, n_probes=1000, n_days=10) -> bool:
+        '''batched minimums are equal to minimums of find_minimum_price rows '''
+        rows = self.db_connector.execute('SELECT symbol, candle_date FROM bars_1 ORDER BY random() LIMIT %s',
+                                         data=(n_probes,), fetch=True, executemany=False)
+        probes = [(symbol, candle_date, n_days) for symbol, candle_date in rows]
+        probes.append(('NOT_A_SYMBOL', '2019-01-01', n_days))
+
+        start_time = time.time()
+        minimums = self.db_connector.find_minimum_prices(probes, 'bars_1')
+        ic('%s probes in one query: %s seconds' % (len(probes), time.time() - start_time))
+
+        start_time = time.time()
+        expected = []
+        for symbol, candle_date, n in probes:
+            start_date = datetime.date.fromisoformat(str(candle_date)) - datetime.timedelta(days=n)
+            data = self.db_connector.find_minimum_price(symbol, start_date, candle_date)
+            expected.append(min(row[6] for row in data) if data else None)
+        ic('%s probes one by one: %s seconds' % (len(probes), time.time() - start_time))
+        return minimums == expected
+
     def test_find_minimum_price(self, symbol, start_date, candle_date):
         data = self.db_connector.find_minimum_price(symbol, start_date, candle_date)
         ic('len of data tuple', len(data))
@@ -317,6 +1316,9 @@ class TestPostgressConnector:
         #self.test_delete_data(table_name='error_log', limit = 99)
 
         #self.test_find_minimum_price(symbol='MMM', start_date='2010-02-01', candle_date='2019-11-11')
+        #self.test_find_minimum_prices(n_probes=1000, n_days=10)
+        #self.test_prepared_statements(symbol='MMM', n_queries=1000)
+        #self.test_query_cache(symbol='MMM', start_date='2010-02-01', candle_date='2019-11-11')
         pass
 
 
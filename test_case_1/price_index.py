@@ -0,0 +1,231 @@
+import numpy as np
+import pandas as pd
+
+from multiprocessing import shared_memory
+
+class PriceIndex:
+    '''Per-symbol, date-sorted index of close prices from bars_1.
+
+    Bars are sorted once by (symbol, date) and stored in flat NumPy arrays.
+    A sparse table over close prices answers "minimum close between two positions"
+    in O(1), so a minimum-price check is two binary searches plus one lookup.
+    Every symbol occupies a contiguous slice of the arrays, and search keys
+    combine symbol code and date, so a whole batch of checks is
+    evaluated with a few vectorized NumPy calls.
+
+    Attributes:
+
+        symbol_codes:dict
+            symbol -> integer code, codes follow the sort order of symbols
+
+        days:np.ndarray
+            candle dates as days since epoch, sorted within each symbol
+
+        closes:np.ndarray
+            close prices in the same order as days
+
+        keys:np.ndarray
+            sorted search keys: symbol code * stride + relative day
+
+        sparse:list
+            sparse[k][i] is the minimum of closes[i:i + 2**k]
+
+    Methods:
+
+        from_df(df:pd.DataFrame, date_column:str, symbol_column:str, close_column:str)
+            builds index from a dataframe with bars_1 data
+
+        window_bounds(codes:np.ndarray, start_days:np.ndarray, end_days:np.ndarray)
+            returns [lo, hi) positions of bars between start and end dates, inclusive
+
+        range_min(lo:np.ndarray, hi:np.ndarray)
+            returns minimum close in [lo, hi), nan for empty ranges
+
+        minimum_prices(symbols, candle_dates, n_days:int)
+            returns minimum close over last n_days for every probe, nan if no data
+
+        minimum_price(symbol:str, candle_date, n_days:int)
+            single probe version of minimum_prices
+
+        check_batch(symbols, candle_dates, closes, n_days:int)
+            returns a boolean array, True if close is bigger than the minimum
+
+        check(symbol:str, candle_date, close:float, n_days:int)
+            returns True/False, or None if there is no data for the window
+
+        share()
+            copies index arrays to shared memory and returns a picklable spec
+
+        attach(spec:dict)
+            builds a read-only index on top of shared memory described by spec,
+            used in worker processes, no arrays are copied
+
+        release()
+            closes shared memory, owner process also unlinks it
+    '''
+    ARRAYS = ['codes', 'days', 'closes', 'keys']
+
+    def __init__(self, symbols, days, closes):
+        symbols = np.asarray(symbols)
+        days = np.asarray(days, dtype=np.int64)
+        closes = np.asarray(closes, dtype=np.float64)
+
+        unique_symbols, codes = np.unique(symbols, return_inverse=True)
+        order = np.lexsort((days, codes))
+        self.symbol_codes = {symbol: code for code, symbol in enumerate(unique_symbols.tolist())}
+        self.codes = codes[order].astype(np.int64)
+        self.days = days[order]
+        self.closes = closes[order]
+
+        '''relative days are clipped to [0, span + 2] so that keys of a symbol
+        never overlap with keys of its neighbours '''
+        self.min_day = int(self.days.min()) if len(self.days) else 0
+        self.span = int(self.days.max()) - self.min_day if len(self.days) else 0
+        self.stride = self.span + 3
+        self.keys = self.codes * self.stride + self.relative_days(self.days)
+
+        self.sparse = self.build_sparse_table(self.closes)
+        self.shared_blocks = []
+        self.owner = False
+
+    @classmethod
+    def from_df(cls, df:pd.DataFrame, date_column:str='Date', symbol_column:str='Symbol', close_column:str='Close'):
+        return cls(df[symbol_column].astype(str).values, cls.to_days(df[date_column]), df[close_column].values)
+
+    @staticmethod
+    def to_days(dates) -> np.ndarray:
+        '''dates, strings or datetimes -> days since epoch '''
+        return pd.to_datetime(pd.Series(dates)).values.astype('datetime64[D]').astype(np.int64)
+
+    @staticmethod
+    def build_sparse_table(values:np.ndarray) -> list:
+        table = [values]
+        width = 1
+        while 2 * width <= len(values):
+            previous = table[-1]
+            table.append(np.minimum(previous[:-width], previous[width:]))
+            width *= 2
+        return table
+
+    def relative_days(self, days:np.ndarray) -> np.ndarray:
+        return np.clip(days - self.min_day, -1, self.span + 1) + 1
+
+    def encode_symbols(self, symbols) -> np.ndarray:
+        '''unknown symbols get code -1 '''
+        return np.fromiter((self.symbol_codes.get(symbol, -1) for symbol in symbols), dtype=np.int64, count=len(symbols))
+
+    def window_bounds(self, codes:np.ndarray, start_days:np.ndarray, end_days:np.ndarray):
+        lo = np.searchsorted(self.keys, codes * self.stride + self.relative_days(start_days), side='left')
+        hi = np.searchsorted(self.keys, codes * self.stride + self.relative_days(end_days), side='right')
+        unknown = codes < 0
+        lo[unknown] = 0
+        hi[unknown] = 0
+        return lo, hi
+
+    def range_min(self, lo:np.ndarray, hi:np.ndarray) -> np.ndarray:
+        result = np.full(len(lo), np.nan)
+        length = hi - lo
+        not_empty = length > 0
+        if not not_empty.any():
+            return result
+        levels = np.zeros(len(lo), dtype=np.int64)
+        levels[not_empty] = np.floor(np.log2(length[not_empty])).astype(np.int64)
+        for k in np.unique(levels[not_empty]):
+            mask = not_empty & (levels == k)
+            table = self.sparse[k]
+            result[mask] = np.minimum(table[lo[mask]], table[hi[mask] - (1 << int(k))])
+        return result
+
+    def minimum_prices(self, symbols, candle_dates, n_days:int=10) -> np.ndarray:
+        return self.minimum_prices_days(symbols, self.to_days(candle_dates), n_days)
+
+    def minimum_prices_days(self, symbols, end_days:np.ndarray, n_days:int=10) -> np.ndarray:
+        '''same as minimum_prices, dates are already converted with to_days '''
+        codes = self.encode_symbols(symbols)
+        end_days = np.asarray(end_days, dtype=np.int64)
+        lo, hi = self.window_bounds(codes, end_days - n_days, end_days)
+        return self.range_min(lo, hi)
+
+    def minimum_price(self, symbol:str, candle_date, n_days:int=10):
+        minimum = self.minimum_prices([symbol], [candle_date], n_days)[0]
+        if np.isnan(minimum):
+            return None
+        return float(minimum)
+
+    def check_batch(self, symbols, candle_dates, closes, n_days:int=10) -> np.ndarray:
+        '''windows without data compare as False, like in check() '''
+        return self.check_batch_days(symbols, self.to_days(candle_dates), closes, n_days)
+
+    def check_batch_days(self, symbols, end_days:np.ndarray, closes, n_days:int=10) -> np.ndarray:
+        minimum = self.minimum_prices_days(symbols, end_days, n_days)
+        with np.errstate(invalid='ignore'):
+            return np.asarray(closes, dtype=np.float64) > minimum
+
+    def check(self, symbol:str, candle_date, close:float, n_days:int=10):
+        minimum = self.minimum_price(symbol, candle_date, n_days)
+        if minimum is None:
+            return None
+        return close > minimum
+
+    @staticmethod
+    def share_array(array:np.ndarray):
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        shared[:] = array
+        return block, {'name': block.name, 'shape': array.shape, 'dtype': array.dtype.str}
+
+    @staticmethod
+    def attach_array(block_spec:dict):
+        block = shared_memory.SharedMemory(name=block_spec['name'])
+        array = np.ndarray(block_spec['shape'], dtype=np.dtype(block_spec['dtype']), buffer=block.buf)
+        array.flags.writeable = False
+        return block, array
+
+    def share(self) -> dict:
+        '''arrays are copied once, call release() when workers are done '''
+        spec = {
+            'symbol_codes': self.symbol_codes,
+            'min_day': self.min_day,
+            'span': self.span,
+            'stride': self.stride,
+            'arrays': {},
+            'sparse': [],
+        }
+        for name in self.ARRAYS:
+            block, block_spec = self.share_array(getattr(self, name))
+            self.shared_blocks.append(block)
+            spec['arrays'][name] = block_spec
+        for level in self.sparse:
+            block, block_spec = self.share_array(level)
+            self.shared_blocks.append(block)
+            spec['sparse'].append(block_spec)
+        self.owner = True
+        return spec
+
+    @classmethod
+    def attach(cls, spec:dict):
+        index = cls.__new__(cls)
+        index.symbol_codes = spec['symbol_codes']
+        index.min_day = spec['min_day']
+        index.span = spec['span']
+        index.stride = spec['stride']
+        index.shared_blocks = []
+        index.owner = False
+        for name, block_spec in spec['arrays'].items():
+            block, array = cls.attach_array(block_spec)
+            index.shared_blocks.append(block)
+            setattr(index, name, array)
+        index.sparse = []
+        for block_spec in spec['sparse']:
+            block, array = cls.attach_array(block_spec)
+            index.shared_blocks.append(block)
+            index.sparse.append(array)
+        return index
+
+    def release(self):
+        for block in self.shared_blocks:
+            block.close()
+            if self.owner:
+                block.unlink()
+        self.shared_blocks = []
+        self.owner = False
@@ -0,0 +1,113 @@
+import threading
+
+class SymbolRegistry:
+    '''Hashed set of symbols present in a table.
+
+    Symbols are loaded from database once, then kept up to date in place:
+    add() is called for symbols inserted by the processor itself after commit,
+    refresh() reads only rows inserted since the last load (id > last_id).
+    Ids are taken before commit, so a row that commits after a row with a bigger id
+    is never read by refresh(), confirm() checks such symbols in table on a miss.
+
+    Attributes:
+
+        db_connector:PostgresConnector
+            database connector
+
+        table_name:str
+            table to read symbols from
+
+        symbols:set
+            symbols present in table
+
+        last_id:int
+            biggest row id seen by load() or refresh()
+
+        loaded:bool
+            True after the first load from database
+
+    Methods:
+
+        load()
+            reads all symbols from table
+
+        refresh()
+            reads symbols of rows inserted since last load/refresh,
+            makes a full load if registry was never loaded
+
+        read_symbols(last_id:int)
+            reads (symbol, max id) rows, raises if the query failed,
+            so a failed read never looks like a table without symbols
+
+        add(symbols)
+            adds symbols to registry without a database call,
+            only symbols of committed rows must be added
+
+        confirm(symbols, cur)
+            checks symbols missing in registry against table with one query,
+            adds and returns the ones that are present, raises if the query failed
+    '''
+    def __init__(self, db_connector, table_name:str='bars_1'):
+        self.db_connector = db_connector
+        self.table_name = table_name
+        self.symbols = set()
+        self.last_id = 0
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def read_symbols(self, last_id:int=0) -> list:
+        '''execute() prints query errors and returns None '''
+        data = self.db_connector.read_symbols_since(self.table_name, last_id)
+        if data is None:
+            raise Exception('Can not read symbols from {}'.format(self.table_name))
+        return data
+
+    def update_from_rows(self, data) -> int:
+        '''data contains (symbol, max id) rows, returns number of new symbols '''
+        with self.lock:
+            size = len(self.symbols)
+            for symbol, max_id in data:
+                self.symbols.add(symbol)
+                if max_id is not None and max_id > self.last_id:
+                    self.last_id = max_id
+            return len(self.symbols) - size
+
+    def load(self) -> int:
+        '''loaded stays False if the read fails, the next refresh() loads again '''
+        data = self.read_symbols(0)
+        with self.lock:
+            self.symbols.clear()
+            self.last_id = 0
+        added = self.update_from_rows(data)
+        self.loaded = True
+        return added
+
+    def refresh(self) -> int:
+        if not self.loaded:
+            return self.load()
+        return self.update_from_rows(self.read_symbols(self.last_id))
+
+    def add(self, symbols):
+        with self.lock:
+            self.symbols.update(symbols)
+
+    def confirm(self, symbols, cur=None) -> set:
+        with self.lock:
+            missing = sorted(set(symbols) - self.symbols)
+        if not missing:
+            return set()
+        data = self.db_connector.read_symbols_present(missing, table_name=self.table_name, cur=cur)
+        if data is None:
+            raise Exception('Can not read symbols from {}'.format(self.table_name))
+        found = {row[0] for row in data}
+        self.add(found)
+        return found
+
+    def __contains__(self, symbol:str) -> bool:
+        return symbol in self.symbols
+
+    def __len__(self) -> int:
+        return len(self.symbols)
+
+    def __iter__(self):
+        return iter(list(self.symbols))
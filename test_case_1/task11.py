@@ -1,12 +1,19 @@
+import time
+import math
 import datetime
 
 from icecream import ic
 
 from db_connector import PostgresConnector
+from bars_engine import BarsEngine
+from task11_aggregates import Task11Aggregates
 
 class Task11:
-    def __init__(self, config_filename, config_section):
-        self.db_connector = PostgresConnector(config_filename, config_section)
+    def __init__(self, config_filename, config_section, cache_size:int=0):
+        '''cache is off by default, cached answers are dropped only when bars_1 is written
+        by this connector, so use cache_size > 0 only if no other process writes bars_1 '''
+        self.db_connector = PostgresConnector(config_filename, config_section, cache_size=cache_size)
+        self.aggregates = Task11Aggregates(self.db_connector)
 
     def query_1(self, table_name='bars_1'):
         q1 = '''
@@ -30,8 +37,8 @@ class Task11:
 
     def question_1(self, table_name='bars_1'):
         command1, command2 = self.query_1(table_name=table_name)
-        data = self.db_connector.execute(command=command1, data=None, fetch=True, executemany=False)
-        data2 = self.db_connector.execute(command=command2, data=None, fetch=True, executemany=False)
+        data = self.db_connector.execute_cached(command=command1, data=None)
+        data2 = self.db_connector.execute_cached(command=command2, data=None)
         result = len(data) / len(data2)
         ic(len(data))
         ic(data[0:20])
@@ -54,7 +61,7 @@ class Task11:
         #calculate average dollar volume
         command = self.query_2(table_name=table_name)
         ic(command)
-        data = self.db_connector.execute(command=command, data=None, fetch=True, executemany=False)
+        data = self.db_connector.execute_cached(command=command, data=None)
         ic(len(data))
         ic(data[0:20])
         ic(data[-1])
@@ -89,7 +96,7 @@ class Task11:
         #ascending order
         command = self.query_3(table_name=table_name)
         ic(command)
-        data = self.db_connector.execute(command=command, data=None, fetch=True, executemany=False)
+        data = self.db_connector.execute_cached(command=command, data=None)
         ic(len(data))
         ic(data[0:20])
         ic(data[-1])
@@ -124,7 +131,7 @@ class Task11:
         #calculate for each stock
         command = self.query_4(table_name=table_name)
         ic(command)
-        data = self.db_connector.execute(command=command, data=None, fetch=True, executemany=False)
+        data = self.db_connector.execute_cached(command=command, data=None)
         ic(len(data))
         ic(data[0:20])
         ic(data[-1])
@@ -133,11 +140,120 @@ class Task11:
             ic('Stock: ', i[0], 'AADPC: ', i[1])
 
 
+    def question_2_aggregated(self, start:str='2019-02-01', end:str='2019-03-01'):
+        '''question_2 answered from bars_1_monthly '''
+        result = self.aggregates.average_dollar_volume(start, end)
+        ic('average dollar volume in February 2019 is ', result)
+        return result
+
+    def question_3_aggregated(self, year:int=2015):
+        '''question_3 answered from bars_1_positive_volume,
+        previous bar is the previous bar of the same symbol '''
+        data = self.aggregates.positive_volume(year)
+        ic('Rank of stocks in %s by Positive Volume in ascending order' % year)
+        for i in data:
+            ic('Stock: ', i[0], 'Positive Volume: ', i[1])
+        return data
+
+    def question_4_aggregated(self):
+        '''question_4 answered from bars_1_symbol_state,
+        previous bar is the previous bar of the same symbol '''
+        data = self.aggregates.average_absolute_change()
+        ic('Average absolute daily percent change for each stock.')
+        for i in data:
+            ic('Stock: ', i[0], 'AADPC: ', i[1])
+        return data
+
+
 class TestTask11:
     def __init__(self, config_filename, config_section):
         self.db_connector = PostgresConnector(config_filename, config_section)
         self.sql_queries = Task11(config_filename, config_section)
 
+    def explain(self, command:str) -> list:
+        '''returns query plan with actual execution times '''
+        data = self.db_connector.execute(command='EXPLAIN (ANALYZE, BUFFERS) ' + command, data=None, fetch=True, executemany=False)
+        return [row[0] for row in data] if data else []
+
+    def benchmark_queries(self, repeat:int=5) -> dict:
+        '''prints query plan and returns best latency of each Task11 query '''
+        queries = {
+            'query_1': self.sql_queries.query_1()[0],
+            'query_1_symbols': self.sql_queries.query_1()[1],
+            'query_2': self.sql_queries.query_2(),
+            'query_3': self.sql_queries.query_3(),
+            'query_4': self.sql_queries.query_4(),
+        }
+        results = {}
+        for name, command in queries.items():
+            plan = self.explain(command)
+            ic(name)
+            for line in plan:
+                print(line)
+            latencies = []
+            for i in range(repeat):
+                start_time = time.time()
+                self.db_connector.execute(command=command, data=None, fetch=True, executemany=False)
+                latencies.append(time.time() - start_time)
+            results[name] = min(latencies)
+            ic(name, 'best of %s: %s seconds' % (repeat, results[name]))
+        return results
+
+    def test_schema_benchmark(self, repeat:int=5):
+        '''compares Task11 latencies before and after migrate_schema '''
+        before = self.benchmark_queries(repeat=repeat)
+        self.db_connector.migrate_schema(partition_by_year=True)
+        after = self.benchmark_queries(repeat=repeat)
+        for name in before:
+            ic(name, 'before: %s' % before[name], 'after: %s' % after[name])
+
+    def test_bars_engine(self, rel_tol:float=1e-9) -> bool:
+        '''answers Task11 questions with BarsEngine in SQL mode (by_id=True)
+        and compares results and latencies with SQL queries '''
+        start_time = time.time()
+        engine = BarsEngine.load(self.db_connector)
+        ic('BarsEngine loaded in %s seconds' % (time.time() - start_time))
+
+        def timed(func, *args, **kwargs):
+            start_time = time.time()
+            result = func(*args, **kwargs)
+            return result, time.time() - start_time
+
+        def close(a, b):
+            if a is None or b is None:
+                return a is None and b is None
+            return math.isclose(float(a), float(b), rel_tol=rel_tol, abs_tol=1e-9)
+
+        def fetch(command):
+            return self.db_connector.execute(command=command, data=None, fetch=True, executemany=False)
+
+        checks = {}
+        command1, command2 = self.sql_queries.query_1()
+        (data1, data2), sql_time = timed(lambda: (fetch(command1), fetch(command2)))
+        (symbols, ratio), engine_time = timed(engine.question_1, by_id=True)
+        checks['question_1'] = (set(symbols) == set(row[0] for row in data1)
+                                and close(ratio, len(data1) / len(data2) if data2 else None), sql_time, engine_time)
+
+        data, sql_time = timed(fetch, self.sql_queries.query_2())
+        average, engine_time = timed(engine.question_2)
+        checks['question_2'] = (close(average, data[0][0]), sql_time, engine_time)
+
+        data, sql_time = timed(fetch, self.sql_queries.query_3())
+        ranking, engine_time = timed(engine.question_3, by_id=True)
+        expected = dict(data)
+        checks['question_3'] = (len(ranking) == len(expected)
+                                and all(close(value, expected.get(symbol)) for symbol, value in ranking), sql_time, engine_time)
+
+        data, sql_time = timed(fetch, self.sql_queries.query_4())
+        ranking, engine_time = timed(engine.question_4, by_id=True)
+        expected = dict(data)
+        checks['question_4'] = (len(ranking) == len(expected)
+                                and all(close(value, expected.get(symbol)) for symbol, value in ranking), sql_time, engine_time)
+
+        for name, (ok, sql_time, engine_time) in checks.items():
+            ic(name, 'match' if ok else 'MISMATCH', 'sql: %.4f s' % sql_time, 'engine: %.4f s' % engine_time)
+        return all(ok for ok, sql_time, engine_time in checks.values())
+
     def run(self):
         #data1 = self.db_connector.read_data(table_name='bars_1')
         #data2 = self.db_connector.read_data(table_name='bars_2')
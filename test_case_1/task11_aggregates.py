@@ -0,0 +1,363 @@
+import math
+import time
+import threading
+import numpy as np
+import pandas as pd
+
+import psycopg2.extras
+from icecream import ic
+
+from db_connector import PostgresConnector
+
+class Task11Aggregates:
+    '''Summary tables of Task11 metrics, updated by every insert batch of bars_1.
+
+    bars_1_monthly:
+        month, sum of adj_close * volume and number of bars, average dollar volume
+        of a period is a sum over its months divided by the number of bars
+
+    bars_1_positive_volume:
+        symbol, year, sum of volume of bars with adj_close bigger than adj_close
+        of the previous bar of the same symbol and year
+
+    bars_1_symbol_state:
+        the last bar of every symbol (date, close, adj_close),
+        number and sum of absolute daily changes of close
+
+    Previous bar is the previous bar of the same symbol in (candle_date, id) order,
+    like BarsEngine with by_id=False. apply_batch() reads state only for symbols
+    of the batch, so an update costs O(batch) and not a scan of bars_1.
+    Batches are expected to contain bars newer than the ones already in bars_1,
+    older bars make aggregates drift, verify() finds it and rebuild() recomputes
+    all tables from bars_1.
+
+    Attributes:
+        db_connector:PostgresConnector
+            database connector
+
+        out_of_order:int
+            number of applied bars older than the last bar of their symbol
+
+    Methods:
+        create_tables(cur)
+            creates summary tables, if they did not exist they are rebuilt from bars_1,
+            returns True if tables were created
+
+        apply_batch(data:list, cur)
+            updates summary tables with inserted bars
+            (candle_date, symbol, open, high, low, close, adj_close, volume)
+
+        rebuild(cur)
+            recomputes summary tables from bars_1
+
+        verify(rel_tol:float)
+            compares summary tables with values computed from bars_1,
+            returns a dict table -> list of mismatched keys
+
+        average_dollar_volume(start:str, end:str)
+            average adj_close * volume of bars with start <= candle_date < end,
+            start and end are first days of months
+
+        positive_volume(year:int)
+            list of (symbol, positive volume) in ascending order
+
+        average_absolute_change()
+            list of (symbol, average absolute daily change) in ascending order
+    '''
+    TABLES = ['bars_1_monthly', 'bars_1_positive_volume', 'bars_1_symbol_state']
+    COLUMNS = ['candle_date', 'symbol', 'open', 'high', 'low', 'close', 'adj_close', 'volume']
+
+    def __init__(self, db_connector:PostgresConnector, table_name:str='bars_1'):
+        self.db_connector = db_connector
+        self.table_name = table_name
+        self.out_of_order = 0
+
+    def tables_sql(self) -> str:
+        return """
+        CREATE TABLE IF NOT EXISTS bars_1_monthly (
+            month DATE PRIMARY KEY,
+            dollar_volume FLOAT NOT NULL,
+            bars BIGINT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS bars_1_positive_volume (
+            symbol TEXT NOT NULL,
+            year INT NOT NULL,
+            volume FLOAT NOT NULL,
+            days BIGINT NOT NULL,
+            PRIMARY KEY (symbol, year)
+        );
+        CREATE TABLE IF NOT EXISTS bars_1_symbol_state (
+            symbol TEXT PRIMARY KEY,
+            last_date DATE NOT NULL,
+            last_close FLOAT NOT NULL,
+            last_adj_close FLOAT NOT NULL,
+            changes BIGINT NOT NULL,
+            abs_change FLOAT NOT NULL
+        );
+        """
+
+    def expected_sql(self) -> dict:
+        '''the same aggregates computed from bars_1 with window functions '''
+        return {
+            'bars_1_monthly': """
+            SELECT date_trunc('month', candle_date)::date, sum(adj_close * volume), count(*)
+            FROM {0} GROUP BY 1
+            """.format(self.table_name),
+            'bars_1_positive_volume': """
+            SELECT symbol, year, sum(volume), count(*) FROM (
+                SELECT symbol, extract(year FROM candle_date)::int AS year, volume, adj_close,
+                lag(adj_close) OVER (PARTITION BY symbol, extract(year FROM candle_date) ORDER BY candle_date, id) AS adj_close_lag
+                FROM {0}
+            ) b
+            WHERE adj_close > adj_close_lag
+            GROUP BY symbol, year
+            """.format(self.table_name),
+            'bars_1_symbol_state': """
+            SELECT symbol, max(candle_date),
+                (array_agg(close ORDER BY candle_date DESC, id DESC))[1],
+                (array_agg(adj_close ORDER BY candle_date DESC, id DESC))[1],
+                count(change), COALESCE(sum(change), 0)
+            FROM (
+                SELECT symbol, candle_date, id, close, adj_close,
+                @(close - lag(close) OVER (PARTITION BY symbol ORDER BY candle_date, id)) AS change
+                FROM {0}
+            ) b
+            GROUP BY symbol
+            """.format(self.table_name),
+        }
+
+    def create_tables(self, cur=None):
+        if cur is None:
+            with self.db_connector.transaction() as cur:
+                return self.create_tables(cur)
+        cur.execute("SELECT to_regclass('bars_1_symbol_state')")
+        if cur.fetchone()[0] is not None:
+            return False
+        '''several workers may try to create tables at the same time,
+        the first one creates them, the others see them after its commit '''
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('bars_1_aggregates'))")
+        cur.execute("SELECT to_regclass('bars_1_symbol_state')")
+        if cur.fetchone()[0] is not None:
+            return False
+        cur.execute(self.tables_sql())
+        self.rebuild(cur)
+        return True
+
+    def rebuild(self, cur=None):
+        '''runs in one transaction, concurrent batches wait for the truncate lock '''
+        if cur is None:
+            with self.db_connector.transaction() as cur:
+                return self.rebuild(cur)
+        start_time = time.time()
+        cur.execute('TRUNCATE {}'.format(', '.join(self.TABLES)))
+        for table_name, command in self.expected_sql().items():
+            cur.execute('INSERT INTO {} {}'.format(table_name, command))
+        self.out_of_order = 0
+        ic('Task11 aggregates rebuilt in %s seconds' % (time.time() - start_time))
+
+    def lock_symbols(self, symbols:list, cur):
+        '''FOR UPDATE can not lock state rows that do not exist yet, so two batches
+        with a new symbol would both miss the last bar of the other one.
+        Transaction advisory locks are taken per symbol instead, in key order,
+        so concurrent batches do not deadlock even if two symbols share a key.
+        Two-key locks do not collide with the bigint lock of create_tables() '''
+        cur.execute("""
+            SELECT pg_advisory_xact_lock(hashtext('bars_1_symbol_state'), key)
+            FROM (SELECT DISTINCT hashtext(symbol) AS key FROM unnest(%s::text[]) AS symbol ORDER BY key) keys
+            """, (symbols,))
+
+    def read_state(self, symbols:list, cur) -> dict:
+        '''symbols are locked first, state is read after other batches of them are committed '''
+        self.lock_symbols(symbols, cur)
+        cur.execute("""
+            SELECT symbol, last_date, last_close, last_adj_close FROM bars_1_symbol_state
+            WHERE symbol = ANY(%s) ORDER BY symbol FOR UPDATE
+            """, (symbols,))
+        return {row[0]: row[1:] for row in cur.fetchall()}
+
+    def apply_batch(self, data:list, cur=None):
+        if not data:
+            return
+        if cur is None:
+            with self.db_connector.transaction() as cur:
+                return self.apply_batch(data, cur)
+        if self.create_tables(cur):
+            '''new tables are built from bars_1, which already contains the batch '''
+            return
+
+        '''stable sort keeps insert order, which is id order, for bars of the same date '''
+        df = pd.DataFrame(list(data), columns=self.COLUMNS)
+        df['candle_date'] = pd.to_datetime(df['candle_date'])
+        df = df.sort_values(['symbol', 'candle_date'], kind='stable').reset_index(drop=True)
+        for name in ['close', 'adj_close', 'volume']:
+            df[name] = df[name].astype(np.float64)
+
+        symbols = sorted(df['symbol'].unique().tolist())
+        state = self.read_state(symbols, cur)
+
+        grouped = df.groupby('symbol', sort=False)
+        first = ~df['symbol'].duplicated()
+        previous = pd.DataFrame({
+            'candle_date': grouped['candle_date'].shift(1),
+            'close': grouped['close'].shift(1),
+            'adj_close': grouped['adj_close'].shift(1),
+        })
+        known = first & df['symbol'].isin(list(state))
+        if known.any():
+            rows = [state[symbol] for symbol in df.loc[known, 'symbol']]
+            previous.loc[known, 'candle_date'] = pd.to_datetime([row[0] for row in rows])
+            previous.loc[known, 'close'] = [row[1] for row in rows]
+            previous.loc[known, 'adj_close'] = [row[2] for row in rows]
+
+        older = int((df['candle_date'] < previous['candle_date']).sum())
+        if older:
+            self.out_of_order += older
+            ic('%s bars are older than the last bar of their symbol, run rebuild()' % older)
+
+        year = df['candle_date'].dt.year
+        same_year = previous['candle_date'].dt.year == year
+        positive = same_year & (df['adj_close'] > previous['adj_close'])
+        change = (df['close'] - previous['close']).abs()
+
+        monthly = (df.assign(month=df['candle_date'].dt.to_period('M').dt.to_timestamp(),
+                             dollar_volume=df['adj_close'] * df['volume'])
+                   .groupby('month').agg(dollar_volume=('dollar_volume', 'sum'), bars=('volume', 'size')))
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO bars_1_monthly (month, dollar_volume, bars) VALUES %s
+            ON CONFLICT (month) DO UPDATE SET
+                dollar_volume = bars_1_monthly.dollar_volume + EXCLUDED.dollar_volume,
+                bars = bars_1_monthly.bars + EXCLUDED.bars
+            """, [(month.date(), float(row.dollar_volume), int(row.bars)) for month, row in monthly.iterrows()])
+
+        positive_volume = (df[positive].assign(year=year[positive])
+                           .groupby(['symbol', 'year']).agg(volume=('volume', 'sum'), days=('volume', 'size')))
+        if len(positive_volume):
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO bars_1_positive_volume (symbol, year, volume, days) VALUES %s
+                ON CONFLICT (symbol, year) DO UPDATE SET
+                    volume = bars_1_positive_volume.volume + EXCLUDED.volume,
+                    days = bars_1_positive_volume.days + EXCLUDED.days
+                """, [(symbol, int(y), float(row.volume), int(row.days)) for (symbol, y), row in positive_volume.iterrows()])
+
+        last = grouped.tail(1).set_index('symbol')
+        changes = change.groupby(df['symbol']).agg(['count', 'sum'])
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO bars_1_symbol_state (symbol, last_date, last_close, last_adj_close, changes, abs_change) VALUES %s
+            ON CONFLICT (symbol) DO UPDATE SET
+                last_date = GREATEST(bars_1_symbol_state.last_date, EXCLUDED.last_date),
+                last_close = CASE WHEN EXCLUDED.last_date >= bars_1_symbol_state.last_date
+                    THEN EXCLUDED.last_close ELSE bars_1_symbol_state.last_close END,
+                last_adj_close = CASE WHEN EXCLUDED.last_date >= bars_1_symbol_state.last_date
+                    THEN EXCLUDED.last_adj_close ELSE bars_1_symbol_state.last_adj_close END,
+                changes = bars_1_symbol_state.changes + EXCLUDED.changes,
+                abs_change = bars_1_symbol_state.abs_change + EXCLUDED.abs_change
+            """, [(symbol, last.at[symbol, 'candle_date'].date(), float(last.at[symbol, 'close']),
+                   float(last.at[symbol, 'adj_close']), int(changes.at[symbol, 'count']), float(changes.at[symbol, 'sum']))
+                  for symbol in symbols])
+
+    def verify(self, rel_tol:float=1e-9) -> dict:
+        def same(a, b):
+            if isinstance(a, float) or isinstance(b, float):
+                return math.isclose(a, b, rel_tol=rel_tol, abs_tol=1e-6)
+            return a == b
+
+        self.create_tables()
+        key_sizes = {'bars_1_monthly': 1, 'bars_1_positive_volume': 2, 'bars_1_symbol_state': 1}
+        mismatches = {}
+        for table_name, command in self.expected_sql().items():
+            size = key_sizes[table_name]
+            expected = self.db_connector.execute(command, data=None, fetch=True, executemany=False) or []
+            stored = self.db_connector.execute('SELECT * FROM {}'.format(table_name), data=None, fetch=True, executemany=False) or []
+            expected = {tuple(row[:size]): row[size:] for row in expected}
+            stored = {tuple(row[:size]): row[size:] for row in stored}
+            mismatches[table_name] = sorted(key for key in set(expected) | set(stored)
+                                            if key not in expected or key not in stored
+                                            or not all(same(a, b) for a, b in zip(expected[key], stored[key])))
+        return mismatches
+
+    def average_dollar_volume(self, start:str='2019-02-01', end:str='2019-03-01'):
+        q = "SELECT sum(dollar_volume) / NULLIF(sum(bars), 0) FROM bars_1_monthly WHERE month >= %s AND month < %s"
+        data = self.db_connector.execute(q, data=(start, end), fetch=True, executemany=False)
+        return data[0][0] if data else None
+
+    def positive_volume(self, year:int=2015) -> list:
+        q = "SELECT symbol, volume FROM bars_1_positive_volume WHERE year = %s ORDER BY volume, symbol"
+        return self.db_connector.execute(q, data=(year,), fetch=True, executemany=False) or []
+
+    def average_absolute_change(self) -> list:
+        q = """SELECT symbol, abs_change / NULLIF(changes, 0) AS average FROM bars_1_symbol_state
+            ORDER BY average NULLS LAST, symbol"""
+        return self.db_connector.execute(q, data=None, fetch=True, executemany=False) or []
+
+'''a class for manual testing of Task11Aggregates '''
+class TestTask11Aggregates:
+    def __init__(self, config_filename, config_section):
+        self.db_connector = PostgresConnector(config_filename, config_section)
+        self.aggregates = Task11Aggregates(self.db_connector)
+
+    def test_verify(self) -> bool:
+        mismatches = self.aggregates.verify()
+        for table_name, keys in mismatches.items():
+            ic(table_name, len(keys), keys[:10])
+        return not any(mismatches.values())
+
+    def test_against_engine(self, rel_tol:float=1e-9) -> bool:
+        '''compares lookups with BarsEngine answers computed from the whole table '''
+        from bars_engine import BarsEngine
+
+        def close(a, b):
+            if a is None or b is None:
+                return a is None and b is None
+            return math.isclose(float(a), float(b), rel_tol=rel_tol, abs_tol=1e-9)
+
+        def same_ranking(a:list, b:list) -> bool:
+            b = dict(b)
+            return len(a) == len(b) and all(symbol in b and close(value, b[symbol]) for symbol, value in a)
+
+        engine = BarsEngine.load(self.db_connector)
+        checks = {
+            'average_dollar_volume': close(engine.question_2(), self.aggregates.average_dollar_volume()),
+            'positive_volume': same_ranking(engine.question_3(), self.aggregates.positive_volume()),
+            'average_absolute_change': same_ranking(engine.question_4(), self.aggregates.average_absolute_change()),
+        }
+        ic(checks)
+        return all(checks.values())
+
+    def test_concurrent_new_symbol(self, symbol:str='CONCURRENT_TEST') -> bool:
+        '''two transactions insert the first bars of a new symbol at the same time,
+        the second one must see the last bar of the first one, test rows are deleted after '''
+        connector = PostgresConnector(self.db_connector.config_filename, self.db_connector.config_section, pooled=True)
+        aggregates = Task11Aggregates(connector)
+        aggregates.create_tables()
+
+        def insert(day:int, delay:float, hold:float):
+            time.sleep(delay)
+            rows = [['2100-01-%02d' % day, symbol, 1, 1, 1, 10.0 * day, 10.0 * day, 100]]
+            with connector.transaction() as cur:
+                connector.insert_data_executemany(rows, 'bars_1', cur=cur)
+                aggregates.apply_batch(rows, cur=cur)
+                time.sleep(hold)
+
+        threads = [threading.Thread(target=insert, args=(1, 0, 1.0)), threading.Thread(target=insert, args=(2, 0.3, 0))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        mismatches = aggregates.verify()
+        ok = not any(key[0] == symbol for keys in mismatches.values() for key in keys)
+        ic('concurrent new symbol', ok)
+
+        connector.execute('DELETE FROM bars_1 WHERE symbol = %s', data=(symbol,), fetch=False, executemany=False)
+        aggregates.rebuild()
+        connector.close()
+        return ok
+
+    def run(self):
+        '''verify command, tables are rebuilt if they drifted '''
+        if not self.test_verify():
+            self.aggregates.rebuild()
+            self.test_verify()
+
+if __name__ == '__main__':
+    test = TestTask11Aggregates(config_filename='database.ini', config_section='postgresql')
+    test.run()
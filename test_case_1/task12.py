@@ -1,11 +1,23 @@
 import time
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
 
 from icecream import ic
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from db_connector import PostgresConnector
+from price_index import PriceIndex
+from symbol_registry import SymbolRegistry
+from task11_aggregates import Task11Aggregates
+
+'''statuses of processed trades '''
+TRADE = 0
+SYMBOL_ERROR = 1
+PRICE_ERROR = 2
+
+'''price index and known symbols of a shard worker process '''
+shard_worker_state = {}
 
 class DataProcessor:
     '''DataProcessor class reads a data batch from csv files and inserts it to database.
@@ -14,9 +26,12 @@ class DataProcessor:
         db_connector:PostgresConnector
             database connector
 
-        list_of_symbols_in_bars_1:str
-            a list of symbols present in table bars_1
-            this variable is used to decrease the number of database calls
+        symbol_registry:SymbolRegistry
+            a set of symbols present in table bars_1, loaded once
+            and refreshed incrementally, used to decrease the number of database calls
+
+        list_of_symbols_in_bars_1:set
+            symbols of symbol_registry
 
         list_of_trades:str
             a list of trades to be inserted to the database
@@ -27,19 +42,39 @@ class DataProcessor:
         bars_1_df:pd.DataFrame
             pandas dataframe that contains data from table bars_1
 
+        price_index:PriceIndex
+            per-symbol sorted close prices from bars_1_df,
+            built once per run and used for minimum price checks
+
+        aggregates:Task11Aggregates
+            summary tables of Task11 metrics, updated in the transaction
+            of every insert, None if aggregates are not maintained
+
+        executor:ProcessPoolExecutor
+            shard workers of process_batch_parallel, started once and reused
+            by following batches, None until the first parallel batch
+
+        shared_index:PriceIndex
+            price_index copied to shared memory for executor workers
+
     Methods:
         read_data(table_name:str, limit:int)
             reads data from table, number of rows is equal to limit
 
+        claim_data(table_name:str, limit:int, cur)
+            claims a batch from table: rows are deleted and returned in the
+            transaction of cur, rows claimed by other workers are skipped
+
         check_if_symbol_in_bars_1(table_name:str, symbol:str)
             method returns True if symbol is in table bars_1
 
         create_list_of_symbols(table_name:str)
-            makes a database query to recieve a list of unique symbols in bars_1,
+            loads symbols of bars_1 into symbol_registry on the first call,
+            later calls read only symbols of newly inserted rows,
             returns a list
 
         check_if_symbol_in_list(symbol:str)
-            returns True if symbol in list_of_symbols_in_bars_1
+            returns True if symbol in symbol_registry
 
         generate_error_message(trade:list, error_type:str)
             method recieves trade data and error type,
@@ -56,47 +91,113 @@ class DataProcessor:
             method checks if close price is bigger than symbol's minimum price
             over last 10 days, returns True if condition is met
 
-        insert_trades()
-            bulk insert trades to bars_1
+        build_price_index()
+            builds price_index from bars_1_df
+
+        insert_trades(cur)
+            bulk insert trades to bars_1 and updates Task11 aggregates with inserted bars,
+            run() adds their symbols to symbol_registry after commit
 
         process_data_by_rows(trade:str)
             Method checks each row of data if it meets test case conditions.
             Appends a trade either to trades_list or errors_list.
 
-        insert_errors()
+        process_batch(batch:list, n_days:int)
+            vectorized version of process_data_by_rows,
+            checks all trades of a batch in one NumPy pass
+
+        process_batch_db(batch:list, n_days:int, cur)
+            same as process_batch, minimum prices are read from bars_1
+            with one find_minimum_prices query instead of price_index,
+            raises if the query fails, no trade is classified then
+
+        append_results(batch:list, status:np.ndarray)
+            appends trades and error messages according to statuses of batch
+
+        process_batch_parallel(batch:list, processes:int, n_days:int)
+            shards batch by symbol across a process pool, workers read price_index
+            from shared memory and return per-shard price checks merged once,
+            symbols are checked in this process with symbol_registry
+
+        start_workers(processes:int)
+            shares price_index and starts the pool, only if it is not started
+            for the same price_index and number of processes yet
+
+        close_workers()
+            stops the pool and releases shared memory of price_index
+
+        close()
+            closes workers and database connections
+
+        insert_errors(cur)
             bulk insert errors to error_log
 
         delete_rows(table_name:str, limit:int)
             deletes processed rows, number of rows is equal to limit
 
-        run(self, rows:int)
-            runs the script, processes 20k rows, inserts errors and trades,
-            deletes processed trades
+        query_process_server_side()
+            returns a single SQL statement that classifies a batch of bars_2
+            as trades, symbol errors or price errors, inserts them into bars_1/error_log
+            and deletes processed rows from bars_2
+
+        run_server_side(rows:int, n_days:int)
+            processes a batch with query_process_server_side in one transaction,
+            no bars data is transferred between database and script, except
+            inserted trades when Task11 aggregates are maintained, they are
+            applied to the aggregates in the same transaction.
+            The first call creates (symbol, candle_date) indexes if they do not exist,
+            without them every trade of the batch scans bars_1 twice
+
+        run(self, rows:int, vectorized:bool, processes:int, source:str)
+            runs the script, claims 20k rows, inserts errors and trades
+            in the same transaction, so processed rows are deleted exactly once
+            and several processors can run on the same bars_2 table.
+            If source is 'db' batch is processed with process_batch_db inside
+            the claim transaction, csv is not read and price_index is not built.
+            Otherwise, if processes > 0 batch is processed with process_batch_parallel,
+            if vectorized is True batch is processed with process_batch,
+            otherwise row by row in a thread pool. Returns number of claimed rows
     '''
-    def __init__(self, config_filename:str, config_section:str):
-        self.db_connector = PostgresConnector(config_filename, config_section)
-        self.list_of_symbols_in_bars_1 = []
+    def __init__(self, config_filename:str, config_section:str, pooled:bool=True, aggregates:bool=True):
+        '''pooled connector keeps connections open between queries of a run '''
+        self.db_connector = PostgresConnector(config_filename, config_section, pooled=pooled)
+        self.aggregates = Task11Aggregates(self.db_connector) if aggregates else None
+        self.symbol_registry = SymbolRegistry(self.db_connector, table_name='bars_1')
+        self.list_of_symbols_in_bars_1 = self.symbol_registry.symbols
         self.list_of_trades = []
         self.list_of_errors = []
 
         self.bars_1_df = pd.DataFrame()
+        self.price_index = None
+
+        self.executor = None
+        self.worker_processes = 0
+        self.shared_index = None
+
+        '''set by the first run_server_side '''
+        self.indexes_created = False
 
     def read_data(self, table_name:str='bars_2', limit:int = 20000) -> list:
         return self.db_connector.read_data_limit(table_name=table_name, limit=limit)
 
+    def claim_data(self, table_name:str='bars_2', limit:int = 20000, cur=None) -> list:
+        return self.db_connector.claim_data(table_name=table_name, limit=limit, cur=cur)
+
     def check_if_symbol_in_bars_1(self, table_name:str='bars_1', symbol:str=''):
         data = self.db_connector.read_data_by_symbol(table_name=table_name, symbol=symbol)
         if data:
             return True
 
     def create_list_of_symbols(self, table_name:str='bars_1'):
-        data = self.db_connector.read_symbols_distinct(table_name=table_name)
-        #list of tuples  -> list of symbols
-        self.list_of_symbols_in_bars_1 = [x[0] for x in data]
-        return [x[0] for x in data]
+        if table_name != self.symbol_registry.table_name:
+            data = self.db_connector.read_symbols_distinct(table_name=table_name)
+            #list of tuples  -> list of symbols
+            return [x[0] for x in data]
+        self.symbol_registry.refresh()
+        return list(self.symbol_registry)
 
     def check_if_symbol_in_list(self, symbol:str):
-        if symbol in self.list_of_symbols_in_bars_1:
+        if symbol in self.symbol_registry:
             return True
 
     def generate_error_message(self, trade:list, error_type:str) -> list:
@@ -122,22 +223,21 @@ class DataProcessor:
         df = pd.DataFrame(data)
         return df
 
+    def build_price_index(self) -> PriceIndex:
+        self.price_index = PriceIndex.from_df(self.bars_1_df, date_column='Date', symbol_column='Symbol', close_column='Close')
+        return self.price_index
+
     def check_minimum_price_over_n_days(self, symbol:str, candle_date:str, close:float, n_days:int=10) -> bool:
-        self.bars_1_df['Date'] = pd.to_datetime(self.bars_1_df['Date'])
-        candle_date = pd.to_datetime(candle_date)
-        period = pd.Timedelta(n_days, "d")
-
-        res = self.bars_1_df.loc[self.bars_1_df['Symbol'] == symbol]
-        res2 = res.loc[(res['Date'] >= candle_date-period) & (res['Date'] <= candle_date)]
-        if len(res2) > 0:
-            minimum_price = res2['Close'].min()
-            if close > minimum_price:
-                return True
-            else:
-                return False
+        if self.price_index is None:
+            self.build_price_index()
+        return self.price_index.check(symbol, candle_date, close, n_days=n_days)
 
-    def insert_trades(self):
-        self.db_connector.insert_data_executemany(data=self.list_of_trades, table_name='bars_1')
+    def insert_trades(self, cur=None):
+        '''trades are bars_2 rows, id column is not inserted '''
+        data = [trade[1:9] for trade in self.list_of_trades]
+        self.db_connector.insert_data_executemany(data=data, table_name='bars_1', cur=cur)
+        if self.aggregates is not None:
+            self.aggregates.apply_batch(data, cur=cur)
 
     def process_data_by_rows(self, trade:str):
         time_spent = 0
@@ -170,40 +270,272 @@ class DataProcessor:
         ic('processed ', len(data), 'rows. OK: ', no_error, ' ERROR: ', error)
         ic(time_spent)
 
-    def insert_errors(self):
-        self.db_connector.insert_error_data_list(data=self.list_of_errors, table_name='error_log')
+    def process_batch(self, batch:list, n_days:int=10):
+        '''trade columns: id, candle_date, symbol, open, high, low, close, ... '''
+        if self.price_index is None:
+            self.build_price_index()
+        symbols = [trade[2] for trade in batch]
+        candle_dates = [trade[1] for trade in batch]
+        closes = np.array([trade[6] for trade in batch], dtype=np.float64)
+
+        symbol_ok = np.array([bool(self.check_if_symbol_in_list(symbol)) for symbol in symbols], dtype=bool)
+        price_ok = self.price_index.check_batch(symbols, candle_dates, closes, n_days=n_days)
+
+        status = np.where(symbol_ok, np.where(price_ok, TRADE, PRICE_ERROR), SYMBOL_ERROR)
+        self.append_results(batch, status)
+
+        ic('processed ', len(batch), 'rows. OK: ', len(self.list_of_trades), ' ERROR: ', len(self.list_of_errors))
+
+    def process_batch_db(self, batch:list, n_days:int=10, cur=None):
+        '''checks prices against bars_1 in database, no csv is read '''
+        symbols = [trade[2] for trade in batch]
+        probes = [(trade[2], trade[1], n_days) for trade in batch]
+        minimums = self.db_connector.find_minimum_prices(probes, table_name='bars_1', cur=cur)
+        if minimums is None:
+            '''the query failed, raising rolls back the transaction of a claimed batch '''
+            raise Exception('Can not read minimum prices of {} trades from bars_1'.format(len(batch)))
+        minimums = np.array([np.nan if minimum is None else minimum for minimum in minimums], dtype=np.float64)
+        closes = np.array([trade[6] for trade in batch], dtype=np.float64)
+
+        symbol_ok = np.array([bool(self.check_if_symbol_in_list(symbol)) for symbol in symbols], dtype=bool)
+        with np.errstate(invalid='ignore'):
+            price_ok = closes > minimums
+
+        status = np.where(symbol_ok, np.where(price_ok, TRADE, PRICE_ERROR), SYMBOL_ERROR)
+        self.append_results(batch, status)
+
+        ic('processed ', len(batch), 'rows. OK: ', len(self.list_of_trades), ' ERROR: ', len(self.list_of_errors))
+
+    def append_results(self, batch:list, status:np.ndarray):
+        '''status: TRADE, SYMBOL_ERROR or PRICE_ERROR for every trade of batch '''
+        for trade, trade_status in zip(batch, status):
+            if trade_status == TRADE:
+                self.list_of_trades.append(trade)
+            elif trade_status == SYMBOL_ERROR:
+                self.generate_error_message(trade, error_type='symbol_error')
+            else:
+                self.generate_error_message(trade, error_type='price_error')
+
+    def process_batch_parallel(self, batch:list, processes:int=4, n_days:int=10):
+        if self.price_index is None:
+            self.build_price_index()
+        symbols = np.array([trade[2] for trade in batch], dtype=object)
+        end_days = PriceIndex.to_days([trade[1] for trade in batch])
+        closes = np.array([trade[6] for trade in batch], dtype=np.float64)
+
+        '''all trades of a symbol go to the same shard '''
+        unique_symbols, symbol_codes = np.unique(symbols.astype(str), return_inverse=True)
+        shards = symbol_codes % processes
+        price_ok = np.zeros(len(batch), dtype=bool)
+
+        executor = self.start_workers(processes)
+        futures = []
+        for shard in range(processes):
+            positions = np.flatnonzero(shards == shard)
+            if len(positions) == 0:
+                continue
+            futures.append(executor.submit(check_shard, positions, symbols[positions].tolist(),
+                                           end_days[positions], closes[positions], n_days))
+        for future in futures:
+            positions, shard_price_ok = future.result()
+            price_ok[positions] = shard_price_ok
+
+        '''registry changes between batches, workers keep only price_index '''
+        symbol_ok = np.array([bool(self.check_if_symbol_in_list(symbol)) for symbol in unique_symbols], dtype=bool)[symbol_codes]
+        status = np.where(symbol_ok, np.where(price_ok, TRADE, PRICE_ERROR), SYMBOL_ERROR)
+        self.append_results(batch, status)
+        ic('processed ', len(batch), 'rows in', processes, 'processes. OK: ', len(self.list_of_trades), ' ERROR: ', len(self.list_of_errors))
+
+    def start_workers(self, processes:int=4) -> ProcessPoolExecutor:
+        '''a new price_index (or number of processes) restarts workers '''
+        if self.executor is not None and self.worker_processes == processes and self.shared_index is self.price_index:
+            return self.executor
+        self.close_workers()
+        spec = self.price_index.share()
+        self.shared_index = self.price_index
+        self.executor = ProcessPoolExecutor(max_workers=processes, initializer=init_shard_worker, initargs=(spec,))
+        self.worker_processes = processes
+        return self.executor
+
+    def close_workers(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+            self.worker_processes = 0
+        if self.shared_index is not None:
+            self.shared_index.release()
+            self.shared_index = None
+
+    def close(self):
+        self.close_workers()
+        self.db_connector.close()
+
+    def insert_errors(self, cur=None):
+        self.db_connector.insert_error_data_list(data=self.list_of_errors, table_name='error_log', cur=cur)
         ic('errors inserted to db', len(self.list_of_errors))
 
     def delete_rows(self, table_name:str='bars_2', limit:int=20000):
         self.db_connector.delete_data(table_name='bars_2', limit=20000)
 
-    def run(self, rows:int=20000):
+    def query_process_server_side(self) -> str:
+        '''parameters: limit, n_days, return_trades. Data-modifying CTEs share one snapshot,
+        so trades inserted by the batch do not affect checks of the same batch,
+        like in the python path. If return_trades is true, the fourth column
+        is a json array of inserted trades in bars_1 id order, else NULL. '''
+        q = '''
+        WITH batch AS (
+            SELECT id, candle_date, symbol, open, high, low, close, adj_close, volume
+            FROM bars_2
+            ORDER BY id
+            LIMIT %(limit)s
+            FOR UPDATE SKIP LOCKED
+        ),
+        classified AS (
+            SELECT b.*,
+                CASE
+                    WHEN NOT EXISTS (SELECT 1 FROM bars_1 s WHERE s.symbol = b.symbol) THEN 'symbol_error'
+                    WHEN b.close > m.min_close THEN 'trade'
+                    ELSE 'price_error'
+                END AS status
+            FROM batch b
+            LEFT JOIN LATERAL (
+                SELECT min(p.close) AS min_close
+                FROM bars_1 p
+                WHERE p.symbol = b.symbol
+                AND p.candle_date >= b.candle_date - %(n_days)s
+                AND p.candle_date <= b.candle_date
+            ) m ON true
+        ),
+        trades AS (
+            INSERT INTO bars_1 (candle_date, symbol, open, high, low, close, adj_close, volume)
+            SELECT candle_date, symbol, open, high, low, close, adj_close, volume
+            FROM classified
+            WHERE status = 'trade'
+            ORDER BY id
+            RETURNING id, candle_date, symbol, open, high, low, close, adj_close, volume
+        ),
+        errors AS (
+            INSERT INTO error_log (launch_timestamp, date, symbol, message)
+            SELECT extract(epoch from now()), candle_date, symbol,
+                CASE status
+                    WHEN 'symbol_error' THEN format('%%s not present in tables_bars_1 on %%s', symbol, candle_date)
+                    ELSE format('%%s close price is not bigger than the minimum over the past %%s days on %%s', symbol, %(n_days)s, candle_date)
+                END
+            FROM classified
+            WHERE status <> 'trade'
+            RETURNING 1
+        ),
+        deleted AS (
+            DELETE FROM bars_2
+            WHERE id IN (SELECT id FROM batch)
+            RETURNING 1
+        )
+
+        SELECT (SELECT count(*) FROM trades), (SELECT count(*) FROM errors), (SELECT count(*) FROM deleted),
+            CASE WHEN %(return_trades)s THEN (
+                SELECT json_agg(json_build_array(candle_date, symbol, open, high, low, close, adj_close, volume) ORDER BY id)
+                FROM trades
+            ) END
+        '''
+        return q
+
+    def run_server_side(self, rows:int=20000, n_days:int=10):
         start_time = time.time()
         print('microservice started at ', start_time)
-        #read bars_1 once at script start
-        data = self.read_data_csv('bars_1_shuffled.csv')
-        self.bars_1_df = self.create_df(data)
+        if not self.indexes_created:
+            '''EXISTS and LATERAL subqueries of the statement are index lookups '''
+            self.db_connector.create_indexes()
+            self.indexes_created = True
+        q = self.query_process_server_side()
+        parameters = {'limit': rows, 'n_days': n_days, 'return_trades': self.aggregates is not None}
+        with self.db_connector.transaction() as cur:
+            data = self.db_connector.execute(q, data=parameters, fetch=True, cur=cur)
+            '''aggregates are updated with inserted trades before the batch commits '''
+            inserted = data[0][3]
+            if self.aggregates is not None and inserted:
+                self.aggregates.apply_batch([tuple(trade) for trade in inserted], cur=cur)
+            '''the statement writes with raw execute(), so cached reads of its tables are dropped here '''
+            self.db_connector.invalidate(('bars_1', 'bars_2', 'error_log'), cur=cur)
+        data = [row[:3] for row in data]
+        if data:
+            trades, errors, deleted = data[0]
+            ic('processed ', deleted, 'rows. OK: ', trades, ' ERROR: ', errors)
+            if deleted == 0:
+                trade = [None, None, None]
+                error = self.generate_error_message(trade, error_type='no_data_error')
+                #error_log requires date and symbol, so this error is only logged
+                self.list_of_errors = []
+                ic(error[3])
+        ic(time.time() - start_time)
+        return data
 
-        #create once per run, append symbols to it if new symbol
+    def run(self, rows:int=20000, vectorized:bool=True, processes:int=0, source:str='csv'):
+        if source not in ('csv', 'db'):
+            raise Exception('Unknown source {}, use csv or db'.format(source))
+        start_time = time.time()
+        print('microservice started at ', start_time)
+        #read bars_1 once at script start, workers of process_batch_parallel reuse the same price_index
+        if source == 'csv' and self.price_index is None:
+            data = self.read_data_csv('bars_1_shuffled.csv')
+            self.bars_1_df = self.create_df(data)
+            self.build_price_index()
+
+        #load once, then read only symbols of rows inserted since last run
         self.create_list_of_symbols(table_name='bars_1')
         #clean lists of trades and errors
         self.list_of_trades = []
         self.list_of_errors = []
 
-        batch = self.read_data(table_name='bars_2', limit=rows)
-        if len(batch) > 0:
-            with ThreadPoolExecutor() as executor:
-                executor.map(self.process_data_by_rows, batch)
-        else:
-            trade = [None, None, None]
-            self.generate_error_message(trade, error_type='no_data_error')
+        with self.db_connector.transaction() as cur:
+            batch = self.claim_data(table_name='bars_2', limit=rows, cur=cur)
+            #symbols missing in registry are checked in bars_1 before they are reported as errors
+            self.symbol_registry.confirm([trade[2] for trade in batch], cur=cur)
+            if len(batch) > 0 and source == 'db':
+                self.process_batch_db(batch, cur=cur)
+            elif len(batch) > 0 and processes > 0:
+                self.process_batch_parallel(batch, processes=processes)
+            elif len(batch) > 0 and vectorized:
+                self.process_batch(batch)
+            elif len(batch) > 0:
+                with ThreadPoolExecutor() as executor:
+                    executor.map(self.process_data_by_rows, batch)
+            else:
+                trade = [None, None, None]
+                error = self.generate_error_message(trade, error_type='no_data_error')
+                #error_log requires date and symbol, so this error is only logged
+                self.list_of_errors = []
+                ic(error[3])
+
+            self.insert_errors(cur=cur)
+            self.insert_trades(cur=cur)
+
+        #a rolled back batch must not leave its symbols in registry
+        self.symbol_registry.add(trade[2] for trade in self.list_of_trades)
+        ic(self.db_connector.pool_stats())
+        ic(time.time() - start_time)
+        return len(batch)
 
-        self.insert_errors()
-        self.insert_trades()
 
-        self.delete_rows(table_name='bars_2', limit=rows)
+def init_shard_worker(spec:dict):
+    '''runs once per worker process, shared memory stays attached for the life of the pool '''
+    shard_worker_state['price_index'] = PriceIndex.attach(spec)
 
-        ic(time.time() - start_time)
+def check_shard(positions:np.ndarray, symbols:list, end_days:np.ndarray, closes:np.ndarray, n_days:int=10):
+    '''runs in a worker process, returns positions and price checks of shard trades '''
+    price_index = shard_worker_state['price_index']
+    return positions, price_index.check_batch_days(symbols, end_days, closes, n_days=n_days)
+
+def run_worker(config_filename:str, config_section:str, rows:int=20000) -> int:
+    '''processes batches until bars_2 is empty, returns number of processed rows '''
+    processor = DataProcessor(config_filename, config_section)
+    processed = 0
+    while True:
+        claimed = processor.run(rows=rows)
+        if claimed == 0:
+            break
+        processed += claimed
+    processor.close()
+    return processed
 
 
 class TestDataProcessor:
@@ -243,6 +575,86 @@ class TestDataProcessor:
 
     def test_run(self):
         self.data_processor.run(rows=20000)
+        self.data_processor.db_connector.close()
+
+    def test_run_db(self):
+        self.data_processor.run(rows=20000, source='db')
+
+    def test_run_server_side(self):
+        self.data_processor.run_server_side(rows=20000)
+
+    def test_benchmark_server_side(self, rows=20000):
+        '''python and server-side modes consume two consecutive batches of bars_2 '''
+        start_time = time.time()
+        self.data_processor.run(rows=rows)
+        python_time = time.time() - start_time
+        start_time = time.time()
+        self.data_processor.run_server_side(rows=rows)
+        server_time = time.time() - start_time
+        ic('python path: %s seconds' % (python_time))
+        ic('server-side path: %s seconds' % (server_time))
+
+    def test_multi_worker(self, n_workers=4, rows=1000):
+        '''runs n_workers processors in separate processes on the same bars_2,
+        every row must be claimed exactly once '''
+        db_connector = self.data_processor.db_connector
+        total = db_connector.execute('select count(*) from bars_2', fetch=True)[0][0]
+        start_time = time.time()
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(run_worker, db_connector.config_filename, db_connector.config_section, rows)
+                       for _ in range(n_workers)]
+            processed = [future.result() for future in futures]
+        time_spent = time.time() - start_time
+        ic('rows per worker', processed)
+        ic('processed %s of %s rows in %s seconds' % (sum(processed), total, time_spent))
+        ic('%d rows/sec' % (sum(processed) / time_spent if time_spent > 0 else 0))
+        ic('exactly once', sum(processed) == total)
+
+    def test_benchmark_parallel(self, rows=20000, processes=(1, 2, 4, 8)):
+        '''processes the same batch with process_batch and process_batch_parallel,
+        nothing is written to database '''
+        data = self.data_processor.read_data_csv('bars_1_shuffled.csv')
+        self.data_processor.bars_1_df = self.data_processor.create_df(data)
+        self.data_processor.build_price_index()
+        self.data_processor.create_list_of_symbols(table_name='bars_1')
+        batch = self.data_processor.read_data(table_name='bars_2', limit=rows)
+
+        self.data_processor.list_of_trades = []
+        self.data_processor.list_of_errors = []
+        start_time = time.time()
+        self.data_processor.process_batch(batch)
+        ic('process_batch: %s seconds' % (time.time() - start_time))
+        for n in processes:
+            '''the first batch starts workers and shares price_index, the next ones reuse them '''
+            for batch_number in range(3):
+                self.data_processor.list_of_trades = []
+                self.data_processor.list_of_errors = []
+                start_time = time.time()
+                self.data_processor.process_batch_parallel(batch, processes=n)
+                ic('process_batch_parallel, %s processes, batch %s: %s seconds' % (n, batch_number, time.time() - start_time))
+        self.data_processor.close_workers()
+
+    def test_process_batch_db(self, rows=20000):
+        '''checks the same batch with bars_1 from database and from price_index,
+        statuses differ only if csv and bars_1 table differ, nothing is written to database '''
+        self.data_processor.create_list_of_symbols(table_name='bars_1')
+        batch = self.data_processor.read_data(table_name='bars_2', limit=rows)
+
+        self.data_processor.list_of_trades = []
+        self.data_processor.list_of_errors = []
+        start_time = time.time()
+        self.data_processor.process_batch_db(batch)
+        ic('process_batch_db: %s seconds' % (time.time() - start_time))
+        db_trades = [trade[0] for trade in self.data_processor.list_of_trades]
+
+        data = self.data_processor.read_data_csv('bars_1_shuffled.csv')
+        self.data_processor.bars_1_df = self.data_processor.create_df(data)
+        self.data_processor.build_price_index()
+        self.data_processor.list_of_trades = []
+        self.data_processor.list_of_errors = []
+        self.data_processor.process_batch(batch)
+        ic('same trades', db_trades == [trade[0] for trade in self.data_processor.list_of_trades])
+        ic(self.data_processor.db_connector.statement_stats())
 
     def run(self):
         #1 - read 20k rows
@@ -1,9 +1,21 @@
+import numpy as np
 import pandas as pd
+import json
 import unittest
+import asyncio
 import time
+from collections import OrderedDict
 
 from events import Event, InfoEvent, TradeEvent, ErrorEvent
 
+def time_scale(first:float, unit:str=None) -> float:
+    '''seconds in one unit of numeric timestamps (s, ms, us, ns),
+    if unit is None it is guessed from the magnitude of epoch time '''
+    if unit is None:
+        first = abs(first)
+        unit = 'ns' if first > 1e17 else 'us' if first > 1e14 else 'ms' if first > 1e11 else 's'
+    return {'s': 1.0, 'ms': 1e-3, 'us': 1e-6, 'ns': 1e-9}[unit]
+
 class DataStream:
     '''this class takes parquet data as input
     checks all conditions described in test case 1.2
@@ -14,11 +26,57 @@ class DataStream:
             sample data from parquet file
         last_timestamp: str
             timestamp of the last trade sent by server to clients
+        group_timestamps: np.ndarray
+            unique timestamps in order of first appearance in data
+        group_offsets: np.ndarray
+            group g consists of rows group_rows[group_offsets[g]:group_offsets[g + 1]]
+        group_rows: np.ndarray
+            row positions of data ordered by group, None if data is already
+            grouped (each timestamp occupies a contiguous block of rows)
+        columns: dict
+            column name -> np.ndarray, datetime columns are converted to epoch
+            milliseconds like in pandas to_json
+        symbol_column: str
+            name of column with trade symbol, used by symbol filters
+        symbol_rows: dict
+            symbol -> sorted row positions of its trades, empty if data has no symbol column
+        filter_masks: OrderedDict
+            sorted tuple of symbols -> boolean mask of rows, filters are chosen by clients,
+            so only filter_cache_size recently used masks are kept
+        filter_cache_size: int
+            maximum number of cached filter masks
+        seekable: bool
+            True, any group can be read again by its number, used to resume clients
 
     Methods:
         to_json(data:pd.DataFrame)
             using built-in pandas func, converts pandas dataframe to json
 
+        build_groups()
+            groups trades by timestamp once at load time
+
+        select_group(n_group:int)
+            returns all trades of group n_group, O(group size)
+
+        build_symbol_index()
+            builds symbol_rows once at load time
+
+        filter_mask(symbols:tuple)
+            returns boolean mask of rows of symbols, least recently used
+            masks are dropped above filter_cache_size
+
+        records(n_group:int, symbols:tuple)
+            returns trades of group n_group as a list of dicts,
+            built directly from column arrays,
+            if symbols is given only trades of these symbols are returned
+
+        group_times(unit:str)
+            returns time of every group in seconds since the first group,
+            used to pace a replay
+
+        group_time(n_group:int)
+            returns time of group n_group in seconds since the first group
+
         select_stacked_timestamps(row:pd.DataFrame)
             selects all trade with the same timestamp
             to send them simultaneously
@@ -27,16 +85,111 @@ class DataStream:
             a func to ensure correct time order of trades,
             returns True if trade's timestamp is bigger then last_trade's timestamp
 
-        run(n_element:int)
+        run(n_group:int)
             a procedure to perform all required actions on data
-            recieves the number of element to read data from dataframe
-            produces TradeEvent to send it to websocket client
+            recieves the number of timestamp group to read data from dataframe
+            produces TradeEvent with a list of trade records to send it to websocket client
             produces ErrorEvent after all data is sent
     '''
-    def __init__(self, filename:str='trades_sample.parquet'):
-        self.data = pd.read_parquet(filename)
+    seekable = True
+
+    def __init__(self, filename:str='trades_sample.parquet', data:pd.DataFrame=None, symbol_column:str='symbol',
+                 filter_cache_size:int=32):
+        self.data = pd.read_parquet(filename) if data is None else data
         '''last_timestamp is required to ensure timestamp order '''
         self.last_timestamp = self.data['timestamp'].iloc[0]
+        self.symbol_column = symbol_column
+        self.filter_cache_size = filter_cache_size
+        self.times = None
+        self.build_groups()
+        self.build_columns()
+        self.build_symbol_index()
+
+    def build_groups(self):
+        '''factorize keeps order of first appearance, so groups are emitted
+        in the same order as a row by row walk would emit them '''
+        codes, uniques = pd.factorize(self.data['timestamp'], sort=False)
+        self.group_timestamps = np.asarray(uniques)
+        self.group_index = pd.Index(uniques)
+        counts = np.bincount(codes, minlength=len(uniques))
+        self.group_offsets = np.concatenate(([0], np.cumsum(counts)))
+        if np.all(np.diff(codes) >= 0):
+            self.group_rows = None
+        else:
+            self.group_rows = np.argsort(codes, kind='stable')
+
+    def build_columns(self):
+        self.columns = {}
+        for name in self.data.columns:
+            column = self.data[name]
+            if pd.api.types.is_datetime64_any_dtype(column):
+                column = column.astype('datetime64[ms]').astype(np.int64)
+            self.columns[name] = column.to_numpy()
+
+    def build_symbol_index(self):
+        self.symbol_rows = {}
+        self.filter_masks = OrderedDict()
+        if self.symbol_column not in self.data.columns:
+            return
+        codes, uniques = pd.factorize(self.data[self.symbol_column], sort=False)
+        valid = np.flatnonzero(codes >= 0)
+        order = valid[np.argsort(codes[valid], kind='stable')]
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(codes[valid], minlength=len(uniques)))))
+        for code, symbol in enumerate(uniques.tolist()):
+            self.symbol_rows[symbol] = order[offsets[code]:offsets[code + 1]]
+
+    def filter_mask(self, symbols:tuple) -> np.ndarray:
+        if symbols in self.filter_masks:
+            self.filter_masks.move_to_end(symbols)
+            return self.filter_masks[symbols]
+        mask = np.zeros(len(self.data), dtype=bool)
+        for symbol in symbols:
+            rows = self.symbol_rows.get(symbol)
+            if rows is not None:
+                mask[rows] = True
+        self.filter_masks[symbols] = mask
+        if len(self.filter_masks) > self.filter_cache_size:
+            self.filter_masks.popitem(last=False)
+        return mask
+
+    def group_positions(self, n_group:int, symbols:tuple=None):
+        start = self.group_offsets[n_group]
+        end = self.group_offsets[n_group + 1]
+        if self.group_rows is None:
+            positions = slice(start, end)
+        else:
+            positions = self.group_rows[start:end]
+        if symbols is None:
+            return positions
+        mask = self.filter_mask(symbols)
+        if isinstance(positions, slice):
+            return start + np.flatnonzero(mask[positions])
+        return positions[mask[positions]]
+
+    def records(self, n_group:int, symbols:tuple=None) -> list:
+        positions = self.group_positions(n_group, symbols)
+        names = list(self.columns)
+        values = [self.columns[name][positions].tolist() for name in names]
+        return [dict(zip(names, row)) for row in zip(*values)]
+
+    def group_times(self, unit:str=None) -> np.ndarray:
+        '''datetime timestamps are converted directly, numeric timestamps use unit
+        (s, ms, us, ns), if unit is None it is guessed from the magnitude of epoch time '''
+        timestamps = self.group_index
+        if len(timestamps) == 0:
+            return np.array([], dtype=np.float64)
+        if isinstance(timestamps, pd.DatetimeIndex):
+            return np.asarray((timestamps - timestamps[0]).total_seconds(), dtype=np.float64)
+        values = np.asarray(timestamps, dtype=np.float64)
+        return (values - values[0]) * time_scale(values[0], unit)
+
+    def group_time(self, n_group:int) -> float:
+        if self.times is None:
+            self.times = self.group_times()
+        return float(self.times[n_group])
+
+    def select_group(self, n_group:int) -> pd.DataFrame:
+        return self.data.iloc[self.group_positions(n_group)]
 
     def to_json(self, data:pd.DataFrame):
         out = data.to_json(orient='records')[1:-1]
@@ -48,8 +201,7 @@ class DataStream:
     def select_stacked_timestamps(self, row:pd.DataFrame):
         '''a func to select ALL trades with same timestamp
         to ensure simultanious send'''
-        df = self.data[self.data['timestamp'] == row.timestamp]
-        return df
+        return self.select_group(self.group_index.get_loc(row.timestamp))
 
     def check_timestamp_order(self, row:pd.DataFrame) -> bool:
         '''1 dont send trades with timestamp older than last sent timestamp
@@ -58,14 +210,14 @@ class DataStream:
         if row.timestamp.iloc[0] > self.last_timestamp:
             return True
 
-    async def run(self, n_element:int) -> Event:
+    async def run(self, n_group:int) -> Event:
+        if n_group >= len(self.group_timestamps):
+            return ErrorEvent('Data stream finished, no more rows in data.')
         try:
-            row = self.data.iloc[n_element]
-            row = self.select_stacked_timestamps(row)
-            if self.check_timestamp_order(row):
-                trades_data = self.to_json(row)
-                self.last_timestamp = row.timestamp.iloc[0]
-                return TradeEvent(trades_data)
+            timestamp = self.group_timestamps[n_group]
+            if timestamp > self.last_timestamp:
+                self.last_timestamp = timestamp
+                return TradeEvent(self.records(n_group), group=n_group, seq=n_group)
             else:
                 pass
 
@@ -89,5 +241,109 @@ class TestDataStream(unittest.TestCase):
         self.datastream.last_timestamp = time.time() - 123
         self.assertTrue(self.datastream.check_timestamp_order(row))
 
+class TestTimestampGroups(unittest.TestCase):
+    '''groups must reproduce the row by row walk over the dataframe '''
+
+    def setUp(self):
+        self.data = pd.DataFrame({
+            'timestamp': [1, 1, 2, 3, 3, 3, 2, 5, 4, 6],
+            'price': [10, 11, 12, 13, 14, 15, 16, 17, 18, 19],
+        })
+
+    def walk(self, datastream):
+        events = []
+        n_group = 0
+        while True:
+            event = asyncio.run(datastream.run(n_group))
+            n_group += 1
+            if event is None:
+                continue
+            if event.type == 'ErrorEvent':
+                return events
+            events.append(event.data)
+
+    def test_unsorted_groups(self):
+        datastream = DataStream(data=self.data)
+        self.assertIsNotNone(datastream.group_rows)
+        events = self.walk(datastream)
+        expected = [
+            json.loads(self.data[self.data['timestamp'] == 2].to_json(orient='records')),
+            json.loads(self.data[self.data['timestamp'] == 3].to_json(orient='records')),
+            json.loads(self.data[self.data['timestamp'] == 5].to_json(orient='records')),
+            json.loads(self.data[self.data['timestamp'] == 6].to_json(orient='records')),
+        ]
+        self.assertEqual(events, expected)
+
+    def test_sorted_groups(self):
+        data = self.data.sort_values('timestamp', kind='stable').reset_index(drop=True)
+        datastream = DataStream(data=data)
+        self.assertIsNone(datastream.group_rows)
+        self.assertEqual(len(self.walk(datastream)), 5)
+
+    def test_datetime_records(self):
+        data = pd.DataFrame({'timestamp': pd.to_datetime([1, 2, 2], unit='s'), 'price': [1.0, 2.0, 3.0]})
+        datastream = DataStream(data=data)
+        self.assertEqual(datastream.records(1), json.loads(data.iloc[1:].to_json(orient='records')))
+
+    def test_group_times(self):
+        data = pd.DataFrame({'timestamp': [1600000000000, 1600000000500, 1600000002000], 'price': [1, 2, 3]})
+        self.assertEqual(list(DataStream(data=data).group_times()), [0.0, 0.5, 2.0])
+        data['timestamp'] = pd.to_datetime(data['timestamp'], unit='ms')
+        self.assertEqual(list(DataStream(data=data).group_times()), [0.0, 0.5, 2.0])
+
+    def test_symbol_filter(self):
+        data = self.data.assign(symbol=['A', 'B', 'A', 'B', 'C', 'A', 'C', 'A', 'B', 'C'])
+        datastream = DataStream(data=data)
+        self.assertEqual([trade['price'] for trade in datastream.records(2, ('A', 'C'))], [14, 15])
+        self.assertEqual([trade['price'] for trade in datastream.records(1, ('C',))], [16])
+        self.assertEqual(datastream.records(1, ('X',)), [])
+
+    def test_filter_cache_size(self):
+        data = self.data.assign(symbol=['A', 'B', 'A', 'B', 'C', 'A', 'C', 'A', 'B', 'C'])
+        datastream = DataStream(data=data, filter_cache_size=2)
+        for symbols in [('A',), ('B',), ('A',), ('C',)]:
+            datastream.filter_mask(symbols)
+        self.assertEqual(list(datastream.filter_masks), [('A',), ('C',)])
+        self.assertEqual([trade['price'] for trade in datastream.records(2, ('B',))], [13])
+
+    def test_select_stacked_timestamps(self):
+        datastream = DataStream(data=self.data)
+        df = datastream.select_stacked_timestamps(self.data.iloc[2])
+        self.assertEqual(list(df['price']), [12, 16])
+
+async def stream_all(datastream:DataStream) -> int:
+    n_group = 0
+    n_events = 0
+    while True:
+        event = await datastream.run(n_group)
+        n_group += 1
+        if event is None:
+            continue
+        if event.type == 'ErrorEvent':
+            return n_events
+        n_events += 1
+
+def benchmark(n_rows:int=2000000, trades_per_timestamp:int=3, prefix:int=2000):
+    '''streams n_rows through timestamp groups and compares it to the
+    row by row walk with a full scan per row, which is O(N^2) and
+    therefore measured on a prefix of rows and extrapolated '''
+    n_timestamps = n_rows // trades_per_timestamp
+    data = pd.DataFrame({
+        'timestamp': np.repeat(np.arange(n_timestamps, dtype=np.int64), trades_per_timestamp),
+        'price': np.random.random(n_timestamps * trades_per_timestamp),
+    })
+    start_time = time.time()
+    datastream = DataStream(data=data)
+    n_events = asyncio.run(stream_all(datastream))
+    grouped_time = time.time() - start_time
+
+    start_time = time.time()
+    for n_element in range(prefix):
+        row = data.iloc[n_element]
+        data[data['timestamp'] == row.timestamp]
+    row_time = (time.time() - start_time) / prefix * len(data)
+    print('grouped stream of %s rows, %s events: %.2f seconds' % (len(data), n_events, grouped_time))
+    print('row by row walk, extrapolated: %.2f seconds' % (row_time))
+
 if __name__ == '__main__':
     unittest.main()
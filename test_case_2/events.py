@@ -21,10 +21,17 @@ class InfoEvent(Event):
         self.data = message
 
 class TradeEvent(Event):
-    def __init__(self, trades:list):
+    '''group is a key to cache encoded trades, data streams set it to
+    the number of timestamp group, WSServer to (channel, group number)
+    because serializers are shared by channels,
+    seq is a position of the group in channel stream, sent to clients
+    and used by them as a resume token '''
+    def __init__(self, trades:list, group:int=None, seq:int=None):
         self.type = 'TradeEvent'
         self.timestamp = time.time()
         self.data = trades
+        self.group = group
+        self.seq = seq
 
 class ErrorEvent(Event):
     def __init__(self, message:str):
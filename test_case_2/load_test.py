@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import asyncio
+import tempfile
+import platform
+import numpy as np
+import pandas as pd
+import websockets
+
+from multiprocessing import Process, Pool
+
+from websocket_client import WSClient
+from websocket_server import WSServer
+from serialization import JSON
+
+class LoadClient(WSClient):
+    '''WSClient that records messages instead of printing them.
+
+    Latency of a message is receive time - event timestamp, both are time.time()
+    of the same machine, so server and clients must run locally.
+    WSServer sets the timestamp right before broadcast, after the pacing wait
+    of speed, so latency is queueing + serialization + network time only.
+    LoadTest starts the stream only after all clients are subscribed,
+    so every client can receive every event.
+    Events replayed to resumed clients keep their original timestamp,
+    LoadClient does not resume.
+
+    Attributes:
+        messages:int
+            number of received messages
+
+        trades:int
+            number of received trades
+
+        bytes:int
+            size of received messages
+
+        latencies:list
+            end-to-end latency of every trade message, seconds
+
+        first_receive, last_receive:float
+            time of the first and the last received message
+
+    Methods:
+        connect(url:str, channel:str, duration:float)
+            receives messages until the stream is finished or duration is over
+
+        read_response(response)
+            decodes a message and updates counters
+    '''
+    def __init__(self, host:str, port:str, channel:str, encoding:str=JSON, symbols:list=None):
+        super().__init__(host, port, channel, encoding, symbols)
+        self.messages = 0
+        self.trades = 0
+        self.bytes = 0
+        self.latencies = []
+        self.first_receive = None
+        self.last_receive = None
+
+    async def connect(self, url:str, channel:str, duration:float=60, retries:int=50):
+        for attempt in range(retries):
+            try:
+                websocket = await websockets.connect(url, max_size=None)
+                break
+            except OSError:
+                '''server is still starting '''
+                await asyncio.sleep(0.1)
+        else:
+            raise ConnectionError('Can not connect to {}'.format(url))
+
+        deadline = time.time() + duration
+        try:
+            await websocket.send(self.build_subscription(channel, self.symbols))
+            while time.time() < deadline:
+                try:
+                    response = await asyncio.wait_for(websocket.recv(), deadline - time.time())
+                except (asyncio.TimeoutError, websockets.ConnectionClosed):
+                    break
+                if self.read_response(response)['type'] == 'ErrorEvent':
+                    break
+        finally:
+            await websocket.close()
+
+    def read_response(self, response) -> dict:
+        receive_time = time.time()
+        self.bytes += len(response)
+        if isinstance(response, str):
+            message = json.loads(response)
+        else:
+            message = self.serializer.decode(response)
+        self.messages += 1
+        if self.first_receive is None:
+            self.first_receive = receive_time
+        self.last_receive = receive_time
+        if message['type'] == 'TradeEvent':
+            self.trades += len(message['data'])
+            self.latencies.append(receive_time - message['timestamp'])
+        return message
+
+    def results(self) -> dict:
+        return {
+            'messages': self.messages,
+            'trades': self.trades,
+            'bytes': self.bytes,
+            'latencies': self.latencies,
+            'first_receive': self.first_receive,
+            'last_receive': self.last_receive,
+        }
+
+def run_clients(host:str, port:int, channel:str, n_clients:int, encoding:str, duration:float) -> list:
+    '''runs n_clients in one asyncio loop, used in worker processes '''
+    clients = [LoadClient(host, port, channel, encoding) for i in range(n_clients)]
+    url = clients[0].build_url(host, port, encoding)
+
+    async def main():
+        await asyncio.gather(*[client.connect(url, channel, duration) for client in clients])
+
+    asyncio.run(main())
+    return [client.results() for client in clients]
+
+def run_server(host:str, port:int, filename:str, delay:float, speed:float, policy:str, max_queue:int,
+               start_clients:int=1):
+    server = WSServer(host=host, port=port, delay=delay, filename=filename, speed=speed,
+                      slow_consumer_policy=policy, max_queue=max_queue, start_clients=start_clients)
+    server.run()
+
+class LoadTest:
+    '''Load and latency benchmark of the websocket pipeline.
+
+    Starts WSServer in a separate process, connects n_clients LoadClients
+    spread across processes (one asyncio loop per process), server starts the stream
+    when all of them are subscribed, and writes a json report
+    with throughput and end-to-end latency percentiles, so results of
+    different versions can be compared.
+
+    Attributes:
+        filename:str
+            parquet file streamed by server, a synthetic file is generated if None
+
+        n_clients:int
+            number of simulated clients
+
+        processes:int
+            number of client processes, 0 runs all clients in this process
+
+        encoding:str
+            json or msgpack
+
+        duration:float
+            maximum time of the test in seconds, clients stop earlier when the stream is finished
+
+        report_filename:str
+            json report is written here
+
+    Methods:
+        make_sample(filename:str, n_rows:int)
+            writes a synthetic trades file
+
+        run()
+            runs server and clients, returns and writes report
+
+        build_report(results:list, started:float)
+            aggregates results of all clients
+    '''
+    def __init__(self, filename:str=None, n_clients:int=10, processes:int=0, encoding:str=JSON,
+                 duration:float=30, host:str='localhost', port:int=8765, delay:float=0, speed:float=None,
+                 policy:str='drop_oldest', max_queue:int=1000, n_rows:int=100000,
+                 report_filename:str='load_test_report.json'):
+        self.filename = filename
+        self.n_clients = n_clients
+        self.processes = processes
+        self.encoding = encoding
+        self.duration = duration
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self.speed = speed
+        self.policy = policy
+        self.max_queue = max_queue
+        self.n_rows = n_rows
+        self.report_filename = report_filename
+
+    @staticmethod
+    def make_sample(filename:str, n_rows:int=100000):
+        pd.DataFrame({
+            'timestamp': pd.to_datetime(1600000000000 + np.arange(n_rows) // 3, unit='ms'),
+            'symbol': np.random.choice(['BTC-USD', 'ETH-USD', 'SOL-USD'], n_rows),
+            'price': np.random.random(n_rows) * 100,
+            'amount': np.random.random(n_rows),
+            'side': np.random.choice(['buy', 'sell'], n_rows),
+        }).to_parquet(filename)
+
+    def run(self) -> dict:
+        directory = None
+        filename = self.filename
+        if filename is None:
+            directory = tempfile.mkdtemp()
+            filename = os.path.join(directory, 'trades.parquet')
+            self.make_sample(filename, self.n_rows)
+
+        server = Process(target=run_server, args=(self.host, self.port, filename, self.delay, self.speed,
+                                                  self.policy, self.max_queue, self.n_clients), daemon=True)
+        server.start()
+        started = time.time()
+        try:
+            if self.processes:
+                shares = [len(part) for part in np.array_split(np.arange(self.n_clients), self.processes)]
+                with Pool(self.processes) as pool:
+                    parts = pool.starmap(run_clients, [(self.host, self.port, 'sample', share, self.encoding, self.duration)
+                                                       for share in shares if share])
+                results = [result for part in parts for result in part]
+            else:
+                results = run_clients(self.host, self.port, 'sample', self.n_clients, self.encoding, self.duration)
+        finally:
+            server.terminate()
+            server.join()
+            if directory is not None:
+                os.remove(filename)
+                os.rmdir(directory)
+
+        report = self.build_report(results, started)
+        with open(self.report_filename, 'w') as f:
+            json.dump(report, f, indent=2)
+        return report
+
+    def build_report(self, results:list, started:float) -> dict:
+        latencies = np.array([latency for result in results for latency in result['latencies']]) * 1000
+        first = [result['first_receive'] for result in results if result['first_receive'] is not None]
+        last = [result['last_receive'] for result in results if result['last_receive'] is not None]
+        elapsed = max(last) - min(first) if first else 0.0
+        messages = sum(result['messages'] for result in results)
+        received_bytes = sum(result['bytes'] for result in results)
+
+        report = {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'config': {
+                'filename': self.filename,
+                'n_rows': self.n_rows if self.filename is None else None,
+                'n_clients': self.n_clients,
+                'processes': self.processes,
+                'encoding': self.encoding,
+                'delay': self.delay,
+                'speed': self.speed,
+                'policy': self.policy,
+                'max_queue': self.max_queue,
+            },
+            'wall_time_s': time.time() - started,
+            'receive_time_s': elapsed,
+            'messages': messages,
+            'trades': sum(result['trades'] for result in results),
+            'bytes': received_bytes,
+            'messages_per_s': messages / elapsed if elapsed else None,
+            'bytes_per_s': received_bytes / elapsed if elapsed else None,
+            'clients_min_messages': min(result['messages'] for result in results) if results else 0,
+            'clients_max_messages': max(result['messages'] for result in results) if results else 0,
+            'latency_ms': {},
+        }
+        if len(latencies):
+            report['latency_ms'] = {
+                'mean': float(latencies.mean()),
+                'p50': float(np.percentile(latencies, 50)),
+                'p90': float(np.percentile(latencies, 90)),
+                'p99': float(np.percentile(latencies, 99)),
+                'max': float(latencies.max()),
+            }
+        return report
+
+if __name__ == '__main__':
+    load_test = LoadTest(n_clients=100, processes=4)
+    print(json.dumps(load_test.run(), indent=2))
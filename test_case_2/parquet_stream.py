@@ -0,0 +1,245 @@
+import os
+import asyncio
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from concurrent.futures import ThreadPoolExecutor
+
+from events import Event, TradeEvent, ErrorEvent
+from datastream import time_scale
+
+class ParquetStream:
+    '''Streaming version of DataStream for big parquet files.
+
+    The file is memory-mapped and read row group by row group,
+    a background thread reads the next row group while the current one is sent,
+    so startup time and memory do not depend on the size of the file.
+
+    Trades are grouped by consecutive equal timestamps. A group that reaches
+    the end of a row group may continue in the next one, so the last group
+    of every row group is carried over and joined with the next row group
+    before it is sent. The file is expected to be sorted by timestamp,
+    out of order trades are dropped by the timestamp check like in DataStream.
+
+    Groups are read in order only, run() and records() accept the current
+    group or the following ones.
+
+    Attributes:
+        file:pq.ParquetFile
+            memory-mapped parquet file
+
+        last_timestamp:
+            timestamp of the last trade sent by server to clients
+
+        chunk:dict
+            column name -> np.ndarray of rows that are read and not sent yet,
+            datetime columns are converted to epoch milliseconds like in DataStream
+
+        chunk_keys:np.ndarray
+            raw timestamps of chunk rows, used for grouping and ordering
+
+        chunk_starts:np.ndarray
+            group g of chunk consists of rows chunk_starts[g]:chunk_starts[g + 1]
+
+        first_group:int
+            global number of the first group of chunk
+
+        complete_groups:int
+            number of groups of chunk that can not continue in the next row group
+
+        seekable:bool
+            False, sent groups are dropped from memory, so resumed clients
+            are served only from replay buffer of the server
+
+    Methods:
+        read_row_group(index:int)
+            reads row group into numpy columns, called in background thread
+
+        load_next_chunk()
+            joins carried over group with the next row group and starts reading the one after
+
+        locate(n_group:int)
+            returns rows of group in chunk, None after the end of file
+
+        in_chunk(n_group:int)
+            True if group is read and not dropped yet, records() of it reads no file
+
+        records(n_group:int, symbols:tuple)
+            returns trades of group n_group as a list of dicts
+
+        group_time(n_group:int)
+            returns time of group in seconds since the first group
+
+        run(n_group:int)
+            produces TradeEvent or ErrorEvent, like DataStream.run
+
+        close()
+            stops background reader
+    '''
+    seekable = False
+
+    def __init__(self, filename:str='trades_sample.parquet', symbol_column:str='symbol', time_unit:str=None):
+        self.file = pq.ParquetFile(filename, memory_map=True)
+        self.symbol_column = symbol_column
+        self.time_unit = time_unit
+        self.datetime_keys = pa.types.is_timestamp(self.file.schema_arrow.field('timestamp').type)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.next_row_group = 0
+        self.pending = None
+        self.prefetch()
+
+        self.chunk = {}
+        self.chunk_keys = np.array([], dtype=np.int64)
+        self.chunk_starts = np.array([0], dtype=np.int64)
+        self.first_group = 0
+        self.complete_groups = 0
+        self.exhausted = False
+
+        self.last_timestamp = None
+        self.first_time = None
+        self.scale = None
+
+    def prefetch(self):
+        if self.next_row_group < self.file.num_row_groups:
+            self.pending = self.executor.submit(self.read_row_group, self.next_row_group)
+            self.next_row_group += 1
+        else:
+            self.pending = None
+
+    def read_row_group(self, index:int):
+        table = self.file.read_row_group(index)
+        columns = {}
+        keys = None
+        for name in table.column_names:
+            column = table.column(name)
+            if pa.types.is_timestamp(column.type):
+                values = column.to_numpy().astype('datetime64[ns]').astype(np.int64)
+                columns[name] = values // 1000000
+            else:
+                values = column.to_numpy()
+                columns[name] = values
+            if name == 'timestamp':
+                keys = values
+        return columns, keys
+
+    def load_next_chunk(self):
+        start = self.chunk_starts[self.complete_groups]
+        columns = {name: values[start:] for name, values in self.chunk.items()}
+        keys = self.chunk_keys[start:]
+        self.first_group += self.complete_groups
+
+        if self.pending is None:
+            self.exhausted = True
+        else:
+            new_columns, new_keys = self.pending.result()
+            self.prefetch()
+            if not columns:
+                columns = new_columns
+                keys = new_keys
+            else:
+                columns = {name: np.concatenate((values, new_columns[name])) for name, values in columns.items()}
+                keys = np.concatenate((keys, new_keys))
+
+        self.chunk = columns
+        self.chunk_keys = keys
+        changes = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+        self.chunk_starts = np.concatenate(([0], changes, [len(keys)])).astype(np.int64)
+        if len(keys) == 0:
+            self.complete_groups = 0
+        elif self.exhausted:
+            self.complete_groups = len(self.chunk_starts) - 1
+        else:
+            '''the last group may continue in the next row group '''
+            self.complete_groups = len(self.chunk_starts) - 2
+
+        if self.last_timestamp is None and len(keys):
+            self.last_timestamp = keys[0]
+            self.first_time = keys[0]
+
+    def locate(self, n_group:int):
+        if n_group < self.first_group:
+            raise ValueError('ParquetStream reads groups in order, group {} is already dropped'.format(n_group))
+        while n_group >= self.first_group + self.complete_groups:
+            if self.exhausted:
+                return None
+            self.load_next_chunk()
+        group = n_group - self.first_group
+        return self.chunk_starts[group], self.chunk_starts[group + 1]
+
+    def in_chunk(self, n_group:int) -> bool:
+        return self.first_group <= n_group < self.first_group + self.complete_groups
+
+    def records(self, n_group:int, symbols:tuple=None) -> list:
+        start, end = self.locate(n_group)
+        positions = slice(start, end)
+        if symbols is not None:
+            if self.symbol_column not in self.chunk:
+                return []
+            positions = start + np.flatnonzero(np.isin(self.chunk[self.symbol_column][positions], symbols))
+        names = list(self.chunk)
+        values = [self.chunk[name][positions].tolist() for name in names]
+        return [dict(zip(names, row)) for row in zip(*values)]
+
+    def group_time(self, n_group:int) -> float:
+        start, end = self.locate(n_group)
+        key = self.chunk_keys[start]
+        if self.datetime_keys:
+            '''datetime keys are epoch nanoseconds '''
+            return float(key - self.first_time) / 1e9
+        if self.scale is None:
+            self.scale = time_scale(self.first_time, self.time_unit)
+        return float(key - self.first_time) * self.scale
+
+    async def run(self, n_group:int) -> Event:
+        '''waits for the background reader without blocking the event loop '''
+        while n_group >= self.first_group + self.complete_groups and self.pending is not None:
+            await asyncio.wrap_future(self.pending)
+            self.load_next_chunk()
+        bounds = self.locate(n_group)
+        if bounds is None:
+            return ErrorEvent('Data stream finished, no more rows in data.')
+        timestamp = self.chunk_keys[bounds[0]]
+        if timestamp > self.last_timestamp:
+            self.last_timestamp = timestamp
+            return TradeEvent(self.records(n_group), group=n_group, seq=n_group)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+def benchmark(sizes:list=[100000, 1000000, 5000000], row_group_size:int=100000):
+    '''time to first event and to a full walk of DataStream and ParquetStream '''
+    import resource
+    from datastream import DataStream
+
+    directory = tempfile.mkdtemp()
+    for size in sizes:
+        filename = os.path.join(directory, 'trades_{}.parquet'.format(size))
+        pd.DataFrame({
+            'timestamp': pd.to_datetime(np.arange(size) // 3, unit='ms'),
+            'symbol': np.random.choice(['BTC-USD', 'ETH-USD'], size),
+            'price': np.random.random(size),
+            'amount': np.random.random(size),
+        }).to_parquet(filename, row_group_size=row_group_size)
+
+        for name, stream_class in (('ParquetStream', ParquetStream), ('DataStream', DataStream)):
+            start_time = time.perf_counter()
+            stream = stream_class(filename=filename)
+            n_group = 0
+            event = None
+            while event is None:
+                event = asyncio.run(stream.run(n_group))
+                n_group += 1
+            print('%s %d rows: first event in %.3f s, max rss %d MB' % (
+                name, size, time.perf_counter() - start_time,
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024))
+            if isinstance(stream, ParquetStream):
+                stream.close()
+        os.remove(filename)
+    os.rmdir(directory)
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,82 @@
+import time
+import asyncio
+import numpy as np
+
+from collections import deque
+
+class ReplayScheduler:
+    '''Paces a replay by gaps between trade timestamps.
+
+    Every event has a target time on the monotonic clock:
+    replay start + (event time - first event time) / speed.
+    Targets are computed from the start of the replay and not from the previous
+    sleep, so oversleeping on one event is corrected on the next ones
+    and long replays do not accumulate lag.
+
+    Attributes:
+        speed:float
+            replay speed multiplier, 1 is real time, 10 is 10x faster,
+            None (or 0, inf) replays as fast as possible
+
+        jitter:deque
+            lateness of recent events in seconds, actual send time - target time
+
+        late_threshold:float
+            events later than this (seconds) are counted as late
+
+    Methods:
+        start(event_time:float)
+            starts the replay clock at the first event time
+
+        wait(event_time:float)
+            sleeps until the target time of an event
+
+        stats()
+            returns jitter statistics: mean, p50, p99, max lateness in milliseconds
+    '''
+    def __init__(self, speed:float=1.0, max_samples:int=10000, late_threshold:float=0.01):
+        if speed is not None and (speed <= 0 or np.isinf(speed)):
+            speed = None
+        self.speed = speed
+        self.late_threshold = late_threshold
+        self.jitter = deque(maxlen=max_samples)
+        self.start_clock = None
+        self.start_event_time = None
+        self.events = 0
+        self.late = 0
+
+    def start(self, event_time:float):
+        self.start_clock = time.monotonic()
+        self.start_event_time = event_time
+
+    def target(self, event_time:float) -> float:
+        return self.start_clock + (event_time - self.start_event_time) / self.speed
+
+    async def wait(self, event_time:float):
+        if self.speed is None:
+            return
+        if self.start_clock is None:
+            self.start(event_time)
+        target = self.target(event_time)
+        delay = target - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        lateness = time.monotonic() - target
+        self.jitter.append(lateness)
+        self.events += 1
+        if lateness > self.late_threshold:
+            self.late += 1
+
+    def stats(self) -> dict:
+        if not self.jitter:
+            return {'speed': self.speed, 'events': self.events, 'late': self.late}
+        jitter = np.array(self.jitter) * 1000
+        return {
+            'speed': self.speed,
+            'events': self.events,
+            'late': self.late,
+            'mean_ms': float(jitter.mean()),
+            'p50_ms': float(np.percentile(jitter, 50)),
+            'p99_ms': float(np.percentile(jitter, 99)),
+            'max_ms': float(jitter.max()),
+        }
@@ -0,0 +1,168 @@
+import json
+import time
+
+from collections import OrderedDict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from events import Event
+
+'''Serialization of events sent to websocket clients.
+
+Every message is encoded once, trade data is a list of records
+and is not encoded as a json string inside json.
+
+Encodings:
+
+    json - text frames, orjson is used if installed, standard json otherwise.
+
+    msgpack - binary frames with the same structure, requires msgpack.
+    Clients choose it with a query parameter: ws://host:port/?encoding=msgpack
+'''
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+def available_encodings() -> list:
+    encodings = [JSON]
+    if msgpack is not None:
+        encodings.append(MSGPACK)
+    return encodings
+
+class Serializer:
+    '''Encodes events in one encoding.
+
+    Trade data of a timestamp group does not change between clients or repeated
+    sends, so encoded data is cached per group (event.group) and only
+    a small envelope with type and timestamp is encoded for every message.
+
+    Attributes:
+        encoding:str
+            json or msgpack
+
+        cache_size:int
+            maximum number of cached encoded trade batches
+
+        hits, misses:int
+            cache statistics
+
+    Methods:
+        encode_data(data)
+            encodes event data, returns str for json and bytes for msgpack
+
+        encode(event:Event)
+            encodes a whole message: type, timestamp, data
+            and seq of trade events that have it
+
+        decode(message)
+            decodes a message back to a dict
+
+        decode_batch(messages:list)
+            decodes a list of messages with one decoder call
+    '''
+    def __init__(self, encoding:str=JSON, cache_size:int=10000):
+        if encoding not in available_encodings():
+            raise ValueError('Encoding {} is not available, available encodings: {}'.format(encoding, available_encodings()))
+        self.encoding = encoding
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def encode_data(self, data):
+        if self.encoding == MSGPACK:
+            return msgpack.packb(data, use_bin_type=True)
+        if orjson is not None:
+            return orjson.dumps(data).decode('utf-8')
+        return json.dumps(data, separators=(',', ':'))
+
+    def cached_data(self, event:Event):
+        key = getattr(event, 'group', None)
+        if key is None:
+            return self.encode_data(event.data)
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.misses += 1
+        encoded = self.encode_data(event.data)
+        self.cache[key] = encoded
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return encoded
+
+    def encode(self, event:Event):
+        data = self.cached_data(event)
+        seq = getattr(event, 'seq', None)
+        if self.encoding == MSGPACK:
+            '''a map of 3 or 4 items followed by packed keys and values '''
+            if seq is None:
+                header = b'\x83'
+            else:
+                header = b'\x84' + msgpack.packb('seq') + msgpack.packb(seq)
+            return (header + msgpack.packb('type') + msgpack.packb(event.type)
+                    + msgpack.packb('timestamp') + msgpack.packb(event.timestamp)
+                    + msgpack.packb('data') + data)
+        if seq is None:
+            return '{{"type":{},"timestamp":{},"data":{}}}'.format(json.dumps(event.type), json.dumps(event.timestamp), data)
+        return '{{"seq":{},"type":{},"timestamp":{},"data":{}}}'.format(seq, json.dumps(event.type), json.dumps(event.timestamp), data)
+
+    def decode(self, message) -> dict:
+        if self.encoding == MSGPACK:
+            return msgpack.unpackb(message, raw=False)
+        return json.loads(message)
+
+    def decode_batch(self, messages:list) -> list:
+        '''json messages are joined into one json array,
+        msgpack messages are fed into one streaming unpacker '''
+        if self.encoding == MSGPACK:
+            unpacker = msgpack.Unpacker(raw=False, max_buffer_size=0)
+            for message in messages:
+                unpacker.feed(message)
+            return list(unpacker)
+        batch = '[' + ','.join(messages) + ']'
+        if orjson is not None:
+            return orjson.loads(batch)
+        return json.loads(batch)
+
+def benchmark(n_events:int=10000, trades_per_event:int=5):
+    '''per-event encode latency of the old double json encoding and of each Serializer encoding '''
+    import numpy as np
+    import pandas as pd
+    from events import TradeEvent
+
+    data = pd.DataFrame({
+        'timestamp': np.repeat(np.arange(n_events, dtype=np.int64), trades_per_event),
+        'price': np.random.random(n_events * trades_per_event),
+        'amount': np.random.random(n_events * trades_per_event),
+        'side': np.random.choice(['buy', 'sell'], n_events * trades_per_event),
+    })
+    groups = [data.iloc[i * trades_per_event:(i + 1) * trades_per_event] for i in range(n_events)]
+
+    start_time = time.perf_counter()
+    for group in groups:
+        event = TradeEvent(group.to_json(orient='records')[1:-1])
+        json.dumps({'type': event.type, 'timestamp': event.timestamp, 'data': event.data})
+    print('to_json + json.dumps: %.1f us/event' % ((time.perf_counter() - start_time) / n_events * 1e6))
+
+    columns = {name: data[name].to_numpy() for name in data.columns}
+    names = list(columns)
+    for encoding in available_encodings():
+        serializer = Serializer(encoding)
+        start_time = time.perf_counter()
+        for i in range(n_events):
+            start, end = i * trades_per_event, (i + 1) * trades_per_event
+            values = [columns[name][start:end].tolist() for name in names]
+            event = TradeEvent([dict(zip(names, row)) for row in zip(*values)])
+            serializer.encode(event)
+        print('%s: %.1f us/event' % (encoding, (time.perf_counter() - start_time) / n_events * 1e6))
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,94 @@
+import asyncio
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+'''Sinks receive decoded trade batches from WSClient.consume.
+
+Every sink has two coroutines:
+
+    write(trades:list) - takes a batch of trade records (dicts).
+
+    close() - called once when the stream is finished.
+'''
+class CallbackSink:
+    '''calls a function or a coroutine function with every batch '''
+    def __init__(self, callback):
+        self.callback = callback
+
+    async def write(self, trades:list):
+        result = self.callback(trades)
+        if asyncio.iscoroutine(result):
+            await result
+
+    async def close(self):
+        pass
+
+class QueueSink:
+    '''puts batches into an asyncio queue, None is put after the last batch '''
+    def __init__(self, queue:asyncio.Queue=None):
+        self.queue = asyncio.Queue() if queue is None else queue
+
+    async def write(self, trades:list):
+        await self.queue.put(trades)
+
+    async def close(self):
+        await self.queue.put(None)
+
+class ColumnarSink:
+    '''Collects trades into columns.
+
+    If filename is set, columns are written to a parquet file
+    every flush_rows trades, one row group per flush, otherwise all trades
+    stay in memory and are returned by to_frame().
+
+    Attributes:
+        filename:str
+            parquet file to write, None keeps trades in memory
+
+        flush_rows:int
+            number of buffered trades that triggers a write
+
+        columns:dict
+            column name -> list of values of buffered trades
+
+        rows:int
+            number of trades received by sink
+    '''
+    def __init__(self, filename:str=None, flush_rows:int=100000):
+        self.filename = filename
+        self.flush_rows = flush_rows
+        self.columns = {}
+        self.buffered = 0
+        self.rows = 0
+        self.writer = None
+
+    async def write(self, trades:list):
+        if not self.columns:
+            self.columns = {name: [] for name in trades[0]}
+        for name, values in self.columns.items():
+            values.extend([trade.get(name) for trade in trades])
+        self.buffered += len(trades)
+        self.rows += len(trades)
+        if self.filename is not None and self.buffered >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.buffered:
+            return
+        table = pa.Table.from_pydict(self.columns)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.filename, table.schema)
+        self.writer.write_table(table)
+        self.columns = {name: [] for name in self.columns}
+        self.buffered = 0
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.columns)
+
+    async def close(self):
+        if self.filename is not None:
+            self.flush()
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
@@ -0,0 +1,170 @@
+import time
+import asyncio
+
+from collections import deque
+
+from events import Event, TradeEvent
+
+'''slow consumer policies:
+
+    drop_oldest - when queue is full, the oldest message is dropped.
+
+    coalesce - when queue is full, a new trade batch is merged into the last
+    queued trade batch, so the client receives all trades in fewer messages.
+
+    disconnect - client is disconnected when queue is full
+    or the oldest queued message is older than max_lag seconds.
+'''
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+
+class QueuedMessage:
+    def __init__(self, message:str, event:Event):
+        self.message = message
+        self.event = event
+        self.enqueued = time.monotonic()
+
+class Subscriber:
+    '''Bounded outbound queue of a single websocket client.
+
+    Producer puts messages without waiting, a separate writer task
+    sends them to the client, so a slow client only fills its own queue
+    and never blocks the stream for other clients.
+
+    Attributes:
+        websocket:
+            client connection
+
+        max_queue:int
+            maximum number of queued messages
+
+        policy:str
+            what to do when the client can not keep up: drop_oldest, coalesce or disconnect
+
+        max_lag:float
+            seconds, used by disconnect policy
+
+        build_message:callable
+            serializes an Event, used to re-encode coalesced trade batches
+
+        encoding:str
+            encoding of messages requested by the client, json or msgpack
+
+        sent, dropped, coalesced:int
+            message counters
+
+        lag:float
+            time spent in queue by the last sent message, seconds
+
+    Methods:
+        put(message:str, event:Event)
+            enqueues a message according to policy, never waits
+
+        writer()
+            sends queued messages to the client until it is closed
+
+        start()
+            starts writer task
+
+        close()
+            stops writer task
+
+        metrics()
+            returns a dict with lag and queue depth of the client
+    '''
+    def __init__(self, websocket, build_message, max_queue:int=1000, policy:str=DROP_OLDEST, max_lag:float=5.0,
+                 encoding:str='json'):
+        self.websocket = websocket
+        self.build_message = build_message
+        self.encoding = encoding
+        self.max_queue = max_queue
+        self.policy = policy
+        self.max_lag = max_lag
+
+        self.queue = deque()
+        self.ready = asyncio.Event()
+        self.task = None
+        self.closed = False
+
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.lag = 0.0
+
+    def current_lag(self) -> float:
+        '''age of the oldest queued message '''
+        if not self.queue:
+            return 0.0
+        return time.monotonic() - self.queue[0].enqueued
+
+    def put(self, message:str, event:Event):
+        if self.closed:
+            return
+
+        if self.policy == DISCONNECT:
+            if len(self.queue) >= self.max_queue or self.current_lag() > self.max_lag:
+                self.disconnect()
+                return
+
+        elif len(self.queue) >= self.max_queue:
+            last = self.queue[-1]
+            if self.policy == COALESCE and event.type == 'TradeEvent' and last.event.type == 'TradeEvent':
+                merged = self.merge_trades(last.event, event)
+                last.event = merged
+                last.message = self.build_message(merged)
+                self.coalesced += 1
+                return
+            self.queue.popleft()
+            self.dropped += 1
+
+        self.queue.append(QueuedMessage(message, event))
+        self.ready.set()
+
+    def merge_trades(self, first:TradeEvent, second:TradeEvent) -> TradeEvent:
+        '''trade batches are lists of records '''
+        merged = TradeEvent(first.data + second.data, seq=second.seq)
+        merged.timestamp = second.timestamp
+        return merged
+
+    def disconnect(self):
+        self.closed = True
+        self.queue.clear()
+        asyncio.ensure_future(self.websocket.close(code=4008, reason='slow consumer'))
+
+    async def writer(self):
+        while not self.closed:
+            if not self.queue:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+            item = self.queue.popleft()
+            self.lag = time.monotonic() - item.enqueued
+            try:
+                await self.websocket.send(item.message)
+            except Exception:
+                self.closed = True
+                break
+            self.sent += 1
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.writer())
+
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        self.ready.set()
+        if self.task is not None:
+            self.task.cancel()
+
+    def metrics(self) -> dict:
+        return {
+            'queue_depth': len(self.queue),
+            'lag': self.current_lag(),
+            'last_send_lag': self.lag,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'policy': self.policy,
+            'closed': self.closed,
+        }
@@ -1,6 +1,23 @@
+import os
+import json
+import time
+import tempfile
 import unittest
+import asyncio
+
+import numpy as np
+import pandas as pd
 
 from websocket_client import WSClient
+from events import TradeEvent, InfoEvent, ErrorEvent
+from subscriber import Subscriber, DROP_OLDEST, COALESCE, DISCONNECT
+from serialization import Serializer, JSON, MSGPACK, available_encodings
+from replay import ReplayScheduler
+from datastream import DataStream
+from parquet_stream import ParquetStream
+from load_test import LoadClient, LoadTest
+from websocket_server import WSServer
+from sinks import ColumnarSink, QueueSink
 
 class TestWSClient(unittest.TestCase):
     '''some basic unit tests for WSClient class '''
@@ -13,5 +30,413 @@ class TestWSClient(unittest.TestCase):
         b = 'ws://localhost:8000'
         self.assertEqual(a, b)
 
+    def test_build_subscription(self):
+        self.assertEqual(self.client.build_subscription('sample'), 'sample')
+        message = self.client.build_subscription('sample', ['ETH-USD', 'BTC-USD'])
+        self.assertEqual(json.loads(message), {'channel': 'sample', 'symbols': ['ETH-USD', 'BTC-USD']})
+        message = self.client.build_subscription('sample', since=10)
+        self.assertEqual(json.loads(message), {'channel': 'sample', 'since': 10})
+
+    def test_handle_batch_resume(self):
+        serializer = Serializer(JSON)
+        sink = QueueSink()
+        messages = [serializer.encode(TradeEvent([{'timestamp': t, 'price': t}])) for t in [1, 2, 3]]
+        asyncio.run(self.client.handle_batch(messages[:2], sink))
+        self.assertEqual(self.client.last_timestamp, 2)
+
+        '''after reconnect the server may send trades again '''
+        self.client.resuming = True
+        finished = asyncio.run(self.client.handle_batch(messages + [serializer.encode(ErrorEvent('end'))], sink))
+        self.assertTrue(finished)
+        self.assertEqual(sink.queue.get_nowait(), [{'timestamp': 1, 'price': 1}, {'timestamp': 2, 'price': 2}])
+        self.assertEqual(sink.queue.get_nowait(), [{'timestamp': 3, 'price': 3}])
+        self.assertEqual(self.client.stats['trades'], 3)
+
+    def test_columnar_sink(self):
+        filename = os.path.join(tempfile.mkdtemp(), 'consumed.parquet')
+        sink = ColumnarSink(filename=filename, flush_rows=2)
+        for t in range(5):
+            asyncio.run(sink.write([{'timestamp': t, 'price': t * 1.5}]))
+        asyncio.run(sink.close())
+        data = pd.read_parquet(filename)
+        self.assertEqual(data['timestamp'].tolist(), [0, 1, 2, 3, 4])
+        os.remove(filename)
+        os.rmdir(os.path.dirname(filename))
+
+class SlowWebsocket:
+    '''collects sent messages, never fails '''
+    def __init__(self):
+        self.messages = []
+        self.close_code = None
+
+    async def send(self, message):
+        self.messages.append(message)
+
+    async def close(self, code=1000, reason=''):
+        self.close_code = code
+
+class DelayedWebsocket(SlowWebsocket):
+    '''collects sent messages, every send takes delay seconds '''
+    def __init__(self, delay:float=0.01):
+        super().__init__()
+        self.delay = delay
+
+    async def send(self, message):
+        await asyncio.sleep(self.delay)
+        self.messages.append(message)
+
+class ParquetTestCase(unittest.TestCase):
+    '''test case with a temporary directory for parquet files, removed after every test '''
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write_parquet(self, data:pd.DataFrame, name:str='trades.parquet', row_group_size:int=None) -> str:
+        filename = os.path.join(self.directory, name)
+        data.to_parquet(filename, row_group_size=row_group_size)
+        return filename
+
+class TestSubscriber(unittest.TestCase):
+    '''slow consumer policies of Subscriber, writer task is not started,
+    so queued messages are never sent '''
+
+    def put_trades(self, subscriber, n):
+        for i in range(n):
+            event = TradeEvent([{'trade': i}])
+            subscriber.put(json.dumps(event.data), event)
+
+    def test_drop_oldest(self):
+        async def check():
+            subscriber = Subscriber(SlowWebsocket(), lambda event: json.dumps(event.data), max_queue=3, policy=DROP_OLDEST)
+            self.put_trades(subscriber, 5)
+            self.assertEqual([item.message for item in subscriber.queue], ['[{"trade": 2}]', '[{"trade": 3}]', '[{"trade": 4}]'])
+            self.assertEqual(subscriber.metrics()['dropped'], 2)
+            self.assertEqual(subscriber.metrics()['queue_depth'], 3)
+        asyncio.run(check())
+
+    def test_coalesce(self):
+        async def check():
+            subscriber = Subscriber(SlowWebsocket(), lambda event: json.dumps(event.data), max_queue=2, policy=COALESCE)
+            self.put_trades(subscriber, 4)
+            self.assertEqual([item.message for item in subscriber.queue], ['[{"trade": 0}]', '[{"trade": 1}, {"trade": 2}, {"trade": 3}]'])
+            self.assertEqual(subscriber.metrics()['coalesced'], 2)
+            self.assertEqual(subscriber.metrics()['dropped'], 0)
+        asyncio.run(check())
+
+    def test_disconnect(self):
+        async def check():
+            websocket = SlowWebsocket()
+            subscriber = Subscriber(websocket, lambda event: json.dumps(event.data), max_queue=2, policy=DISCONNECT)
+            self.put_trades(subscriber, 3)
+            await asyncio.sleep(0)
+            self.assertTrue(subscriber.closed)
+            self.assertEqual(websocket.close_code, 4008)
+        asyncio.run(check())
+
+    def test_writer(self):
+        async def check():
+            websocket = SlowWebsocket()
+            subscriber = Subscriber(websocket, lambda event: json.dumps(event.data), max_queue=10)
+            subscriber.start()
+            self.put_trades(subscriber, 3)
+            await asyncio.sleep(0.01)
+            subscriber.close()
+            self.assertEqual(len(websocket.messages), 3)
+            self.assertEqual(subscriber.metrics()['sent'], 3)
+        asyncio.run(check())
+
+class TestSerializer(unittest.TestCase):
+    '''each encoding must decode back to the same message '''
+
+    def check_roundtrip(self, encoding):
+        serializer = Serializer(encoding)
+        event = TradeEvent([{'timestamp': 1, 'price': 1.5, 'side': 'buy'}], group=0)
+        message = serializer.decode(serializer.encode(event))
+        self.assertEqual(message, {'type': 'TradeEvent', 'timestamp': event.timestamp, 'data': event.data})
+
+    def test_json(self):
+        self.check_roundtrip(JSON)
+
+    def test_msgpack(self):
+        if MSGPACK not in available_encodings():
+            self.skipTest('msgpack is not installed')
+        self.check_roundtrip(MSGPACK)
+
+    def test_cache(self):
+        serializer = Serializer(JSON)
+        serializer.encode(TradeEvent([{'price': 1}], group=7))
+        serializer.encode(TradeEvent([{'price': 1}], group=7))
+        self.assertEqual((serializer.hits, serializer.misses), (1, 1))
+
+    def test_decode_batch(self):
+        for encoding in available_encodings():
+            serializer = Serializer(encoding)
+            events = [TradeEvent([{'price': i}], group=i) for i in range(3)]
+            messages = serializer.decode_batch([serializer.encode(event) for event in events])
+            self.assertEqual([message['data'] for message in messages], [event.data for event in events])
+
+class TestReplayScheduler(unittest.TestCase):
+
+    def test_paced(self):
+        async def replay():
+            scheduler = ReplayScheduler(speed=20)
+            start_time = time.monotonic()
+            for event_time in [0, 0.5, 1, 2]:
+                await scheduler.wait(event_time)
+            return time.monotonic() - start_time, scheduler.stats()
+        elapsed, stats = asyncio.run(replay())
+        self.assertGreaterEqual(elapsed, 0.1)
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(stats['events'], 4)
+
+    def test_max_speed(self):
+        async def replay():
+            scheduler = ReplayScheduler(speed=None)
+            start_time = time.monotonic()
+            for event_time in [0, 100, 200]:
+                await scheduler.wait(event_time)
+            return time.monotonic() - start_time
+        self.assertLess(asyncio.run(replay()), 0.1)
+
+class TestPacedTimestamps(ParquetTestCase):
+    '''with speed set, event timestamp is the broadcast time, not the time
+    the event was read before the pacing wait '''
+
+    def setUp(self):
+        super().setUp()
+        self.filename = self.write_parquet(pd.DataFrame({
+            'timestamp': pd.to_datetime(np.arange(4) * 100, unit='ms'),
+            'price': np.arange(4, dtype=np.float64),
+        }))
+
+    def test_timestamp_after_wait(self):
+        received = []
+
+        class Recorder:
+            encoding = JSON
+
+            def put(self, message, event):
+                received.append((time.time(), event))
+
+        async def stream():
+            server = WSServer(filename=self.filename, speed=1)
+            server.subscribers['sample'][None].add(Recorder())
+            await server.data_stream_logic('sample')
+
+        asyncio.run(stream())
+        trades = [(put_time, event) for put_time, event in received if event.type == 'TradeEvent']
+        self.assertEqual(len(trades), 3)
+        for put_time, event in trades:
+            self.assertLess(put_time - event.timestamp, 0.05)
+
+class TestParquetStream(ParquetTestCase):
+    '''ParquetStream must produce the same events as DataStream,
+    row groups are small so timestamp groups cross row group boundaries '''
+
+    def setUp(self):
+        super().setUp()
+        timestamps = np.repeat(np.arange(40), np.arange(40) % 4 + 1)
+        self.filename = self.write_parquet(pd.DataFrame({
+            'timestamp': pd.to_datetime(timestamps, unit='s'),
+            'symbol': np.where(np.arange(len(timestamps)) % 3 == 0, 'A', 'B'),
+            'price': np.arange(len(timestamps), dtype=np.float64),
+        }), row_group_size=7)
+
+    def walk(self, stream, symbols=None):
+        events = []
+        n_group = 0
+        while True:
+            event = asyncio.run(stream.run(n_group))
+            if event is not None:
+                if event.type == 'ErrorEvent':
+                    return events
+                events.append((stream.group_time(n_group), stream.records(n_group, symbols)))
+            n_group += 1
+
+    def test_same_events(self):
+        stream = ParquetStream(filename=self.filename)
+        self.assertEqual(self.walk(stream), self.walk(DataStream(filename=self.filename)))
+        stream.close()
+
+    def test_symbol_filter(self):
+        stream = ParquetStream(filename=self.filename)
+        self.assertEqual(self.walk(stream, ('A',)), self.walk(DataStream(filename=self.filename), ('A',)))
+        stream.close()
+
+class TestLoadTest(unittest.TestCase):
+    '''counters of LoadClient and aggregation of the report, no server is started '''
+
+    def test_build_report(self):
+        serializer = Serializer(JSON)
+        clients = [LoadClient(host='localhost', port=8000, channel='sample') for i in range(2)]
+        for client in clients:
+            for i in range(3):
+                event = TradeEvent([{'price': i}, {'price': i + 1}])
+                client.read_response(serializer.encode(event))
+        report = LoadTest().build_report([client.results() for client in clients], time.time())
+        self.assertEqual(report['messages'], 6)
+        self.assertEqual(report['trades'], 12)
+        self.assertEqual(set(report['latency_ms']), {'mean', 'p50', 'p90', 'p99', 'max'})
+        json.dumps(report)
+
+class TestResume(ParquetTestCase):
+    '''the producer walks the whole file first, then a client resumes,
+    replay buffer is smaller than the file so older events are read from DataStream '''
+
+    def setUp(self):
+        super().setUp()
+        self.filename = self.write_parquet(pd.DataFrame({
+            'timestamp': pd.to_datetime(np.repeat(np.arange(20), 2), unit='s'),
+            'symbol': ['A', 'B'] * 20,
+            'price': np.arange(40, dtype=np.float64),
+        }))
+
+    def resume(self, token, symbols=None, streaming=False):
+        async def replay():
+            server = WSServer(filename=self.filename, replay_buffer=5, streaming=streaming)
+            await server.data_stream_logic('sample')
+            subscriber = Subscriber(SlowWebsocket(), server.build_message, max_queue=1000)
+            await server.resume(subscriber, 'sample', symbols, token)
+            return [item.event for item in subscriber.queue]
+        return asyncio.run(replay())
+
+    def test_resume_seq(self):
+        events = self.resume({'seq': 3})
+        self.assertEqual([event.seq for event in events[:-1]], list(range(4, 20)))
+        self.assertEqual(events[-1].type, 'ErrorEvent')
+
+    def test_resume_since(self):
+        events = self.resume({'since': 16000}, symbols=('B',))
+        self.assertEqual([event.data for event in events[:-1]],
+                         [[{'timestamp': 17000, 'symbol': 'B', 'price': 35.0}],
+                          [{'timestamp': 18000, 'symbol': 'B', 'price': 37.0}],
+                          [{'timestamp': 19000, 'symbol': 'B', 'price': 39.0}]])
+
+    def test_resume_streaming_live(self):
+        '''the producer keeps running and rotates replay buffer while a slow client
+        is replayed, dropped events are skipped and the client joins the live stream '''
+        async def replay():
+            server = WSServer(filename=self.filename, replay_buffer=5, streaming=True, delay=0.005)
+            producer = asyncio.ensure_future(server.data_stream_logic('sample'))
+            while len(server.history['sample'][0]) < 6:
+                await asyncio.sleep(0.001)
+            websocket = DelayedWebsocket(0.02)
+            subscriber = Subscriber(websocket, server.build_message, max_queue=4)
+            subscriber.start()
+            await server.resume(subscriber, 'sample', None, {'seq': 0})
+            await producer
+            while subscriber.queue:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.05)
+            subscriber.close()
+            return [json.loads(message) for message in websocket.messages]
+
+        messages = asyncio.run(replay())
+        self.assertIn('InfoEvent', [message['type'] for message in messages])
+        seqs = [message['seq'] for message in messages if message['type'] == 'TradeEvent']
+        self.assertEqual(seqs, sorted(set(seqs)))
+        self.assertEqual(messages[-1]['type'], 'ErrorEvent')
+
+    def test_invalid_resume_token(self):
+        '''a token which is not a number is an invalid subscription '''
+        server = WSServer(filename=self.filename)
+        for token in ('"abc"', '[1]', '{"a": 1}', 'true'):
+            message = '{{"channel": "sample", "seq": {}}}'.format(token)
+            self.assertEqual(server.parse_subscription(message), (None, None, None))
+        message = '{"channel": "sample", "since": 1.5}'
+        self.assertEqual(server.parse_subscription(message), ('sample', None, {'since': 1.5}))
+
+    def test_resume_failure_closes(self):
+        '''an error in resume task is sent to the client and the connection is closed '''
+        async def replay():
+            async def fail(*args):
+                raise ValueError('dropped row group')
+            server = WSServer(filename=self.filename)
+            server.resume = fail
+            websocket = SlowWebsocket()
+            subscriber = Subscriber(websocket, server.build_message, max_queue=10)
+            await server.resume_or_close(subscriber, 'sample', None, {'seq': 0})
+            return websocket
+
+        websocket = asyncio.run(replay())
+        self.assertEqual(json.loads(websocket.messages[-1])['type'], 'ErrorEvent')
+        self.assertEqual(websocket.close_code, 1011)
+
+    def test_resume_streaming(self):
+        '''ParquetStream can not seek, only buffered events are replayed '''
+        events = self.resume({'seq': 3}, streaming=True)
+        self.assertEqual(events[0].type, 'InfoEvent')
+        self.assertEqual([event.seq for event in events[1:-1]], list(range(15, 20)))
+
+class TestChannels(ParquetTestCase):
+    '''two channels share serializers, group N of one channel must not
+    be sent with cached data of group N of the other channel '''
+
+    def setUp(self):
+        super().setUp()
+        self.filenames = {}
+        for channel, symbol in (('first', 'A'), ('second', 'B')):
+            self.filenames[channel] = self.write_parquet(pd.DataFrame({
+                'timestamp': pd.to_datetime(np.arange(5), unit='s'),
+                'symbol': [symbol] * 5,
+                'price': np.arange(5, dtype=np.float64),
+            }), name='{}.parquet'.format(channel))
+
+    def messages(self, symbols=None, streaming=False):
+        async def stream():
+            server = WSServer(channels=self.filenames, streaming=streaming)
+            subscribers = {}
+            for channel in self.filenames:
+                subscribers[channel] = Subscriber(SlowWebsocket(), server.build_message, max_queue=1000)
+                server.subscribers[channel].setdefault(symbols, set()).add(subscribers[channel])
+            for channel in self.filenames:
+                await server.data_stream_logic(channel)
+            return {channel: [json.loads(item.message) for item in subscriber.queue]
+                    for channel, subscriber in subscribers.items()}
+        return asyncio.run(stream())
+
+    def check_channels(self, messages):
+        for channel, symbol in (('first', 'A'), ('second', 'B')):
+            trades = [message for message in messages[channel] if message['type'] == 'TradeEvent']
+            self.assertEqual(len(trades), 4)
+            self.assertTrue(all(trade['symbol'] == symbol for message in trades for trade in message['data']))
+
+    def test_payloads_differ(self):
+        self.check_channels(self.messages())
+
+    def test_filtered_payloads_differ(self):
+        self.check_channels(self.messages(symbols=('A', 'B')))
+
+    def test_start_clients(self):
+        '''producer waits until start_clients clients are subscribed '''
+        async def subscribe():
+            server = WSServer(channels=self.filenames, start_clients=2)
+            started = []
+            for symbols in (None, ('A',)):
+                server.subscribe(Subscriber(SlowWebsocket(), server.build_message), 'first', symbols)
+                started.append('first' in server.producers)
+            await server.producers['first']
+            return started
+
+        self.assertEqual(asyncio.run(subscribe()), [False, True])
+
+    def test_invalid_symbols(self):
+        '''symbols must be a string or a list of strings '''
+        server = WSServer(channels=self.filenames)
+        for symbols in ('5', '[{"a": 1}]', '["A", 1]', '{"A": 1}', '[["A"]]'):
+            message = '{{"channel": "first", "symbols": {}}}'.format(symbols)
+            self.assertEqual(server.parse_subscription(message), (None, None, None))
+        message = '{"channel": "first", "symbols": ["B", "A", "B"]}'
+        self.assertEqual(server.parse_subscription(message), ('first', ('A', 'B'), None))
+
+    def test_streaming_filter(self):
+        '''live groups of ParquetStream are filtered with its chunk columns '''
+        self.check_channels(self.messages(symbols=('A', 'B'), streaming=True))
+        messages = self.messages(symbols=('A',), streaming=True)
+        self.assertEqual(len([message for message in messages['first'] if message['type'] == 'TradeEvent']), 4)
+        self.assertEqual([message for message in messages['second'] if message['type'] == 'TradeEvent'], [])
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,12 +1,21 @@
+import time
 import asyncio
 import websockets
 import json
 
 from icecream import ic
 
+from serialization import Serializer, JSON
+
 class WSClient:
     '''websocket client to test websocket server
-    can connect to 1 channel - 'sample'
+    can connect to 1 channel, 'sample' by default,
+    and receive trades of some symbols only
+
+    run() prints every message and is meant for debugging.
+    consume() is the fast mode: messages are decoded in batches,
+    trades are handed to a sink (see sinks.py), nothing is logged per message,
+    and a lost connection is restored, resuming after the last received trade.
 
     Attributes:
 
@@ -19,42 +28,178 @@ class WSClient:
         channel:str
             name of channel to connect to
 
+        encoding:str
+            message encoding requested from server, json or msgpack
+
+        symbols:list
+            symbols to receive, None for all symbols of channel
+
+        last_timestamp:int
+            timestamp of the last trade passed to sink, used to resume after reconnect
+
+        last_seq:int
+            seq of the last received trade message, resume token sent after reconnect
+
+        stats:dict
+            counters of consume(): messages, trades, batches, reconnects
+
     Methods:
 
-        build_url(host:str, port:str)
+        build_url(host:str, port:str, encoding:str)
             returns a string containing websocket address to connect to
 
+        build_subscription(channel:str, symbols:list, since:int, seq:int)
+            returns subscription message, channel name or json with channel, symbols
+            and resume token: seq or timestamp to resume after
+
         connect(url:str, channel:str)
             connects to websocket server and sends a message with desired channel name
 
         read_response(response:str)
-            deserializes json to a dict and prints it
+            deserializes json (or msgpack) message to a dict and prints it
+
+        consume(sink)
+            receives trades in batches and writes them to sink until the stream is finished,
+            reconnects if connection is lost
+
+        consume_messages(websocket, sink, batch_size:int, batch_timeout:float)
+            collects messages of one connection into batches
+
+        handle_batch(messages:list, sink)
+            decodes a batch, drops already received trades and writes the rest to sink
 
         run()
             starts asyncio loop with websocket connection
     '''
-    def __init__(self, host:str, port:str, channel:str):
+    def __init__(self, host:str, port:str, channel:str, encoding:str=JSON, symbols:list=None):
         self.host = host
         self.port = port
         self.channel = channel
-
-    def build_url(self, host:str, port:str) -> str:
-        return 'ws://{}:{}'.format(host, port)
+        self.encoding = encoding
+        self.symbols = symbols
+        self.serializer = Serializer(encoding)
+        self.last_timestamp = None
+        self.last_seq = None
+        self.resuming = False
+        self.stats = {'messages': 0, 'trades': 0, 'batches': 0, 'reconnects': 0}
+
+    def build_url(self, host:str, port:str, encoding:str=JSON) -> str:
+        url = 'ws://{}:{}'.format(host, port)
+        if encoding != JSON:
+            url += '/?encoding={}'.format(encoding)
+        return url
+
+    def build_subscription(self, channel:str, symbols:list=None, since:int=None, seq:int=None) -> str:
+        if symbols is None and since is None and seq is None:
+            return channel
+        subscription = {'channel': channel}
+        if symbols is not None:
+            subscription['symbols'] = list(symbols)
+        if seq is not None:
+            subscription['seq'] = seq
+        elif since is not None:
+            subscription['since'] = since
+        return json.dumps(subscription)
 
     async def connect(self, url:str, channel:str):
         async with websockets.connect(url) as websocket:
-            await websocket.send(channel)
+            await websocket.send(self.build_subscription(channel, self.symbols))
             while True:
                 response = await websocket.recv()
                 self.read_response(response)
 
+    async def consume(self, sink, batch_size:int=500, batch_timeout:float=0.05, reconnect:bool=True,
+                      max_retries:int=10, backoff:float=0.1, max_backoff:float=5.0) -> dict:
+        url = self.build_url(self.host, self.port, self.encoding)
+        retries = 0
+        while True:
+            batches = self.stats['batches']
+            try:
+                async with websockets.connect(url, max_size=None) as websocket:
+                    await websocket.send(self.build_subscription(self.channel, self.symbols, self.last_timestamp, self.last_seq))
+                    await self.consume_messages(websocket, sink, batch_size, batch_timeout)
+                    break
+
+            except (OSError, websockets.ConnectionClosed) as e:
+                '''retries are counted from the last connection that received data '''
+                if self.stats['batches'] > batches:
+                    retries = 0
+                if not reconnect or retries >= max_retries:
+                    raise
+                retries += 1
+                self.stats['reconnects'] += 1
+                self.resuming = self.last_timestamp is not None
+                ic('Connection lost, reconnecting', url, retries, self.last_timestamp, repr(e))
+                await asyncio.sleep(min(backoff * 2 ** (retries - 1), max_backoff))
+
+        await sink.close()
+        return self.stats
+
+    async def consume_messages(self, websocket, sink, batch_size:int=500, batch_timeout:float=0.05):
+        '''a batch is handed over when it has batch_size messages
+        or batch_timeout seconds after its first message '''
+        messages = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                message = await asyncio.wait_for(websocket.recv(), timeout)
+            except asyncio.TimeoutError:
+                message = None
+            except websockets.ConnectionClosed:
+                if messages:
+                    await self.handle_batch(messages, sink)
+                raise
+
+            if message is not None:
+                messages.append(message)
+                if deadline is None:
+                    deadline = time.monotonic() + batch_timeout
+            if messages and (message is None or len(messages) >= batch_size):
+                finished = await self.handle_batch(messages, sink)
+                messages = []
+                deadline = None
+                if finished:
+                    return
+
+    async def handle_batch(self, messages:list, sink) -> bool:
+        '''returns True if the stream is finished '''
+        trades = []
+        finished = False
+        for message in self.serializer.decode_batch(messages):
+            if message['type'] == 'TradeEvent':
+                seq = message.get('seq')
+                if seq is not None:
+                    if self.last_seq is not None and seq <= self.last_seq:
+                        continue
+                    self.last_seq = seq
+                trades.extend(message['data'])
+            elif message['type'] == 'ErrorEvent':
+                finished = True
+
+        if self.resuming and trades and self.last_seq is None:
+            '''without seq, trades sent again after reconnect are dropped by timestamp '''
+            trades = [trade for trade in trades if trade['timestamp'] > self.last_timestamp]
+            self.resuming = not trades
+
+        self.stats['messages'] += len(messages)
+        self.stats['batches'] += 1
+        if trades:
+            self.stats['trades'] += len(trades)
+            self.last_timestamp = trades[-1]['timestamp']
+            await sink.write(trades)
+        return finished
+
     def read_response(self, response:str) -> dict:
-        response = json.loads(response)
+        if isinstance(response, str):
+            response = json.loads(response)
+        else:
+            response = self.serializer.decode(response)
         ic(response)
         return response
 
     def run(self):
-        url = self.build_url(self.host, self.port)
+        url = self.build_url(self.host, self.port, self.encoding)
         asyncio.get_event_loop().run_until_complete(self.connect(url, self.channel))
 
 if __name__ == '__main__':
@@ -4,12 +4,52 @@ import asyncio
 import websockets
 import json
 
+from array import array
+from bisect import bisect_right
+from collections import deque
+
 from events import Event, InfoEvent, TradeEvent, ErrorEvent
+from urllib.parse import urlparse, parse_qs
+
 from datastream import DataStream
+from parquet_stream import ParquetStream
+from subscriber import Subscriber, DROP_OLDEST
+from serialization import Serializer, JSON, available_encodings
+from replay import ReplayScheduler
+
+class ReplayEntry:
+    '''sent trade event and its encoded messages for unfiltered subscribers, encoding -> message '''
+    def __init__(self, event:TradeEvent):
+        self.event = event
+        self.messages = {}
 
 class WSServer:
-    '''Websocket server with a single channel - 'sample'.
-    Sends data from parquet file to all connected clients.
+    '''Websocket server with a registry of channels, each channel streams its own parquet file.
+    Sends data from parquet files to all connected clients.
+
+    Clients subscribe with a channel name, or with a json message that also
+    limits the stream to some symbols: {"channel": "sample", "symbols": ["BTC-USD"]}.
+    Subscribers with the same symbol filter share one filtered event,
+    so trades are filtered and encoded once per filter and not once per client.
+
+    Each channel has one producer task that walks the data stream,
+    serializes every event once and broadcasts the same message
+    to all subscribers of the channel. Clients can join mid-stream,
+    they receive events starting from the current position.
+
+    Trade messages carry seq, a position of the timestamp group in the channel.
+    A client that reconnects sends a resume token, the last received seq
+    or the timestamp of the last received trade:
+    {"channel": "sample", "seq": 1234} or {"channel": "sample", "since": 1600000000000}.
+    Missed events are replayed from a bounded buffer of recent events,
+    older ones are read again from DataStream by group number,
+    and then the client joins the live stream without gaps or duplicates.
+
+    Every client has its own bounded outbound queue (Subscriber),
+    so a slow client can not stall the stream for other clients.
+
+    Messages are json by default, clients can ask for msgpack
+    with a query parameter: ws://host:port/?encoding=msgpack
 
     Attributes:
         host:str
@@ -24,86 +64,407 @@ class WSServer:
         available_channels:set
             contains a list of all channels available for clients
 
-        data_stream:DataStream
-            a separate module that reads data from parquet and
+        channels:dict
+            channel name -> parquet file of channel, {'sample': filename} by default
+
+        subscribers:dict
+            channel name -> symbol filter -> set of Subscriber objects,
+            filter is None for all symbols or a sorted tuple of symbols
+
+        producers:dict
+            channel name -> producer task of channel
+
+        finished_events:dict
+            channel name -> last event of a finished stream,
+            it is sent to clients that subscribe after the end
+
+        serializers:dict
+            encoding -> Serializer, each event is encoded once per encoding
+
+        replay_buffers:dict
+            channel name -> deque of recent ReplayEntry objects, at most replay_buffer entries
+
+        history:dict
+            channel name -> (seqs, times), arrays with seq and first trade timestamp
+            of every sent trade event, 16 bytes per event, used to find resume positions
+
+        data_streams:dict
+            channel name -> DataStream, a separate module that reads data from parquet and
             produces events trade by trade to send them to clients
 
+        streaming:bool
+            if True, channels use ParquetStream, which reads parquet files
+            row group by row group instead of loading them into memory
+
         delay:float
-            delays send_message func, for testing purposes
+            delays send_message func, for testing purposes,
+            used only if speed is not set
+
+        speed:float
+            paced replay speed: 1 - real time, 10 - 10x faster, None - fixed delay,
+            events are sent according to gaps between their timestamps
+
+        schedulers:dict
+            channel name -> ReplayScheduler of channel producer
+
+        max_queue:int
+            size of outbound queue of each client
+
+        slow_consumer_policy:str
+            drop_oldest, coalesce or disconnect, see subscriber.py
+
+        max_lag:float
+            lag in seconds after which a client is disconnected by disconnect policy
+
+        start_clients:int
+            producer of a channel starts when this many clients are subscribed to it,
+            so all clients of a load test receive the whole stream
 
     Methods:
-        build_message(event:Event)
-            takes data from Event and serializes it to json string
+        build_message(event:Event, encoding:str)
+            takes data from Event and serializes it, json string by default
+
+        requested_encoding(path:str)
+            returns encoding requested in connection url, json by default
+
+        parse_subscription(message:str)
+            returns (channel, symbol filter, resume token) of a subscription message,
+            channel is None if the message is not a valid subscription,
+            including symbols which are not a list of strings
+            and a resume token which is not a number
 
         handler(websocket, path)
             handler method manages connected clients,
-            and sends them data stream if they choose correct channel
+            and subscribes them to data stream if they choose correct channel
+
+        subscribe(subscriber:Subscriber, channel:str, symbols:tuple)
+            adds subscriber to channel with symbol filter, starts channel producer
+            if it is not started and start_clients clients are subscribed
+
+        resume(subscriber:Subscriber, channel:str, symbols:tuple, token:dict)
+            replays missed events to subscriber and subscribes it to the live stream,
+            events dropped from replay buffer of a streaming channel during replay
+            are skipped with an InfoEvent
+
+        resume_or_close(subscriber:Subscriber, channel:str, symbols:tuple, token:dict)
+            runs resume, sends ErrorEvent and closes connection if it fails
+
+        resume_position(channel:str, token:dict)
+            returns position in history of the first event after resume token
+
+        replay_event(subscriber:Subscriber, channel:str, symbols:tuple, position:int)
+            puts a past event into subscriber queue, from replay buffer or from data stream
+
+        remember(channel:str, event:TradeEvent)
+            adds a sent event to replay buffer and history
+
+        unsubscribe(subscriber:Subscriber, channel:str, symbols:tuple)
+            removes subscriber from channel
 
-        data_stream_logic(websocket)
-            contains a loop that calls data_stream on each iteration
+        data_stream_logic(channel:str)
+            producer loop that calls data_stream on each iteration
             to recieve events with trade data or error data
-            sends events to clients
+            and broadcasts them to channel subscribers,
+            events are timestamped right before broadcast
+
+        broadcast(channel:str, event:Event, shared:dict)
+            filters event once per symbol filter, serializes it once per encoding
+            and puts it into queues of all subscribers of channel,
+            messages for unfiltered subscribers are stored in shared
+
+        filter_event(channel:str, event:Event, symbols:tuple)
+            returns event with trades of symbols only, None if there are no such trades
+
+        client_metrics()
+            returns lag and queue depth of every connected client
+
+        replay_stats()
+            returns scheduling jitter statistics of every channel
 
         send_message(websocket, message:str)
-            sends json to all connected clients
+            sends json to a single client
 
         run()
             runs asyncio loop with websocket server
     '''
-    def __init__(self, host:str='localhost', port:int=8000, delay:float = 0, filename:str='trades_sample.parquet'):
+    def __init__(self, host:str='localhost', port:int=8000, delay:float = 0, filename:str='trades_sample.parquet',
+                 max_queue:int=1000, slow_consumer_policy:str=DROP_OLDEST, max_lag:float=5.0,
+                 speed:float=None, channels:dict=None, streaming:bool=False, replay_buffer:int=10000,
+                 start_clients:int=1):
         self.host = host
         self.port = port
         self.connected_clients = set()
-        self.available_channels = set(['sample'])
-        self.data_stream = DataStream(filename=filename)
+        self.channels = channels if channels is not None else {'sample': filename}
+        self.available_channels = set(self.channels)
+        self.subscribers = {channel: {None: set()} for channel in self.available_channels}
+        self.producers = {}
+        self.finished_events = {}
+        self.serializers = {encoding: Serializer(encoding) for encoding in available_encodings()}
+        self.streaming = streaming
+        stream_class = ParquetStream if streaming else DataStream
+        self.data_streams = {channel: stream_class(filename=channel_filename)
+                             for channel, channel_filename in self.channels.items()}
         self.delay = delay
+        self.max_queue = max_queue
+        self.slow_consumer_policy = slow_consumer_policy
+        self.max_lag = max_lag
+        self.speed = speed
+        self.start_clients = start_clients
+        self.schedulers = {}
+        self.replay_buffers = {channel: deque(maxlen=replay_buffer) for channel in self.available_channels}
+        self.history = {channel: (array('q'), array('d')) for channel in self.available_channels}
 
-    '''builds a message and covnerts it to json '''
-    def build_message(self, event:Event) -> str:
-        message = {'type': event.type, 'timestamp': event.timestamp, 'data': event.data}
-        return json.dumps(message)
+    '''builds a message and serializes it '''
+    def build_message(self, event:Event, encoding:str=JSON):
+        return self.serializers[encoding].encode(event)
+
+    def requested_encoding(self, path:str) -> str:
+        encoding = parse_qs(urlparse(path or '').query).get('encoding', [JSON])[0]
+        if encoding not in self.serializers:
+            return JSON
+        return encoding
+
+    def parse_subscription(self, message:str):
+        if message in self.available_channels:
+            return message, None, None
+        try:
+            request = json.loads(message)
+        except (TypeError, ValueError):
+            return None, None, None
+        if not isinstance(request, dict) or request.get('channel') not in self.available_channels:
+            return None, None, None
+        symbols = request.get('symbols')
+        if isinstance(symbols, str):
+            symbols = [symbols]
+        if symbols is not None:
+            if not isinstance(symbols, list) or not all(isinstance(symbol, str) for symbol in symbols):
+                return None, None, None
+            symbols = tuple(sorted(set(symbols)))
+        token = None
+        for key in ('seq', 'since'):
+            if request.get(key) is None:
+                continue
+            value = request[key]
+            '''the token is compared with history, bool is an int but not a position '''
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                return None, None, None
+            token = {key: value}
+            break
+        return request['channel'], symbols, token
 
     async def handler(self, websocket, path):
         message = await websocket.recv()
+        channel, symbols, token = self.parse_subscription(message)
+        while channel is None:
+            await websocket.send("""Wrong channel. Available channels: {}""".format(self.available_channels))
+            message = await websocket.recv()
+            channel, symbols, token = self.parse_subscription(message)
+
+        encoding = self.requested_encoding(path)
+        subscriber = Subscriber(websocket, self.serializers[encoding].encode, max_queue=self.max_queue,
+                                policy=self.slow_consumer_policy, max_lag=self.max_lag, encoding=encoding)
+        info = InfoEvent('You are now connected to {} channel.'.format(channel))
+        subscriber.put(self.build_message(info, encoding), info)
+        # Register.
+        self.connected_clients.add(subscriber)
+        subscriber.start()
+        if token is None:
+            self.subscribe(subscriber, channel, symbols)
+        else:
+            asyncio.ensure_future(self.resume_or_close(subscriber, channel, symbols, token))
+        try:
+            await websocket.wait_closed()
+
+        finally:
+            # Unregister.
+            self.unsubscribe(subscriber, channel, symbols)
+            self.connected_clients.discard(subscriber)
+            subscriber.close()
+
+    def subscribe(self, subscriber:Subscriber, channel:str, symbols:tuple=None):
+        if channel in self.finished_events:
+            event = self.finished_events[channel]
+            subscriber.put(self.build_message(event, subscriber.encoding), event)
+            return
+        self.subscribers[channel].setdefault(symbols, set()).add(subscriber)
+        if channel in self.producers:
+            return
+        if sum(len(group) for group in self.subscribers[channel].values()) >= self.start_clients:
+            self.producers[channel] = asyncio.ensure_future(self.data_stream_logic(channel))
+
+    async def resume(self, subscriber:Subscriber, channel:str, symbols:tuple, token:dict):
+        '''the producer keeps running during replay, so replay follows history
+        until it catches up, and the subscriber joins the live stream right after
+        the last replayed event, without awaiting in between '''
+        position = self.resume_position(channel, token)
+        seqs = self.history[channel][0]
+        seekable = self.data_streams[channel].seekable
+
+        while position < len(seqs):
+            if subscriber.closed:
+                return
+            if len(subscriber.queue) >= subscriber.max_queue // 2:
+                await asyncio.sleep(0.001)
+                continue
+            if not seekable:
+                '''the producer rotates replay buffer while replay waits for the client '''
+                oldest = len(seqs) - len(self.replay_buffers[channel])
+                if position < oldest:
+                    info = InfoEvent('Resume position is older than replay buffer, {} events are lost.'.format(oldest - position))
+                    subscriber.put(self.build_message(info, subscriber.encoding), info)
+                    position = oldest
+                    continue
+            self.replay_event(subscriber, channel, symbols, position)
+            position += 1
+            if position % 100 == 0:
+                await asyncio.sleep(0)
+        if not subscriber.closed:
+            self.subscribe(subscriber, channel, symbols)
+
+    async def resume_or_close(self, subscriber:Subscriber, channel:str, symbols:tuple, token:dict):
+        '''resume runs in its own task, a failure is reported to the client and
+        the connection is closed, so the client does not wait unsubscribed '''
+        try:
+            await self.resume(subscriber, channel, symbols, token)
+        except Exception as e:
+            error = ErrorEvent('Resume failed: {}'.format(e))
+            subscriber.close()
+            try:
+                await subscriber.websocket.send(self.build_message(error, subscriber.encoding))
+                await subscriber.websocket.close(code=1011, reason='resume failed')
+            except Exception:
+                pass
+
+    def resume_position(self, channel:str, token:dict) -> int:
+        seqs, times = self.history[channel]
+        if 'seq' in token:
+            return bisect_right(seqs, token['seq'])
+        return bisect_right(times, token['since'])
+
+    def replay_event(self, subscriber:Subscriber, channel:str, symbols:tuple, position:int):
+        buffer = self.replay_buffers[channel]
+        index = position - (len(self.history[channel][0]) - len(buffer))
+        if index >= 0:
+            entry = buffer[index]
+            event = entry.event
+        else:
+            '''older than replay buffer, data stream is seekable by group number '''
+            seq = self.history[channel][0][position]
+            entry = None
+            event = TradeEvent(self.data_streams[channel].records(seq), group=(channel, seq), seq=seq)
+
+        filtered = self.filter_event(channel, event, symbols)
+        if filtered is None:
+            return
+        if entry is not None and symbols is None:
+            messages = entry.messages
+        else:
+            messages = {}
+        if subscriber.encoding not in messages:
+            messages[subscriber.encoding] = self.build_message(filtered, subscriber.encoding)
+        subscriber.put(messages[subscriber.encoding], filtered)
+
+    def remember(self, channel:str, event:TradeEvent):
+        seqs, times = self.history[channel]
+        seqs.append(event.seq)
+        times.append(event.data[0]['timestamp'])
+        entry = ReplayEntry(event)
+        self.replay_buffers[channel].append(entry)
+        return entry
+
+    def unsubscribe(self, subscriber:Subscriber, channel:str, symbols:tuple=None):
+        group = self.subscribers[channel].get(symbols)
+        if group is None:
+            return
+        group.discard(subscriber)
+        if not group and symbols is not None:
+            del self.subscribers[channel][symbols]
+
+    async def data_stream_logic(self, channel:str):
+        '''the only consumer of data_stream, so the stream is walked once
+        no matter how many clients are connected '''
+        data_stream = self.data_streams[channel]
+        scheduler = None
+        if self.speed is not None:
+            scheduler = ReplayScheduler(speed=self.speed)
+            self.schedulers[channel] = scheduler
+
+        n_group = 0
         while True:
-            if message in self.available_channels:
-                message = self.build_message(InfoEvent('You are now connected to {} channel.'.format(message)))
-                await websocket.send(message)
-                # Register.
-                self.connected_clients.add(websocket)
-                try:
-                    await self.data_stream_logic(websocket)
-
-                finally:
-                    # Unregister.
-                    self.connected_clients.remove(websocket)
-
-            else:
-                await websocket.send("""Wrong channel. Available channels: {}""".format(self.available_channels))
-                await asyncio.sleep(10)
-
-    async def data_stream_logic(self, websocket):
-        n_element = 0
-        while True:
-            event = await self.data_stream.run(n_element)
-            n_element += 1
+            event = await data_stream.run(n_group)
+            n_group += 1
 
             if event:
-                message = self.build_message(event)
-                await self.send_message(websocket, message)
+                if event.type == 'TradeEvent':
+                    '''serializers are shared by channels, so the cache key includes the channel '''
+                    event.group = (channel, event.seq)
+
+                if scheduler is not None and event.type == 'TradeEvent':
+                    await scheduler.wait(data_stream.group_time(event.seq))
+
+                '''the event was built before the pacing wait, its timestamp is the send time '''
+                event.timestamp = time.time()
+
+                if event.type == 'TradeEvent':
+                    self.broadcast(channel, event, self.remember(channel, event).messages)
+                else:
+                    self.broadcast(channel, event)
 
                 if event.type == 'ErrorEvent':
+                    self.finished_events[channel] = event
                     break
 
+                if scheduler is None:
+                    await asyncio.sleep(self.delay)
+                elif scheduler.speed is None:
+                    await asyncio.sleep(0)
+
+    def broadcast(self, channel:str, event:Event, shared:dict=None):
+        '''never waits for clients, each Subscriber sends from its own queue,
+        messages of unfiltered subscribers are kept in replay buffer '''
+        for symbols, group in list(self.subscribers[channel].items()):
+            if not group:
+                continue
+            filtered = self.filter_event(channel, event, symbols)
+            if filtered is None:
+                continue
+            messages = shared if symbols is None and shared is not None else {}
+            for subscriber in list(group):
+                if subscriber.encoding not in messages:
+                    messages[subscriber.encoding] = self.build_message(filtered, subscriber.encoding)
+                subscriber.put(messages[subscriber.encoding], filtered)
+
+    def filter_event(self, channel:str, event:Event, symbols:tuple):
+        '''errors and info are sent to every filter,
+        serializer cache key of a filtered batch includes the filter '''
+        if symbols is None or event.type != 'TradeEvent':
+            return event
+        data_stream = self.data_streams[channel]
+        if data_stream.seekable or data_stream.in_chunk(event.seq):
+            '''the live group of a streaming source is still in its chunk '''
+            trades = data_stream.records(event.seq, symbols)
+        else:
+            '''groups replayed from buffer are dropped from the chunk of a streaming source '''
+            trades = [trade for trade in event.data if trade.get(data_stream.symbol_column) in symbols]
+        if not trades:
+            return None
+        filtered = TradeEvent(trades, group=(channel, symbols, event.seq), seq=event.seq)
+        filtered.timestamp = event.timestamp
+        return filtered
+
+    def client_metrics(self) -> list:
+        return [dict(subscriber.metrics(), remote_address=str(subscriber.websocket.remote_address))
+                for subscriber in self.connected_clients]
+
     async def send_message(self, websocket, message):
         try:
-            for client in self.connected_clients:
-                await websocket.send(message)
+            await websocket.send(message)
 
         except websockets.ConnectionClosedOK:
             pass
 
-        await asyncio.sleep(self.delay)
+    def replay_stats(self) -> dict:
+        return {channel: scheduler.stats() for channel, scheduler in self.schedulers.items()}
 
     def run(self):
         start_server = websockets.serve(self.handler, self.host, self.port)
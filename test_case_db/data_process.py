@@ -4,15 +4,31 @@ from data_shuffle import ShuffleData
 from db_connector import PostgresConnector
 
 class DataProcessing:
-    '''reads csv and processes data to database '''
-    def __init__(self, config_filename, config_section):
+    '''reads csv and processes data to database
+
+    insert_mode:
+        'copy' - streams csv into table with COPY FROM STDIN (default)
+        'execute_values' - batched multi-row INSERT
+        'executemany' - one INSERT per row
+    '''
+    def __init__(self, config_filename, config_section, insert_mode='copy'):
         self.db_connector = PostgresConnector(config_filename, config_section)
         self.shuffle = ShuffleData()
+        self.insert_mode = insert_mode
 
     def test_insert_data_executemany(self, source_filename='bars_1.csv', table_name='bars_1'):
         data = self.db_connector.preprocess_data(source_filename)
         self.db_connector.insert_data_executemany(data, table_name)
 
+    def insert_data(self, source_filename='bars_1.csv', table_name='bars_1'):
+        if self.insert_mode == 'copy':
+            self.db_connector.insert_data_copy(source_filename, table_name)
+        elif self.insert_mode == 'execute_values':
+            rows = self.db_connector.iter_csv_rows(source_filename)
+            self.db_connector.insert_data_values(rows, table_name)
+        else:
+            self.test_insert_data_executemany(source_filename, table_name)
+
     def run(self):
         print('hello data reader')
         time.sleep(15)
@@ -26,8 +42,8 @@ class DataProcessing:
 
         self.shuffle.run()
 
-        self.test_insert_data_executemany(source_filename='bars_1_shuffled.csv', table_name='bars_1')
-        self.test_insert_data_executemany(source_filename='bars_2_shuffled.csv', table_name='bars_2')
+        self.insert_data(source_filename='bars_1_shuffled.csv', table_name='bars_1')
+        self.insert_data(source_filename='bars_2_shuffled.csv', table_name='bars_2')
 
         print('Done. All data processed to database.')
 
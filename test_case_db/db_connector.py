@@ -1,8 +1,12 @@
+import io
 import csv
 import time
+import queue
+import threading
 import pandas as pd
 
 import psycopg2
+import psycopg2.extras
 from configparser import ConfigParser
 from icecream import ic
 
@@ -60,6 +64,14 @@ class PostgresConnector(DBConnector):
             read data from file, changes columns order and filters null values
             returns a list of preprocessed bars
 
+        preprocess_data_chunks(source_filename:str, chunk_size:int)
+            same as preprocess_data, but yields lists of chunk_size bars,
+            memory does not depend on file size
+
+        prefetch_chunks(chunks, queue_size:int)
+            consumes chunks in a background thread and yields them through
+            a bounded queue, so parsing overlaps with database writes
+
         execute(command:str, data=None, fetch=bool, executemany=bool)
             Executes a query command.
             Data contains some data like data to be inserted to database.
@@ -70,6 +82,18 @@ class PostgresConnector(DBConnector):
         insert_data_executemany(data:list, table_name:str, fetch:bool)
             bulk insert trades to database
 
+        iter_csv_rows(source_filename:str)
+            lazily reads csv and yields preprocessed rows one by one
+
+        insert_data_values(rows, table_name:str, page_size:int)
+            inserts rows with psycopg2.extras.execute_values,
+            page_size rows per INSERT statement
+
+        insert_data_copy(source_filename:str, table_name:str, chunk_size:int, queue_size:int)
+            streams preprocessed chunks from csv into table with COPY FROM STDIN,
+            next chunks are parsed while current one is sent,
+            falls back to insert_data_values if COPY is not supported by the server
+
         read_data_limit(table_name:str, limit:int)
             reads n rows from database, amount of rows is based on limit parameter
 
@@ -129,18 +153,60 @@ class PostgresConnector(DBConnector):
 
     def preprocess_data(self, source_filename:str) -> list:
         start_time = time.time()
-        result = []
-        with open(source_filename, 'r') as f:
-            reader = csv.reader(f)
-            next(reader) # Skip the header row.
-            for row in reader:
-                row = self.format_data(row)
-                if self.check_null_data(row):
-                    result.append(row)
+        result = list(self.iter_csv_rows(source_filename))
         time_spent = time.time() - start_time
         ic("data preprocessed in %s seconds" % (time_spent))
         return result
 
+    def preprocess_data_chunks(self, source_filename:str, chunk_size:int=50000):
+        chunk = []
+        for row in self.iter_csv_rows(source_filename):
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def prefetch_chunks(self, chunks, queue_size:int=2):
+        '''at most queue_size chunks wait in memory besides the one being consumed '''
+        buffer = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for chunk in chunks:
+                    if not put(chunk):
+                        return
+            except Exception as error:
+                put(error)
+                return
+            put(done)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = buffer.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            producer.join()
+
     def execute(self, command:str, data=None, fetch=False, executemany=False):
         '''executes a database query '''
         start_time = time.time()
@@ -172,6 +238,95 @@ class PostgresConnector(DBConnector):
         q = "INSERT INTO {} (candle_date, symbol, open, high, low, close, adj_close, volume) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)".format(table_name)
         self.execute(q, data, fetch=False, executemany=True)
 
+    def iter_csv_rows(self, source_filename:str):
+        with open(source_filename, 'r') as f:
+            reader = csv.reader(f)
+            next(reader) # Skip the header row.
+            for row in reader:
+                row = self.format_data(row)
+                if self.check_null_data(row):
+                    yield row
+
+    def insert_data_values(self, rows, table_name:str, page_size:int=10000) -> int:
+        '''rows can be any iterable, it is consumed page by page '''
+        start_time = time.time()
+        q = "INSERT INTO {} (candle_date, symbol, open, high, low, close, adj_close, volume) VALUES %s".format(table_name)
+        conn = None
+        inserted = 0
+        try:
+            conn = psycopg2.connect(**self.connection_parameters)
+            cur = conn.cursor()
+            page = []
+            for row in rows:
+                page.append(row)
+                if len(page) >= page_size:
+                    psycopg2.extras.execute_values(cur, q, page, page_size=page_size)
+                    inserted += len(page)
+                    page = []
+            if page:
+                psycopg2.extras.execute_values(cur, q, page, page_size=page_size)
+                inserted += len(page)
+            cur.close()
+            conn.commit()
+        except (Exception, psycopg2.DatabaseError) as error:
+            inserted = 0
+            print(error)
+        finally:
+            time_spent = time.time() - start_time
+            ic("%s rows inserted with execute_values in %s seconds" % (inserted, time_spent))
+            if conn is not None:
+                conn.close()
+            return inserted
+
+    def copy_chunk(self, cur, q:str, chunk:list):
+        '''writes chunk as csv to an in-memory buffer and sends it with COPY '''
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(chunk)
+        buffer.seek(0)
+        cur.copy_expert(q, buffer)
+
+    def insert_data_copy(self, source_filename:str, table_name:str, chunk_size:int=50000, queue_size:int=2) -> int:
+        '''at most queue_size + 1 chunks of rows are kept in memory at a time,
+        all chunks are committed in a single transaction '''
+        start_time = time.time()
+        q = "COPY {} (candle_date, symbol, open, high, low, close, adj_close, volume) FROM STDIN WITH (FORMAT csv)".format(table_name)
+        conn = None
+        chunks = None
+        inserted = 0
+        copy_supported = True
+        try:
+            conn = psycopg2.connect(**self.connection_parameters)
+            cur = conn.cursor()
+            chunks = self.prefetch_chunks(self.preprocess_data_chunks(source_filename, chunk_size), queue_size)
+            for chunk in chunks:
+                self.copy_chunk(cur, q, chunk)
+                inserted += len(chunk)
+            cur.close()
+            conn.commit()
+        except psycopg2.NotSupportedError as error:
+            print(error)
+            copy_supported = False
+        except (Exception, psycopg2.DatabaseError) as error:
+            inserted = 0
+            print(error)
+        finally:
+            if chunks is not None:
+                chunks.close()
+            if conn is not None:
+                conn.close()
+
+        if not copy_supported:
+            ic('COPY is not supported, falling back to execute_values')
+            return self.insert_data_values(self.iter_csv_rows(source_filename), table_name, page_size=chunk_size)
+
+        time_spent = time.time() - start_time
+        ic("%s rows copied in %s seconds" % (inserted, time_spent))
+        return inserted
+
+    def truncate_table(self, table_name:str):
+        q = "TRUNCATE {} RESTART IDENTITY".format(table_name)
+        self.execute(q, data=None, fetch=False, executemany=False)
+
     def read_data_limit(self, table_name:str='bars_1', limit:int=0):
         q = "select * from {} limit {}".format(table_name, limit)
         data = self.execute(q, data=None, fetch=True, executemany=False)
@@ -266,6 +421,37 @@ class TestPostgressConnector:
         data = self.db_connector.preprocess_data(source_filename)
         self.db_connector.insert_data_executemany(data, table_name)
 
+    def test_preprocess_data_chunks(self, source_filename='bars_1.csv', chunk_size=50000):
+        n_chunks = 0
+        n_rows = 0
+        for chunk in self.db_connector.preprocess_data_chunks(source_filename, chunk_size):
+            n_chunks += 1
+            n_rows += len(chunk)
+        ic('chunks', n_chunks, 'rows', n_rows)
+
+    def test_insert_data_copy(self, source_filename='bars_1.csv', table_name='bars_1'):
+        self.db_connector.insert_data_copy(source_filename, table_name)
+
+    def test_benchmark_insert_strategies(self, source_filename='bars_1_shuffled.csv', table_name='bars_1'):
+        '''compares rows/sec of executemany, execute_values and COPY,
+        table is truncated before each strategy '''
+        strategies = {
+            'executemany': lambda: self.db_connector.insert_data_executemany(self.db_connector.preprocess_data(source_filename), table_name),
+            'execute_values': lambda: self.db_connector.insert_data_values(self.db_connector.iter_csv_rows(source_filename), table_name),
+            'copy': lambda: self.db_connector.insert_data_copy(source_filename, table_name),
+        }
+        results = {}
+        for name, insert in strategies.items():
+            self.db_connector.truncate_table(table_name)
+            start_time = time.time()
+            insert()
+            time_spent = time.time() - start_time
+            rows = self.db_connector.execute("select count(*) from {}".format(table_name), fetch=True)[0][0]
+            results[name] = rows / time_spent if time_spent > 0 else 0
+            ic(name, rows, 'rows in %s seconds' % (time_spent), '%d rows/sec' % (results[name]))
+        self.db_connector.truncate_table(table_name)
+        return results
+
     def test_read_symbols_distinct(self, table_name):
         data = self.db_connector.read_symbols_distinct(table_name)
         ic(len(data))